@@ -1,33 +1,122 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash, send_from_directory
-import uuid
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, session, flash, stream_with_context, g, before_render_template, template_rendered
+import hashlib
+import json
 import os
+import time
+import zlib
 from functools import wraps
-from src.user import register_user, login_user, get_user_by_email, get_notifications, mark_notification_read
-from src.task import create_task, share_task, update_task_status, list_tasks, revoke_share, add_comment, generate_report, start_live_task, stop_live_task, checkin_live_task, leave_live_task, get_live_status, delete_task, accept_shared_task, reject_shared_task, reclaim_task
-from src.utils import USERS_FILE, TASKS_FILE, load_data, save_data
+from src.user import register_user, login_user, get_user_by_email, get_notifications, notification_badge, mark_notification_read, mark_all_notifications_read
+from src.task import create_task, share_task, update_task_status, list_tasks, revoke_share, add_comment, generate_report, start_live_task, stop_live_task, checkin_live_task, leave_live_task, get_live_status, delete_task, accept_shared_task, reject_shared_task, reclaim_task, iter_report, report_cache_stats, REPORT_FORMATS, list_tasks_page, get_task_log, get_task, apply_batch, get_stats, list_occurrences, update_occurrence_status
+from src.utils import USERS_FILE, TASKS_FILE, run_transaction, cache_stats, tx_stats
+from src.scheduler import start_jobs
+from src.tokens import TokenStore
+from src.events import hub
+from src.recurrence import OCCURRENCE_WINDOW_DAYS
+from src.metrics import metrics
 
 app = Flask(__name__)
 app.secret_key = 'secret_key_for_session'
 
-tokens = {}
-
-def generate_token():
-    return str(uuid.uuid4())
+tokens = TokenStore()
+
+# background jobs (live start/end, due-date notices, presence flush) run in every process that
+# serves requests; set SHARETASK_JOBS=0 where another process runs them, e.g. `main.py scheduler`
+JOBS_ENABLED = os.environ.get('SHARETASK_JOBS', '1') != '0'
+
+@app.before_request
+def start_request_metrics():
+    metrics.begin()
+
+@app.before_request
+def ensure_jobs():
+    # started on the first request so each WSGI worker (forked or not) runs its own, and the
+    # debug reloader's parent, which never serves, runs none; restarts them if they died
+    if JOBS_ENABLED:
+        start_jobs()
+
+@app.after_request
+def finish_request_metrics(response):
+    stats = metrics.end()
+    if stats is not None:
+        metrics.finish_request(stats, request.endpoint or 'unmatched', request.method, request.path, response.status_code)
+    return response
+
+@app.teardown_request
+def drop_request_metrics(exc):
+    # after_request is skipped when the view raised
+    metrics.end()
+
+@before_render_template.connect_via(app)
+def _render_started(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _render_finished(sender, template, context, **extra):
+    metrics.record_io('render', 0, time.perf_counter() - g.pop('render_started', time.perf_counter()))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    data_cache, report_cache = cache_stats(), report_cache_stats()
+    extra = {'sharetask_data_cache_hits_total': ('Data file cache hits', 'counter', data_cache['hits']),
+             'sharetask_data_cache_misses_total': ('Data file cache misses', 'counter', data_cache['misses']),
+             'sharetask_report_cache_hits_total': ('Report fragment cache hits', 'counter', report_cache['hits']),
+             'sharetask_report_cache_misses_total': ('Report fragment cache misses', 'counter', report_cache['misses']),
+             'sharetask_event_subscribers': ('Open event streams', 'gauge', hub.stats()['subscribers'])}
+    extra.update({f"sharetask_tx_{name}_total": (f"Units of work: {name}", 'counter', value) for name, value in tx_stats().items()})
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+def _token_user():
+    token = None
+    if 'Authorization' in request.headers:
+        auth_header = request.headers['Authorization']
+        if auth_header.startswith('Bearer '):
+            token = auth_header.split(' ')[1]
+    return tokens.lookup(token) if token else None
 
 def token_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            if auth_header.startswith('Bearer '):
-                token = auth_header.split(' ')[1]
-        if not token or token not in tokens.values():
+        user_email = _token_user()
+        if not user_email:
             return jsonify({'error': 'Unauthorized'}), 401
-        user_email = next((email for email, t in tokens.items() if t == token), None)
         return f(user_email, *args, **kwargs)
     return wrapper
 
+REPORT_MIMETYPES = {'text': 'text/plain', 'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+REPORT_EXTENSIONS = {'text': 'txt', 'csv': 'csv', 'ndjson': 'ndjson'}
+REPORT_CHUNK_SIZE = 64 * 1024
+
+def _buffered(chunks):
+    # one write per ~64KB instead of one per task
+    buf, size = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= REPORT_CHUNK_SIZE:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def report_response(user_email, fmt, attachment=False):
+    """Report streamed as a chunked response, gzipped on the fly if the client accepts it."""
+    chunks = _buffered(iter_report(user_email, fmt))
+    headers = {'Vary': 'Accept-Encoding'}
+    if attachment:
+        headers['Content-Disposition'] = f'attachment; filename=task_report.{REPORT_EXTENSIONS[fmt]}'
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        chunks = _gzipped(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=REPORT_MIMETYPES[fmt], headers=headers)
+
 def login_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
@@ -54,8 +143,7 @@ def api_login():
         return jsonify({'error': 'Missing fields'}), 400
     success, msg = login_user(data['email'], data['password'], set_session=False)
     if success:
-        token = generate_token()
-        tokens[data['email']] = token
+        token = tokens.issue(data['email'])
         return jsonify({'message': msg, 'token': token}), 200
     return jsonify({'error': msg}), 401
 
@@ -72,14 +160,85 @@ def api_create_task(user_email):
         return jsonify({'message': msg}), 201
     return jsonify({'error': msg}), 400
 
+TASK_PAGE_PARAMS = ('limit', 'cursor', 'sort', 'fields', 'exclude', 'relation', 'master_status', 'category', 'task_type', 'due_from', 'due_to')
+
+def _project(task, fields, exclude):
+    if fields:
+        task = {k: task[k] for k in fields if k in task}
+    return {k: v for k, v in task.items() if k not in exclude}
+
+def etag_json(body):
+    """JSON 200 with a strong ETag over the body, or 304 if the client already has it."""
+    response = jsonify(body)
+    response.set_etag(hashlib.sha256(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
 @app.route('/api/tasks', methods=['GET'])
 @token_required
 def api_list_tasks(user_email):
-    success, msg, tasks = list_tasks(False, user_email)
+    args = request.args
+    if not any(p in args for p in TASK_PAGE_PARAMS):
+        try:
+            window = _int_arg('window')
+        except ValueError:
+            return jsonify({'error': 'window must be an integer'}), 400
+        success, msg, tasks = list_tasks(False, user_email, window)
+        if success:
+            return etag_json({'message': msg, 'tasks': tasks})
+        return jsonify({'error': msg}), 400
+    try:
+        limit = int(args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    sort = args.get('sort', 'id')
+    filters = {k: args.get(k) for k in ('master_status', 'category', 'task_type', 'due_from', 'due_to')}
+    success, msg, tasks, next_cursor = list_tasks_page(user_email, args.get('relation'), filters, sort.lstrip('-'), sort.startswith('-'),
+                                                       args.get('cursor'), limit)
+    if not success:
+        return jsonify({'error': msg}), 400
+    fields = [f for f in args.get('fields', '').split(',') if f]
+    exclude = {f for f in args.get('exclude', '').split(',') if f}
+    return etag_json({'message': msg, 'tasks': [[tid, _project(task, fields, exclude)] for tid, task in tasks], 'next_cursor': next_cursor})
+
+@app.route('/api/tasks/batch', methods=['POST'])
+@token_required
+def api_batch(user_email):
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else data
+    success, msg, results = apply_batch(operations, user_email)
+    if success:
+        return jsonify({'message': msg, 'results': results}), 200
+    return jsonify({'error': msg}), 400
+
+@app.route('/api/occurrences', methods=['GET'])
+@token_required
+def api_occurrences(user_email):
+    try:
+        days = _int_arg('days', OCCURRENCE_WINDOW_DAYS)
+    except ValueError:
+        return jsonify({'error': 'days must be an integer'}), 400
+    success, msg, occurrences = list_occurrences(user_email, request.args.get('start'), days)
     if success:
-        return jsonify({'message': msg, 'tasks': tasks}), 200
+        return etag_json({'message': msg, 'occurrences': occurrences})
     return jsonify({'error': msg}), 400
 
+@app.route('/api/stats', methods=['GET'])
+@token_required
+def api_stats(user_email):
+    filters = {k: request.args.get(k) for k in ('master_status', 'category', 'task_type')}
+    success, msg, stats = get_stats(user_email, request.args.get('scope', 'mine'), filters)
+    if success:
+        return etag_json({'message': msg, 'stats': stats})
+    return jsonify({'error': msg}), 400
+
+@app.route('/api/tasks/<task_id>', methods=['GET'])
+@token_required
+def api_get_task(user_email, task_id):
+    success, msg, task = get_task(task_id, user_email)
+    if success:
+        return etag_json({'message': msg, 'task': task})
+    return jsonify({'error': msg}), 404
+
 @app.route('/api/tasks/<task_id>', methods=['DELETE'])
 @token_required
 def api_delete_task(user_email, task_id):
@@ -140,6 +299,32 @@ def api_add_comment(user_email, task_id):
         return jsonify({'message': msg}), 200
     return jsonify({'error': msg}), 400
 
+def _int_arg(name, default=None):
+    value = request.args.get(name)
+    return default if value in (None, '') else int(value)
+
+def task_log_response(user_email, task_id, field):
+    try:
+        before, limit = _int_arg('before'), _int_arg('limit', 20)
+    except ValueError:
+        return jsonify({'error': 'before and limit must be integers'}), 400
+    if not 1 <= limit <= 500:
+        return jsonify({'error': 'limit must be between 1 and 500'}), 400
+    success, msg, entries, next_before = get_task_log(task_id, field, user_email, before, limit)
+    if success:
+        return jsonify({'message': msg, field: entries, 'next_before': next_before}), 200
+    return jsonify({'error': msg}), 404
+
+@app.route('/api/tasks/<task_id>/comments', methods=['GET'])
+@token_required
+def api_task_comments(user_email, task_id):
+    return task_log_response(user_email, task_id, 'comments')
+
+@app.route('/api/tasks/<task_id>/history', methods=['GET'])
+@token_required
+def api_task_history(user_email, task_id):
+    return task_log_response(user_email, task_id, 'history')
+
 @app.route('/api/tasks/<task_id>/status', methods=['PUT'])
 @token_required
 def api_update_status(user_email, task_id):
@@ -151,6 +336,17 @@ def api_update_status(user_email, task_id):
         return jsonify({'message': msg}), 200
     return jsonify({'error': msg}), 400
 
+@app.route('/api/tasks/<task_id>/occurrences/<day>', methods=['PUT'])
+@token_required
+def api_update_occurrence(user_email, task_id, day):
+    data = request.get_json()
+    if not data or 'status' not in data:
+        return jsonify({'error': 'Missing status'}), 400
+    success, msg = update_occurrence_status(task_id, day, data['status'], user_email)
+    if success:
+        return jsonify({'message': msg}), 200
+    return jsonify({'error': msg}), 400
+
 @app.route('/api/tasks/<task_id>/start-live', methods=['POST'])
 @token_required
 def api_start_live(user_email, task_id):
@@ -185,12 +381,44 @@ def api_live_status(user_email, task_id):
         return jsonify({'message': msg, 'status': status}), 200
     return jsonify({'error': msg}), 400
 
+EVENT_KEEPALIVE = 15  # seconds between comment lines on an idle stream, keeps proxies from closing it
+
+def _event_stream(sub):
+    try:
+        # tell EventSource how soon to reconnect if the stream drops
+        yield "retry: 1000\n\n"
+        while not sub.closed:
+            events = sub.get(EVENT_KEEPALIVE)
+            if not events:
+                yield ": keepalive\n\n"
+            for event_id, kind, data in events:
+                yield f"id: {event_id}\nevent: {kind}\ndata: {json.dumps(data, default=str)}\n\n"
+    finally:
+        hub.unsubscribe(sub)
+
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    # EventSource cannot send headers, so the UI's session cookie is accepted too
+    user_email = session.get('user_email') or _token_user()
+    if not user_email:
+        return jsonify({'error': 'Unauthorized'}), 401
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    sub = hub.subscribe(user_email, int(last_id) if last_id and last_id.isdigit() else None)
+    return Response(_event_stream(sub), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/report', methods=['POST'])
 @token_required
 def api_generate_report(user_email):
+    data = request.get_json(silent=True) or {}
+    fmt = request.args.get('format') or data.get('format')
+    if fmt:
+        if fmt not in REPORT_FORMATS:
+            return jsonify({'error': f"Format must be one of: {', '.join(REPORT_FORMATS)}"}), 400
+        return report_response(user_email, fmt)
     success, report = generate_report(user_email)
     if success:
-        return jsonify({'message': 'Report generated', 'report': report}), 200
+        return jsonify({'message': 'Report generated', 'report': report, 'cache': report_cache_stats()}), 200
     return jsonify({'error': report}), 400
 
 # UI routes for frontend screens
@@ -221,8 +449,7 @@ def ui_login():
         success, msg = login_user(email, password, set_session=False)
         if success:
             session['user_email'] = email
-            token = generate_token()
-            tokens[email] = token
+            tokens.issue(email)
             flash(msg)
             return redirect(url_for('ui_home'))
         flash(msg)
@@ -240,8 +467,7 @@ def ui_home():
     user_email = session.get('user_email')
     success, msg, tasks_list = list_tasks(False, user_email)
     tasks = tasks_list if success else []
-    notifications = get_notifications(user_email)
-    unread_count = sum(1 for n in notifications if not n.get('read', True))
+    notifications, unread_count = notification_badge(user_email)
     return render_template('home.html', tasks=tasks, user_email=user_email, notifications=notifications, unread_count=unread_count)
 
 @app.route('/generate-report', methods=['POST'])
@@ -249,16 +475,17 @@ def ui_home():
 def ui_generate_report():
     user_email = session.get('user_email')
     success, report = generate_report(user_email)
-    notifications = get_notifications(user_email)
-    unread_count = sum(1 for n in notifications if not n.get('read', True))
+    notifications, unread_count = notification_badge(user_email)
     return render_template('report.html', report=report, notifications=notifications, unread_count=unread_count)
 
 @app.route('/download-report', methods=['POST'])
 @login_required
 def download_report():
-    file_type = request.form.get('format', 'txt')
-    filename = f'task_report.{file_type}'
-    return send_from_directory('data', filename, as_attachment=True)
+    fmt = {'txt': 'text'}.get(request.form.get('format', 'txt'), request.form.get('format'))
+    if fmt not in REPORT_FORMATS:
+        flash('Unknown report format')
+        return redirect(url_for('ui_home'))
+    return report_response(session.get('user_email'), fmt, attachment=True)
 
 @app.route('/profile')
 @login_required
@@ -266,8 +493,7 @@ def ui_profile():
     user_email = session.get('user_email')
     user_data = get_user_by_email(user_email)
     user_name = user_data.get('name', 'N/A') if user_data else 'N/A'
-    notifications = get_notifications(user_email)
-    unread_count = sum(1 for n in notifications if not n.get('read', True))
+    notifications, unread_count = notification_badge(user_email)
     return render_template('profile.html', user_email=user_email, user_name=user_name, notifications=notifications, unread_count=unread_count)
 
 @app.route('/create-task', methods=['GET', 'POST'])
@@ -289,8 +515,7 @@ def ui_create_task():
             return redirect(url_for('ui_home'))
         flash(msg)
     user_email = session.get('user_email')
-    notifications = get_notifications(user_email)
-    unread_count = sum(1 for n in notifications if not n.get('read', True))
+    notifications, unread_count = notification_badge(user_email)
     return render_template('create_task.html', notifications=notifications, unread_count=unread_count, user_email=user_email)
 
 @app.route('/delete-task/<task_id>', methods=['POST'])
@@ -308,19 +533,19 @@ def ui_delete_task(task_id):
 @login_required
 def ui_task_details(task_id):
     user_email = session.get('user_email')
-    success, msg, tasks_list = list_tasks(False, user_email)
-    task = None
-    if success:
-        for tid, t in tasks_list:
-            if tid == task_id:
-                task = t
-                break
-    if not task:
+    success, msg, task = get_task(task_id, user_email)
+    if not success:
         flash('Task not found')
         return redirect(url_for('ui_home'))
-    notifications = get_notifications(user_email)
-    unread_count = sum(1 for n in notifications if not n.get('read', True))
-    return render_template('task_details.html', task=task, task_id=task_id, user_email=user_email, notifications=notifications, unread_count=unread_count)
+    try:
+        comments_before, history_before = _int_arg('comments_before'), _int_arg('history_before')
+    except ValueError:
+        comments_before = history_before = None
+    _, _, comments, comments_next = get_task_log(task_id, 'comments', user_email, comments_before)
+    _, _, history, history_next = get_task_log(task_id, 'history', user_email, history_before)
+    notifications, unread_count = notification_badge(user_email)
+    return render_template('task_details.html', task=task, task_id=task_id, user_email=user_email, notifications=notifications, unread_count=unread_count,
+                           comments=comments, comments_next=comments_next, history=history, history_next=history_next)
 
 @app.route('/task/<task_id>/share', methods=['POST'])
 @login_required
@@ -433,16 +658,27 @@ def ui_notifications():
             flash(msg)
         else:
             # mark all
-            users = load_data(USERS_FILE)
-            if user_email in users and 'notifications' in users[user_email]:
-                for n in users[user_email]['notifications']:
-                    n['read'] = True
-                save_data(USERS_FILE, users)
+            mark_all_notifications_read(user_email)
             flash('All marked read')
         return redirect(url_for('ui_notifications'))
     notifications = get_notifications(user_email)
     return render_template('notifications.html', notifications=notifications, user_email=user_email)
 
+# each handler is one unit of work: its task/user writes are committed together when it returns
+def transactional_view(view):
+    # a view re-run after a write conflict must not repeat the flashes of the failed attempt
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        flashes = list(session.get('_flashes', []))
+        def reset_flashes():
+            session['_flashes'] = list(flashes)
+        return run_transaction(view, *args, on_retry=reset_flashes, **kwargs)
+    return wrapper
+
+for endpoint, view in list(app.view_functions.items()):
+    if endpoint != 'static':
+        app.view_functions[endpoint] = transactional_view(view)
+
 if __name__ == '__main__':
     os.makedirs('data', exist_ok=True)
     if not os.path.exists(USERS_FILE):
@@ -457,4 +693,8 @@ if __name__ == '__main__':
         with open('data/session.json', 'w') as f:
             import json
             json.dump({'current_email': None}, f)
+    # debug mode re-runs this module in a reloader child that serves the requests; start there
+    # without waiting for the first request so due transitions are not held back
+    if JOBS_ENABLED and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_jobs()
     app.run(debug=True, port=5000)
@@ -0,0 +1,2 @@
+"""Benchmarks: synthetic datasets (dataset.py), the operation timing harness (harness.py),
+the concurrent API load test (loadtest.py) and the SHARETASK_FORMAT comparison (storage_formats.py)."""
@@ -0,0 +1,120 @@
+"""Seeded synthetic users and tasks, written to data/ through the configured SHARETASK_STORAGE.
+
+Usage: python3 -m benchmarks.dataset [--users N] [--tasks-per-user N] [--fanout N] [--comments N]
+                                     [--history N] [--live FRACTION] [--seed N] [--dir DIR]
+
+Writes into DIR/data (default: the current directory), which must not hold data already.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils import USERS_FILE, TASKS_FILE, DB_FILE, TASK_LOGS_DIR, JsonStorage, SqliteStorage, get_storage, save_data, split_task_logs, hash_password
+from src.task import set_user_status, derive_master_status
+
+PASSWORD = 'Benchmark1!pass'
+FREQUENCIES = ('one-time', 'daily', 'weekly', 'monthly')
+STATUSES = ('To Do', 'In Progress', 'Done')
+SQLITE_CHUNK = 10000
+
+def user_email(i):
+    return f"user{i}@bench.example.com"
+
+def make_users(count):
+    password_hash = hash_password(PASSWORD)
+    return {user_email(i): {'name': f"User {i}", 'password_hash': password_hash, 'registered_at': '2024-01-01 09:00:00', 'version': 1}
+            for i in range(count)}
+
+def make_task(rnd, tid, owner_index, users, fanout, comments, history, live):
+    owner = user_email(owner_index)
+    created = datetime(2024, 1, 1) + timedelta(minutes=int(tid))
+    category = 'assignment' if rnd.random() < 0.1 else 'sharing'
+    task = {
+        'owner': owner,
+        'title': f"Task {tid}",
+        'description': f"Synthetic task {tid} of {owner}",
+        'frequency': rnd.choice(FREQUENCIES),
+        'due_date': (datetime.now().date() + timedelta(days=rnd.randint(-60, 60))).isoformat(),
+        'created_at': str(created),
+        'shared_with': [],
+        'statuses': {},
+        'task_type': 'live' if rnd.random() < live else 'normal',
+        'category': category,
+        'version': 1,
+    }
+    set_user_status(task, owner, rnd.choice(STATUSES))
+    others = [user_email(i) for i in rnd.sample(range(users), min(users, fanout + 1)) if i != owner_index]
+    for email in others[:1 if category == 'assignment' else fanout]:
+        task['shared_with'].append(email)
+        set_user_status(task, email, 'Pending' if rnd.random() < 0.2 else rnd.choice(STATUSES))
+    derive_master_status(task)
+    if task['task_type'] == 'live':
+        task.update({'live_status': 'not_started', 'start_time': None, 'duration': None, 'participants': {}, 'live_mode': 'dynamic'})
+    members = [owner] + task['shared_with']
+    task['comments'] = [{'user': rnd.choice(members), 'comment': f"Comment {k} on task {tid}", 'timestamp': str(created + timedelta(hours=k))}
+                        for k in range(comments)]
+    task['history'] = [{'action': 'created', 'user': owner, 'timestamp': str(created), 'details': f"Category: {category}, type: {task['task_type']}"}][:history]
+    task['history'] += [{'action': 'status_update', 'user': rnd.choice(members), 'timestamp': str(created + timedelta(hours=k)), 'details': 'to In Progress'}
+                        for k in range(1, history)]
+    return task
+
+def generate(users=100, tasks_per_user=10, fanout=2, comments=2, history=3, live=0.1, seed=1):
+    """Write a dataset of users * tasks_per_user tasks to data/; returns (users, tasks) written."""
+    rnd = random.Random(seed)
+    os.makedirs('data', exist_ok=True)
+    user_records = make_users(users)
+    storage = get_storage()
+    if isinstance(storage, SqliteStorage):
+        storage.commit({}, user_records)
+        tasks, logs = {}, []
+        for n in range(users * tasks_per_user):
+            tid = str(n + 1)
+            task = make_task(rnd, tid, n % users, users, fanout, comments, history, live)
+            logs += [(tid, field, entries) for field, entries in split_task_logs(task).items()]
+            tasks[tid] = task
+            if len(tasks) == SQLITE_CHUNK:
+                storage.commit(tasks, {}, logs=logs)
+                tasks, logs = {}, []
+        if tasks:
+            storage.commit(tasks, {}, logs=logs)
+        return users, users * tasks_per_user
+    # json and journal: one tasks.json snapshot plus the per-task comment/history logs
+    tasks = {}
+    files = JsonStorage()
+    os.makedirs(TASK_LOGS_DIR, exist_ok=True)
+    for n in range(users * tasks_per_user):
+        tid = str(n + 1)
+        task = make_task(rnd, tid, n % users, users, fanout, comments, history, live)
+        for field, entries in split_task_logs(task).items():
+            with open(files._log_path(tid, field), 'wb') as f:
+                f.write(b''.join(json.dumps(entry, separators=(',', ':')).encode() + b'\n' for entry in entries))
+        tasks[tid] = task
+    save_data(USERS_FILE, user_records)
+    save_data(TASKS_FILE, tasks)
+    return users, len(tasks)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic ShareTask dataset in data/')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--tasks-per-user', type=int, default=10)
+    parser.add_argument('--fanout', type=int, default=2, help='Users each task is shared with')
+    parser.add_argument('--comments', type=int, default=2, help='Comments per task')
+    parser.add_argument('--history', type=int, default=3, help='History entries per task')
+    parser.add_argument('--live', type=float, default=0.1, help='Fraction of live tasks')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', default='.')
+    args = parser.parse_args(argv)
+    os.chdir(args.dir)
+    if os.path.exists(USERS_FILE) or os.path.exists(TASKS_FILE) or os.path.exists(DB_FILE):
+        print(f"ERROR: {os.path.abspath('data')} already holds data")
+        sys.exit(1)
+    users, tasks = generate(args.users, args.tasks_per_user, args.fanout, args.comments, args.history, args.live, args.seed)
+    print(f"Generated {users} users and {tasks} tasks in {os.path.abspath('data')} (password: {PASSWORD})")
+
+if __name__ == '__main__':
+    main()
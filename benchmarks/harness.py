@@ -0,0 +1,186 @@
+"""Time src.task / src.user operations against generated datasets of increasing size.
+
+Usage:
+  python3 -m benchmarks.harness run [--sizes 1000 10000 100000 1000000] [--repeat 20] [--output results.json]
+                                    [--tasks-per-user N] [--fanout N] [--comments N] [--history N] [--live F] [--seed N]
+  python3 -m benchmarks.harness compare BASELINE.json CANDIDATE.json [--threshold 0.2] [--min-delta-ms 0.05]
+
+Each size runs in its own process and scratch directory, with the storage backend and
+data format taken from SHARETASK_STORAGE / SHARETASK_FORMAT. Every operation runs as one
+unit of work like a CLI command or request; the first call (cold caches and indexes) is
+reported apart from the repeated ones. compare exits 1 when any operation's median got
+slower by more than the threshold (and by more than min-delta-ms, so timer noise on
+sub-millisecond operations is not flagged).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [1000, 10000, 100000, 1000000]
+OPERATIONS = ('create_task', 'share_task', 'update_task_status', 'list_tasks', 'generate_report', 'add_notification', 'login_user')
+
+def _summary(first, samples, rejected):
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'rejected': rejected,
+        'first_ms': round(first * 1000, 3),
+        'min_ms': round(samples[0] * 1000, 3),
+        'median_ms': round(statistics.median(samples) * 1000, 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+    }
+
+def measure(size, repeat, tasks_per_user, fanout, comments, history, live, seed):
+    """Generate a dataset of size tasks in the current directory and time each operation on it."""
+    sys.path.insert(0, ROOT)
+    from benchmarks.dataset import generate, user_email, PASSWORD
+    from src.utils import run_transaction, TASKS_FILE, DB_FILE
+    from src.task import create_task, share_task, update_task_status, list_tasks, generate_report
+    from src.user import add_notification, login_user
+
+    users = max(2, -(-size // tasks_per_user))
+    start = time.perf_counter()
+    generate(users, -(-size // users), fanout, comments, history, live, seed)
+    generated = time.perf_counter() - start
+    rnd = random.Random(seed)
+    created = iter(range(10 ** 9))
+
+    def pick_task():
+        # each user i owns tasks i+1, i+1+users, ...
+        owner = rnd.randrange(users)
+        return str(owner + 1), user_email(owner)
+
+    def create():
+        email = user_email(rnd.randrange(users))
+        n = next(created)
+        return create_task(f"Bench {n}", f"Benchmark task {n}", 'weekly', '2030-01-01', user_email=email)
+
+    def share():
+        tid, owner = pick_task()
+        return share_task(tid, user_email(rnd.randrange(users)), user_email=owner)
+
+    def update():
+        tid, owner = pick_task()
+        return update_task_status(tid, rnd.choice(['To Do', 'In Progress', 'Done']), user_email=owner)
+
+    calls = {
+        'create_task': create,
+        'share_task': share,
+        'update_task_status': update,
+        'list_tasks': lambda: list_tasks(user_email=user_email(rnd.randrange(users))),
+        'generate_report': lambda: generate_report(user_email(rnd.randrange(users))),
+        'add_notification': lambda: add_notification(user_email(rnd.randrange(users)), 'Benchmark notification', 'info'),
+        'login_user': lambda: login_user(user_email(rnd.randrange(users)), PASSWORD, set_session=False),
+    }
+    results = {}
+    for name in OPERATIONS:
+        timings, rejected = [], 0
+        for _ in range(repeat + 1):
+            start = time.perf_counter()
+            outcome = run_transaction(calls[name])
+            timings.append(time.perf_counter() - start)
+            # refused by a business rule (e.g. reassigning an assignment in progress), still timed
+            rejected += not outcome[0]
+        results[name] = _summary(timings[0], timings[1:], rejected)
+    data_file = DB_FILE if os.path.exists(DB_FILE) else TASKS_FILE
+    return {'tasks': users * -(-size // users), 'users': users, 'generate_s': round(generated, 3),
+            'data_bytes': os.path.getsize(data_file), 'operations': results}
+
+def run(args):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    report = {
+        'meta': {
+            'started_at': str(datetime.now()),
+            'storage': os.environ.get('SHARETASK_STORAGE', 'json'),
+            'format': os.environ.get('SHARETASK_FORMAT', 'pretty'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip(),
+            'params': {k: getattr(args, k) for k in ('repeat', 'tasks_per_user', 'fanout', 'comments', 'history', 'live', 'seed')},
+        },
+        'results': {},
+    }
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory(prefix='sharetask-bench-') as workdir:
+            worker = [sys.executable, '-m', 'benchmarks.harness', 'worker', '--size', str(size)]
+            for key, value in report['meta']['params'].items():
+                worker += [f"--{key.replace('_', '-')}", str(value)]
+            proc = subprocess.run(worker, cwd=workdir, env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"ERROR: size {size} failed:\n{proc.stderr}", file=sys.stderr)
+            sys.exit(1)
+        result = json.loads(proc.stdout.splitlines()[-1])
+        report['results'][str(size)] = result
+        print(f"{size:>9} tasks  generated in {result['generate_s']:.1f}s")
+        for name, stats in result['operations'].items():
+            print(f"  {name:<20} median {stats['median_ms']:>10.3f} ms  p95 {stats['p95_ms']:>10.3f} ms  first {stats['first_ms']:>10.3f} ms")
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+def compare(baseline, candidate, threshold, min_delta_ms=0.05):
+    """[(size, operation, baseline ms, candidate ms, change, regressed)] for the medians both runs have."""
+    rows = []
+    for size, result in candidate['results'].items():
+        before = baseline['results'].get(size, {}).get('operations', {})
+        for name, stats in result['operations'].items():
+            if name not in before:
+                continue
+            old, new = before[name]['median_ms'], stats['median_ms']
+            change = (new - old) / old if old else 0.0
+            rows.append((size, name, old, new, change, change > threshold and new - old > min_delta_ms))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ShareTask operation benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name in ('run', 'worker'):
+        p = sub.add_parser(name)
+        if name == 'run':
+            p.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+            p.add_argument('--output', default=f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+        else:
+            p.add_argument('--size', type=int, required=True)
+        p.add_argument('--repeat', type=int, default=20)
+        p.add_argument('--tasks-per-user', type=int, default=10)
+        p.add_argument('--fanout', type=int, default=2)
+        p.add_argument('--comments', type=int, default=2)
+        p.add_argument('--history', type=int, default=3)
+        p.add_argument('--live', type=float, default=0.1)
+        p.add_argument('--seed', type=int, default=1)
+    cmp = sub.add_parser('compare')
+    cmp.add_argument('baseline')
+    cmp.add_argument('candidate')
+    cmp.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown of a median, as a fraction (default 0.2)')
+    cmp.add_argument('--min-delta-ms', type=float, default=0.05, help='Slowdowns smaller than this are never flagged')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'worker':
+        result = measure(args.size, args.repeat, args.tasks_per_user, args.fanout, args.comments, args.history, args.live, args.seed)
+        print(json.dumps(result))
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.candidate) as f:
+            candidate = json.load(f)
+        rows = compare(baseline, candidate, args.threshold, args.min_delta_ms)
+        print(f"{'tasks':>9} {'operation':<20} {'baseline ms':>12} {'candidate ms':>12} {'change':>8}")
+        for size, name, old, new, change, regressed in rows:
+            print(f"{size:>9} {name:<20} {old:>12.3f} {new:>12.3f} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+        regressions = sum(row[5] for row in rows)
+        print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
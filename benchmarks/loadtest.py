@@ -0,0 +1,497 @@
+"""Concurrent load test of the /api endpoints: throughput, tail latency and end-state invariants.
+
+Usage:
+  python3 -m benchmarks.loadtest [--clients 8] [--servers 1] [--duration 10]
+                                 [--mix status=40,list=15,get=10,comment=10,create=10,share=8,stats=5,report=1,register=1]
+                                 [--users N] [--tasks-per-user 10] [--fanout 2] [--seed 1] [--dir DIR] [--output results.json]
+
+A seeded dataset (benchmarks.dataset, SHARETASK_STORAGE / SHARETASK_FORMAT apply) is written
+to a scratch directory, or DIR, which is kept. --servers N starts N server processes on local
+ports over that one data directory (requests are spread over them); --servers 0 drives the
+Flask test client in this process instead. Each client thread logs in as its own generated user
+and runs the weighted mix for --duration seconds. Background jobs are not started (SHARETASK_JOBS=0),
+so every notification comes from a share the test made.
+
+Afterwards the data is read back and checked: the files parse, every acknowledged status update
+and comment is there, acknowledged creates and registrations exist exactly once with distinct
+task ids, and every user has exactly the notifications its acknowledged shares sent. Requests
+that failed without an answer (5xx, dropped connection) may or may not have been applied, so
+the records they touched are left out of the checks. Exits 1 when an invariant is broken.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = 'status=40,list=15,get=10,comment=10,create=10,share=8,stats=5,report=1,register=1'
+STATUSES = ('To Do', 'In Progress', 'Done')
+SERVER_START_TIMEOUT = 30
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{name}' (one of: {', '.join(OPERATIONS)})")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError('The mix needs a positive weight')
+    return mix
+
+def percentile(samples, p):
+    """Nearest-rank percentile of sorted samples."""
+    return samples[max(0, -(-len(samples) * p // 100) - 1)]
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {'p50_ms': round(percentile(samples, 50) * 1000, 3), 'p95_ms': round(percentile(samples, 95) * 1000, 3),
+            'p99_ms': round(percentile(samples, 99) * 1000, 3), 'max_ms': round(samples[-1] * 1000, 3),
+            'mean_ms': round(statistics.fmean(samples) * 1000, 3)}
+
+class HttpTransport:
+    """Keep-alive connection to one server; a dropped connection is reopened for the next request."""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.conn.request(method, path, payload, headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            raise
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_data()
+
+class Client(threading.Thread):
+    """One logged-in user running the mix; keeps what the server acknowledged for the checks."""
+
+    def __init__(self, index, transport, state, mix, seed, barrier, deadline):
+        super().__init__(daemon=True)
+        self.index = index
+        self.transport = transport
+        self.state = state
+        self.email = state['emails'][index]
+        self.rnd = random.Random(seed * 1000 + index)
+        self.ops, self.weights = list(mix), list(mix.values())
+        self.barrier = barrier
+        self.deadline = deadline
+        self.headers = {}
+        self.samples = {name: [] for name in OPERATIONS}
+        self.outcomes = {name: Counter() for name in OPERATIONS}
+        self.members = state['members'].get(self.email, [])
+        self.shared = {tid: set(shared) for tid, shared in state['owned'].get(self.email, {}).items()}
+        self.statuses = {}
+        self.comments = Counter()
+        self.notified = Counter()
+        self.created = []
+        self.registered = []
+        self.uncertain = set()
+        self.failure = None
+
+    def call(self, name, method, path, body=None):
+        start = time.perf_counter()
+        try:
+            status, data = self.transport.request(method, path, body, self.headers)
+        except (OSError, http.client.HTTPException):
+            status, data = None, b''
+        self.samples[name].append(time.perf_counter() - start)
+        outcome = 'error' if status is None or status >= 500 else 'rejected' if status >= 400 else 'ok'
+        self.outcomes[name][outcome] += 1
+        return outcome, data
+
+    def run(self):
+        try:
+            status, data = self.transport.request('POST', '/api/login', {'email': self.email, 'password': self.state['password']})
+            if status != 200:
+                raise RuntimeError(f"login of {self.email} failed with {status}: {data[:200]!r}")
+            self.headers = {'Authorization': 'Bearer ' + json.loads(data)['token']}
+        except Exception as e:
+            self.failure = e
+            self.barrier.abort()
+            return
+        try:
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            return
+        n = 0
+        while time.monotonic() < self.deadline[0]:
+            name = self.rnd.choices(self.ops, self.weights)[0]
+            getattr(self, 'op_' + name)(n)
+            n += 1
+
+    def op_status(self, n):
+        if not self.members:
+            return self.op_list(n)
+        tid, status = self.rnd.choice(self.members), self.rnd.choice(STATUSES)
+        outcome, _ = self.call('status', 'PUT', f"/api/tasks/{tid}/status", {'status': status})
+        if outcome == 'ok':
+            self.statuses[tid] = status
+        elif outcome == 'error':
+            self.uncertain.add(('status', tid, self.email))
+
+    def op_comment(self, n):
+        if not self.members:
+            return self.op_list(n)
+        tid = self.rnd.choice(self.members)
+        outcome, _ = self.call('comment', 'POST', f"/api/tasks/{tid}/comment", {'comment': f"Load comment {self.index}-{n}"})
+        if outcome == 'ok':
+            self.comments[tid] += 1
+        elif outcome == 'error':
+            self.uncertain.add(('comment', tid))
+
+    def op_share(self, n):
+        if not self.shared:
+            return self.op_list(n)
+        tid = self.rnd.choice(sorted(self.shared))
+        target = self.rnd.choice(self.state['emails'])
+        if target == self.email:
+            return self.op_list(n)
+        outcome, _ = self.call('share', 'POST', f"/api/tasks/{tid}/share", {'email': target})
+        if outcome == 'ok' and target not in self.shared[tid]:
+            # re-sharing with someone already on the task succeeds without a notification
+            self.shared[tid].add(target)
+            self.notified[target] += 1
+        elif outcome == 'error':
+            self.uncertain.add(('notify', target))
+            self.shared[tid].add(target)
+
+    def op_create(self, n):
+        title = f"Load {self.index}-{n}"
+        outcome, _ = self.call('create', 'POST', '/api/tasks', {'title': title, 'description': f"Load test task {self.index}-{n}",
+                                                                'frequency': 'weekly', 'due_date': '2030-01-01'})
+        if outcome == 'ok':
+            self.created.append((self.email, title))
+        elif outcome == 'error':
+            self.uncertain.add(('create', self.email, title))
+
+    def op_register(self, n):
+        email = f"load{self.index}-{n}@load.example.com"
+        outcome, _ = self.call('register', 'POST', '/api/register', {'email': email, 'password': self.state['password'], 'name': f"Load {self.index}-{n}"})
+        if outcome == 'ok':
+            self.registered.append(email)
+        elif outcome == 'error':
+            self.uncertain.add(('register', email))
+
+    def op_list(self, n):
+        self.call('list', 'GET', '/api/tasks?limit=50')
+
+    def op_get(self, n):
+        if not self.members:
+            return self.op_list(n)
+        self.call('get', 'GET', f"/api/tasks/{self.rnd.choice(self.members)}")
+
+    def op_stats(self, n):
+        self.call('stats', 'GET', '/api/stats')
+
+    def op_report(self, n):
+        self.call('report', 'POST', '/api/report?format=ndjson')
+
+OPERATIONS = tuple(name[3:] for name in vars(Client) if name.startswith('op_'))
+
+def initial_state(users):
+    """Emails, passwords and, per user, the tasks it can update and the sharing tasks it owns."""
+    from benchmarks.dataset import user_email, PASSWORD
+    from src.utils import iter_tasks, TASK_LOG_COUNTS
+    state = {'emails': [user_email(i) for i in range(users)], 'password': PASSWORD,
+             'members': {}, 'owned': {}, 'statuses': {}, 'comments': {}, 'tasks': 0}
+    for tid, task in iter_tasks():
+        state['tasks'] += 1
+        state['comments'][tid] = task.get(TASK_LOG_COUNTS['comments'], 0)
+        if task.get('category') != 'sharing':
+            # assignment rules refuse or undo some status updates and shares
+            continue
+        state['owned'].setdefault(task['owner'], {})[tid] = list(task['shared_with'])
+        for email, status in task['statuses'].items():
+            state['statuses'][(tid, email)] = status
+            if status != 'Pending':
+                state['members'].setdefault(email, []).append(tid)
+    return state
+
+def check_files():
+    """Problems found parsing the data files of the configured storage."""
+    from src.utils import USERS_FILE, TASKS_FILE, TASKS_LOG, DB_FILE, NOTIFICATIONS_DIR, decode_data, BINARY_MAGIC
+    import sqlite3
+    problems = []
+    if os.path.exists(DB_FILE):
+        conn = sqlite3.connect(DB_FILE)
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        conn.close()
+        if result != 'ok':
+            problems.append(f"{DB_FILE}: integrity_check: {result}")
+        return problems
+
+    def no_duplicates(pairs):
+        keys = [k for k, _ in pairs]
+        if len(keys) != len(set(keys)):
+            raise ValueError(f"duplicate keys {sorted(k for k, c in Counter(keys).items() if c > 1)[:5]}")
+        return dict(pairs)
+
+    paths = [USERS_FILE, TASKS_FILE]
+    if os.path.isdir(NOTIFICATIONS_DIR):
+        paths += [os.path.join(NOTIFICATIONS_DIR, name) for name in sorted(os.listdir(NOTIFICATIONS_DIR))]
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            payload = f.read()
+        try:
+            if payload.startswith(BINARY_MAGIC):
+                decode_data(payload)
+            else:
+                json.loads(payload, object_pairs_hook=no_duplicates)
+        except Exception as e:
+            problems.append(f"{path}: {e}")
+    if os.path.exists(TASKS_LOG):
+        with open(TASKS_LOG, 'rb') as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    if line.strip():
+                        json.loads(line)
+                except ValueError as e:
+                    problems.append(f"{TASKS_LOG} line {number}: {e}")
+    return problems
+
+def check_invariants(state, clients):
+    """{invariant: (records checked, [problems])} for the final data against what clients were told."""
+    from src.utils import iter_tasks, load_task, load_user, load_mailbox, task_log, TASK_LOG_COUNTS
+    uncertain = set().union(*(c.uncertain for c in clients))
+    results = {'files': (1, check_files())}
+
+    problems, checked = [], 0
+    for c in clients:
+        for tid, status in c.statuses.items():
+            if ('status', tid, c.email) in uncertain:
+                continue
+            checked += 1
+            actual = (load_task(tid) or {}).get('statuses', {}).get(c.email)
+            if actual != status:
+                problems.append(f"task {tid}: {c.email} was told '{status}', stored '{actual}'")
+    results['status_updates'] = (checked, problems)
+
+    problems, comments = [], Counter()
+    for c in clients:
+        comments.update(c.comments)
+    comments = {tid: n for tid, n in comments.items() if ('comment', tid) not in uncertain}
+    for tid, added in comments.items():
+        task = load_task(tid) or {}
+        expected = state['comments'].get(tid, 0) + added
+        count, entries = task.get(TASK_LOG_COUNTS['comments'], 0), len(task_log(tid, task, 'comments'))
+        if count != expected or entries != expected:
+            problems.append(f"task {tid}: {expected} comments acknowledged, count {count}, log {entries}")
+    results['comments'] = (len(comments), problems)
+
+    problems, titles, ids = [], Counter(), []
+    for tid, task in iter_tasks():
+        ids.append(tid)
+        titles[(task['owner'], task['title'])] += 1
+    if len(ids) != len(set(ids)):
+        problems.append(f"duplicate task ids: {sorted(t for t, n in Counter(ids).items() if n > 1)[:10]}")
+    created = [key for c in clients for key in c.created]
+    for owner, title in created:
+        if titles[(owner, title)] != 1:
+            problems.append(f"created task '{title}' of {owner} stored {titles[(owner, title)]} times")
+    maybe = sum(1 for key in uncertain if key[0] == 'create')
+    if not state['tasks'] + len(created) <= len(ids) <= state['tasks'] + len(created) + maybe:
+        problems.append(f"{len(ids)} tasks stored, expected {state['tasks']} + {len(created)} created")
+    results['created_tasks'] = (len(created), problems)
+
+    registered = [email for c in clients for email in c.registered]
+    results['registered_users'] = (len(registered), [f"registered user {email} missing" for email in registered if load_user(email) is None])
+
+    problems, notified = [], Counter()
+    for c in clients:
+        notified.update(c.notified)
+    emails = [email for email in state['emails'] if ('notify', email) not in uncertain]
+    for email in emails:
+        # seq numbers every notification a mailbox ever received, including ones rotated out
+        received = (load_mailbox(email) or {}).get('seq', 0)
+        if received != notified[email]:
+            problems.append(f"{email}: {notified[email]} notifications sent, mailbox received {received}")
+    results['notifications'] = (len(emails), problems)
+    return results
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_servers(count, env):
+    servers = []
+    for _ in range(count):
+        port = free_port()
+        with open(f"data/loadtest-server-{port}.log", 'w') as log:
+            proc = subprocess.Popen([sys.executable, '-m', 'benchmarks.loadtest', 'serve', '--port', str(port)], env=env,
+                                    stdout=subprocess.DEVNULL, stderr=log)
+        servers.append((port, proc))
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    for port, proc in servers:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server on port {port} exited with {proc.returncode}, see data/loadtest-server-{port}.log")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"server on port {port} did not start")
+                time.sleep(0.05)
+    return servers
+
+def stop_servers(servers):
+    for _, proc in servers:
+        proc.terminate()
+    for _, proc in servers:
+        proc.wait()
+
+def serve(port):
+    import logging
+    from werkzeug.serving import make_server
+    from app import app
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+def run(args):
+    """Generate the data, run the clients for args.duration and check the result; returns the report dict."""
+    from benchmarks.dataset import generate
+    started_at = str(datetime.now())
+    users = max(args.users, args.clients)
+    generate(users, args.tasks_per_user, args.fanout, 2, 3, 0.1, args.seed)
+    state = initial_state(users)
+    mix = parse_mix(args.mix)
+    servers = []
+    if args.servers:
+        servers = start_servers(args.servers, dict(os.environ, PYTHONPATH=ROOT, SHARETASK_JOBS='0'))
+        transports = [HttpTransport(servers[i % len(servers)][0]) for i in range(args.clients)]
+    else:
+        os.environ['SHARETASK_JOBS'] = '0'
+        from app import app
+        transports = [TestClientTransport(app) for _ in range(args.clients)]
+    deadline = [float('inf')]
+    barrier = threading.Barrier(args.clients + 1)
+    clients = [Client(i, transports[i], state, mix, args.seed, barrier, deadline) for i in range(args.clients)]
+    try:
+        for c in clients:
+            c.start()
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            raise RuntimeError(f"client setup failed: {next(c.failure for c in clients if c.failure)}")
+        start = time.monotonic()
+        deadline[0] = start + args.duration
+        for c in clients:
+            c.join()
+        elapsed = time.monotonic() - start
+    finally:
+        stop_servers(servers)
+
+    operations = {}
+    for name in OPERATIONS:
+        outcomes = sum((c.outcomes[name] for c in clients), Counter())
+        if outcomes:
+            operations[name] = dict({k: outcomes[k] for k in ('ok', 'rejected', 'error')}, **latency_summary([s for c in clients for s in c.samples[name]]))
+    samples = [s for c in clients for name in OPERATIONS for s in c.samples[name]]
+    total = dict({k: sum(op[k] for op in operations.values()) for k in ('ok', 'rejected', 'error')}, **latency_summary(samples))
+    invariants = check_invariants(state, clients)
+    return {
+        'meta': {'started_at': started_at, 'storage': os.environ.get('SHARETASK_STORAGE', 'json'),
+                 'format': os.environ.get('SHARETASK_FORMAT', 'pretty'), 'clients': args.clients, 'servers': args.servers,
+                 'users': users, 'tasks': state['tasks'], 'mix': mix, 'seed': args.seed},
+        'duration_s': round(elapsed, 3),
+        'requests': len(samples),
+        'requests_per_s': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        'operations': operations,
+        'total': total,
+        'invariants': {name: {'checked': checked, 'problems': problems} for name, (checked, problems) in invariants.items()},
+    }
+
+def print_report(report):
+    meta = report['meta']
+    servers = f"{meta['servers']} server process(es)" if meta['servers'] else 'in-process test client'
+    print(f"{meta['clients']} clients, {servers}, {meta['storage']} storage, "
+          f"{meta['users']} users, {meta['tasks']} tasks, {report['duration_s']:.1f}s")
+    print(f"{report['requests']} requests, {report['requests_per_s']:.1f} req/s")
+    print(f"  {'operation':<10} {'ok':>7} {'rejected':>8} {'error':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, op in list(report['operations'].items()) + [('all', report['total'])]:
+        if 'p50_ms' in op:
+            print(f"  {name:<10} {op['ok']:>7} {op['rejected']:>8} {op['error']:>6} {op['p50_ms']:>9.2f} {op['p95_ms']:>9.2f} {op['p99_ms']:>9.2f} {op['max_ms']:>9.2f}")
+    print('Invariants:')
+    for name, result in report['invariants'].items():
+        verdict = f"{len(result['problems'])} FAILED" if result['problems'] else 'OK'
+        print(f"  {name:<17} {result['checked']:>7} checked  {verdict}")
+        for problem in result['problems'][:10]:
+            print(f"    {problem}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ShareTask concurrent API load test')
+    sub = parser.add_subparsers(dest='command')
+    srv = sub.add_parser('serve')
+    srv.add_argument('--port', type=int, required=True)
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent client threads, one user each')
+    parser.add_argument('--servers', type=int, default=1, help='Server processes over the same data (0: test client in this process)')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run the mix')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Operation weights (default {DEFAULT_MIX})")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--tasks-per-user', type=int, default=10)
+    parser.add_argument('--fanout', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', help='Run in DIR (must not hold data) and keep it')
+    parser.add_argument('--output', help='Write the results as JSON')
+    args = parser.parse_args(argv)
+    sys.path.insert(0, ROOT)
+    if args.command == 'serve':
+        serve(args.port)
+        return
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    output = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory(prefix='sharetask-load-') as scratch:
+        workdir = args.dir or scratch
+        os.makedirs(workdir, exist_ok=True)
+        os.chdir(workdir)
+        if os.path.exists('data'):
+            print(f"ERROR: {os.path.abspath('data')} already exists")
+            sys.exit(1)
+        report = run(args)
+        os.chdir(ROOT)
+    print_report(report)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+    sys.exit(1 if any(result['problems'] for result in report['invariants'].values()) else 0)
+
+if __name__ == '__main__':
+    main()
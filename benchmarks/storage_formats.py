@@ -0,0 +1,50 @@
+"""Load/save time and file size of each SHARETASK_FORMAT for a tasks file of benchmarks.dataset records.
+
+Usage: python3 benchmarks/storage_formats.py [N ...]   (default: 10000 100000 1000000)
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils import DATA_FORMATS, encode_data, decode_data, write_file_atomic, split_task_logs
+from benchmarks.dataset import make_task
+
+def make_tasks(n):
+    """n records shaped as the app stores them in tasks.json: benchmarks.dataset tasks with
+    comments and history moved off to the per-task logs."""
+    rnd = random.Random(1)
+    users = max(n // 10, 2)
+    tasks = {}
+    for i in range(n):
+        tid = str(i + 1)
+        task = make_task(rnd, tid, i % users, users, 2, 2, 3, 0.1)
+        split_task_logs(task)
+        tasks[tid] = task
+    return tasks
+
+def bench(tasks, fmt, path):
+    start = time.perf_counter()
+    write_file_atomic(path, encode_data(tasks, fmt))
+    save = time.perf_counter() - start
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        loaded = decode_data(f.read())
+    load = time.perf_counter() - start
+    assert len(loaded) == len(tasks)
+    return save, load, os.path.getsize(path)
+
+def main(sizes):
+    print(f"{'tasks':>9} {'format':>8} {'save s':>8} {'load s':>8} {'size MB':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            tasks = make_tasks(n)
+            for fmt in DATA_FORMATS:
+                save, load, size = bench(tasks, fmt, os.path.join(tmp, f"tasks.{fmt}"))
+                print(f"{n:>9} {fmt:>8} {save:>8.3f} {load:>8.3f} {size / 1e6:>9.1f}")
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
@@ -1,10 +1,29 @@
 import argparse
+import atexit
+import json
 import sys
 from src.user import register_user, login_user, get_notifications
-from src.task import create_task, share_task, update_task_status, list_tasks, revoke_share, add_comment, generate_report, start_live_task, stop_live_task, checkin_live_task, get_live_status, accept_shared_task, reject_shared_task
+from src.utils import DB_FILE, migrate_json_to_sqlite, compact_journal, split_inline_task_logs, run_transaction, ConflictError
+from src.scheduler import lifecycle, due_notifier, start_jobs
+from src.recurrence import OCCURRENCE_WINDOW_DAYS
+from src.metrics import metrics
+from src.task import create_task, share_task, update_task_status, list_tasks, revoke_share, add_comment, start_live_task, stop_live_task, checkin_live_task, get_live_status, accept_shared_task, reject_shared_task, iter_report, report_cache_stats, REPORT_FORMATS, apply_batch, BATCH_OPERATIONS, get_stats, list_occurrences, update_occurrence_status
+
+def unit_of_work(fn, *args, **kwargs):
+    """Run a command's data operation as one unit of work and return its result once committed.
+
+    It is re-run if another writer changed the same records meanwhile, so the command
+    prints only after this returns; a conflict outlasting the retries is an error.
+    """
+    try:
+        return run_transaction(fn, *args, **kwargs)
+    except ConflictError as e:
+        print(f"ERROR: {e}, please retry")
+        sys.exit(1)
 
 def main():
     parser = argparse.ArgumentParser(description='Shareable Task Tracker CLI')
+    parser.add_argument('--stats', action='store_true', help='Print storage I/O calls, bytes and time of the command to stderr')
     subparsers = parser.add_subparsers(dest='command')
 
     # Register
@@ -53,6 +72,15 @@ def main():
     update.add_argument('--task-id', required=True)
     update.add_argument('--status', required=True, choices=['To Do', 'In Progress', 'Done'])
 
+    # Recurring tasks: occurrences follow from the due date and frequency
+    occurrences = subparsers.add_parser('occurrences', help='List occurrences of your tasks in a window (recurring tasks expanded)')
+    occurrences.add_argument('--start', help='First day YYYY-MM-DD (default: today)')
+    occurrences.add_argument('--days', type=int, default=OCCURRENCE_WINDOW_DAYS)
+    update_occ = subparsers.add_parser('update-occurrence', help='Update your status for one occurrence of a recurring task')
+    update_occ.add_argument('--task-id', required=True)
+    update_occ.add_argument('--date', required=True, help='Occurrence date YYYY-MM-DD')
+    update_occ.add_argument('--status', required=True, choices=['To Do', 'In Progress', 'Done'])
+
     # Live task commands
     start_live = subparsers.add_parser('start-live-task', help='Start live task (owner only, optional duration mins)')
     start_live.add_argument('--task-id', required=True)
@@ -67,104 +95,151 @@ def main():
     live_status = subparsers.add_parser('live-status', help='Check live task status (joined/in/absent etc)')
     live_status.add_argument('--task-id', required=True)
 
+    # Lifecycle scheduler
+    sched = subparsers.add_parser('scheduler', help='Run live-task auto start/end and due-date notifications (until interrupted)')
+    sched.add_argument('--once', action='store_true', help='Apply what is due now and exit')
+
+    # Batch of status/share/revoke/comment/accept/reject operations, one write
+    batch = subparsers.add_parser('batch', help=f"Apply a JSON list of operations ({', '.join(BATCH_OPERATIONS)}) in one commit")
+    batch.add_argument('--file', required=True, help='JSON file with [{"op": "status", "task_id": "1", "status": "Done"}, ...], - for stdin')
+
     # Generate report
     report = subparsers.add_parser('generate-report', help='Generate task status report (simulates Monday email)')
+    report.add_argument('--format', choices=REPORT_FORMATS, default='text')
+    report.add_argument('--cache-stats', action='store_true', help='Print report fragment cache hits/misses to stderr')
 
     # List tasks
     lst = subparsers.add_parser('list-tasks', help='List all tasks (own created + shared with user)')
     lst.add_argument('--shared', action='store_true', help='Deprecated: now always included')
+    lst.add_argument('--window', type=int, help='Also show occurrences over the next N days')
+
+    # Task counts by master status, category and type
+    stats = subparsers.add_parser('stats', help='Show task counts by master status, category and type')
+    stats.add_argument('--all', action='store_true', help='Count all tasks instead of your own and shared ones')
+    stats.add_argument('--master-status', choices=['To Do', 'In Progress', 'Done'])
+    stats.add_argument('--category', choices=['sharing', 'assignment'])
+    stats.add_argument('--type', choices=['normal', 'live'])
 
     # Notifications (due dates, shares, rejections)
     notifs = subparsers.add_parser('notifications', help='View user notifications')
 
+    # Storage migration (data/*.json -> sqlite, then run with SHARETASK_STORAGE=sqlite)
+    migrate = subparsers.add_parser('migrate-storage', help='One-shot migration of data/*.json into the SQLite database')
+    migrate.add_argument('--db', default=DB_FILE, help=f'Target database file (default: {DB_FILE})')
+
+    # Journal compaction (SHARETASK_STORAGE=journal; normally runs in the background)
+    compact = subparsers.add_parser('compact-journal', help='Fold data/tasks.log into a new data/tasks.json snapshot')
+
+    # One-shot move of comments/history out of task records written before the per-task logs
+    split_logs = subparsers.add_parser('migrate-task-logs', help='Move comments/history stored inside tasks into the per-task logs')
+
     args = parser.parse_args()
+    if args.stats:
+        # printed at exit so early sys.exit() paths are counted too
+        stats = metrics.begin()
+        atexit.register(lambda: print(stats.format(), file=sys.stderr))
 
     if args.command == 'register':
-        success, msg = register_user(args.email, args.password, args.name)
+        success, msg = unit_of_work(register_user, args.email, args.password, args.name)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'login':
-        success, msg = login_user(args.email, args.password)
+        success, msg = unit_of_work(login_user, args.email, args.password)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'create-task':
-        success, msg = create_task(args.title, args.description, args.frequency, args.due_date, args.type, args.category)
+        success, msg = unit_of_work(create_task, args.title, args.description, args.frequency, args.due_date, args.type, args.category)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'share-task':
-        success, msg = share_task(args.task_id, args.email)
+        success, msg = unit_of_work(share_task, args.task_id, args.email)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'revoke-share':
-        success, msg = revoke_share(args.task_id, args.email)
+        success, msg = unit_of_work(revoke_share, args.task_id, args.email)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'accept-task':
-        success, msg = accept_shared_task(args.task_id)
+        success, msg = unit_of_work(accept_shared_task, args.task_id)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'reject-task':
-        success, msg = reject_shared_task(args.task_id)
+        success, msg = unit_of_work(reject_shared_task, args.task_id)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'add-comment':
-        success, msg = add_comment(args.task_id, args.comment)
+        success, msg = unit_of_work(add_comment, args.task_id, args.comment)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'update-status':
-        success, msg = update_task_status(args.task_id, args.status)
+        success, msg = unit_of_work(update_task_status, args.task_id, args.status)
+        if success:
+            print(msg)
+        else:
+            print(f"ERROR: {msg}")
+            sys.exit(1)
+    elif args.command == 'occurrences':
+        success, msg, items = unit_of_work(list_occurrences, start=args.start, days=args.days)
+        if not success:
+            print(f"ERROR: {msg}")
+            sys.exit(1)
+        print(msg)
+        for o in items:
+            print(f"{o['date']}  Task {o['task_id']}: {o['title']} [{o['master_status']}]")
+    elif args.command == 'update-occurrence':
+        success, msg = unit_of_work(update_occurrence_status, args.task_id, args.date, args.status)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'start-live-task':
-        success, msg = start_live_task(args.task_id, args.duration)
+        success, msg = unit_of_work(start_live_task, args.task_id, args.duration)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'stop-live-task':
-        success, msg = stop_live_task(args.task_id)
+        success, msg = unit_of_work(stop_live_task, args.task_id)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'checkin-live-task':
-        success, msg = checkin_live_task(args.task_id)
+        success, msg = unit_of_work(checkin_live_task, args.task_id)
         if success:
             print(msg)
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'live-status':
-        success, msg, status = get_live_status(args.task_id)
+        success, msg, status = unit_of_work(get_live_status, args.task_id)
         if success:
             print(msg)
             print(status)
@@ -172,7 +247,7 @@ def main():
             print(f"ERROR: {msg}")
             sys.exit(1)
     elif args.command == 'list-tasks':
-        success, msg, tasks = list_tasks(args.shared)
+        success, msg, tasks = unit_of_work(list_tasks, args.shared, window_days=args.window)
         if success:
             print(msg)
             for tid, task in tasks:
@@ -187,13 +262,23 @@ def main():
                 for user, stat in task['statuses'].items():
                     print(f"    {user}: {stat}")
                 print(f"  Shared with: {task.get('shared_with', [])}")
-                print("  Comments:")
-                for c in task.get('comments', []):
-                    print(f"    {c['user']} @ {c['timestamp']}: {c['comment']}")
+                print(f"  Comments: {task.get('comment_count', 0)}")
+                if task.get('occurrences'):
+                    print(f"  Occurrences: " + ', '.join(f"{o['date']} {o['master_status']}" for o in task['occurrences']))
                 print("---")
         else:
             print(f"ERROR: {msg}")
             sys.exit(1)
+    elif args.command == 'stats':
+        filters = {'master_status': args.master_status, 'category': args.category, 'task_type': args.type}
+        success, msg, counts = unit_of_work(get_stats, scope='all' if args.all else 'mine', filters=filters)
+        if not success:
+            print(f"ERROR: {msg}")
+            sys.exit(1)
+        print(msg)
+        print(f"Total: {counts.pop('total')}")
+        for field, values in counts.items():
+            print(f"{field}: " + ', '.join(f"{value}={n}" for value, n in sorted(values.items())))
     elif args.command == 'notifications':
         current = None
         try:
@@ -204,17 +289,63 @@ def main():
         if not current:
             print("Please login first (no session)")
         else:
-            notifs = get_notifications(current)
+            notifs = unit_of_work(get_notifications, current)
             print("Notifications:")
             for n in notifs:
                 print(f"[{n.get('type', 'info').upper()}] {n.get('message')} @ {n.get('timestamp', '')[:16]}")
-    elif args.command == 'generate-report':
-        success, report = generate_report()
+    elif args.command == 'migrate-storage':
+        success, msg = migrate_json_to_sqlite(args.db)
+        if success:
+            print(msg)
+        else:
+            print(f"ERROR: {msg}")
+            sys.exit(1)
+    elif args.command == 'compact-journal':
+        success, msg = compact_journal()
         if success:
-            print(report)
+            print(msg)
+        else:
+            print(f"ERROR: {msg}")
+            sys.exit(1)
+    elif args.command == 'migrate-task-logs':
+        success, msg = unit_of_work(split_inline_task_logs)
+        print(msg)
+    elif args.command == 'scheduler':
+        if args.once:
+            lifecycle.rescan()
+            due_notifier.rescan()
+            print(f"Applied {lifecycle.run_due()} live-task transitions, sent {due_notifier.run_due()} due-date notifications")
         else:
-            print(f"ERROR: {report}")
+            # the job threads commit their own batches, outside this command's unit of work
+            print("Scheduler running (Ctrl+C to stop)")
+            try:
+                for thread in start_jobs():
+                    thread.join()
+            except KeyboardInterrupt:
+                pass
+    elif args.command == 'batch':
+        try:
+            if args.file == '-':
+                operations = json.load(sys.stdin)
+            else:
+                with open(args.file) as f:
+                    operations = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Cannot read operations: {e}")
+            sys.exit(1)
+        success, msg, results = unit_of_work(apply_batch, operations)
+        if not success:
+            print(f"ERROR: {msg}")
             sys.exit(1)
+        print(msg)
+        for r in results:
+            print(f"{'OK' if r['success'] else 'ERROR'} {r['op']} {r['task_id']}: {r['message']}")
+    elif args.command == 'generate-report':
+        for chunk in iter_report(fmt=args.format):
+            sys.stdout.write(chunk)
+        sys.stdout.flush()
+        if args.cache_stats:
+            print(f"Report cache: {report_cache_stats()}", file=sys.stderr)
     else:
         parser.print_help()
 
@@ -0,0 +1,99 @@
+import itertools
+import threading
+from collections import deque
+from src.utils import current_transaction
+
+# recent events kept per user and replayed to a client reconnecting with Last-Event-ID
+EVENT_BACKLOG = 100
+# a subscriber this far behind is dropped; its client reconnects and catches up from the backlog
+EVENT_QUEUE_SIZE = 1000
+
+class Subscription:
+    def __init__(self, email):
+        self.email = email
+        self._events = deque()
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def push(self, event):
+        with self._cond:
+            if len(self._events) >= EVENT_QUEUE_SIZE:
+                self.closed = True
+            else:
+                self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout):
+        """Pending (id, type, data) events, waiting up to timeout; [] on timeout."""
+        with self._cond:
+            if not self._events and not self.closed:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+class EventHub:
+    """In-process publish/subscribe of task and notification changes, fanned out per user.
+
+    Events are numbered across the process; each user keeps the last EVENT_BACKLOG
+    so a reconnecting stream misses nothing. Only the process that made a change
+    sees it (the web server and the scheduler jobs it starts share one hub).
+    """
+
+    def __init__(self, backlog=EVENT_BACKLOG):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._subscribers = {}
+        self._backlogs = {}
+        self._backlog_size = backlog
+        self.published = 0
+
+    def publish(self, emails, kind, data):
+        with self._lock:
+            event = (next(self._ids), kind, data)
+            for email in set(emails):
+                self._backlogs.setdefault(email, deque(maxlen=self._backlog_size)).append(event)
+                for sub in self._subscribers.get(email, ()):
+                    sub.push(event)
+            self.published += 1
+
+    def subscribe(self, email, last_id=None):
+        sub = Subscription(email)
+        with self._lock:
+            self._subscribers.setdefault(email, set()).add(sub)
+            if last_id is not None:
+                for event in self._backlogs.get(email, ()):
+                    if event[0] > last_id:
+                        sub.push(event)
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.close()
+        with self._lock:
+            subs = self._subscribers.get(sub.email)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.email]
+
+    def stats(self):
+        with self._lock:
+            return {'published': self.published, 'subscribers': sum(len(s) for s in self._subscribers.values())}
+
+hub = EventHub()
+
+def publish(emails, kind, **data):
+    """Publish to emails once the current unit of work commits (right away outside one)."""
+    tx = current_transaction()
+    if tx is None:
+        hub.publish(emails, kind, data)
+    else:
+        tx.after_commit(lambda: hub.publish(emails, kind, data))
+
+def task_members(task):
+    return [task['owner']] + list(task.get('shared_with', []))
@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+# requests at least this slow are appended to SLOW_REQUEST_LOG with their I/O breakdown
+SLOW_REQUEST_MS = float(os.environ.get('SHARETASK_SLOW_REQUEST_MS', 500))
+SLOW_REQUEST_LOG = os.environ.get('SHARETASK_SLOW_REQUEST_LOG', 'data/slow_requests.log')
+# histogram bucket upper bounds, seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# load: data file reads (cache hits included) with parsing, parse: the parsing alone,
+# encode: serialising for save_data, save: file rewrites, commit: storage writes of a
+# unit of work, render: templates
+IO_KINDS = ('load', 'parse', 'encode', 'save', 'commit', 'render')
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        total, result = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class RequestStats:
+    """Calls, bytes and seconds per I/O kind within one request or CLI command."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.io = {kind: [0, 0, 0.0] for kind in IO_KINDS}
+
+    def add(self, kind, nbytes, seconds, calls):
+        entry = self.io[kind]
+        entry[0] += calls
+        entry[1] += nbytes
+        entry[2] += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        return {kind: {'calls': c, 'bytes': b, 'ms': round(s * 1000, 3)} for kind, (c, b, s) in self.io.items() if c or b}
+
+    def format(self):
+        lines = [f"{kind:<7} {c:>6} calls {b:>12} bytes {s * 1000:>10.3f} ms" for kind, (c, b, s) in self.io.items()]
+        return "\n".join(lines + [f"total   {self.elapsed() * 1000:>42.3f} ms"])
+
+class Metrics:
+    """Process-wide counters and latency histograms, plus the stats of the request each thread is serving.
+
+    Storage code reports every I/O call through record_io(); it always adds to the
+    totals and, between begin() and end() on the same thread, to that request's stats.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.io_totals = {kind: [0, 0, 0.0] for kind in IO_KINDS}
+        self.io_latency = {kind: Histogram() for kind in IO_KINDS}
+        self.request_io = {kind: Histogram() for kind in IO_KINDS}
+        self.request_latency = {}
+        self.requests = {}
+        self.slow_requests = 0
+
+    def begin(self):
+        self._local.stats = RequestStats()
+        return self._local.stats
+
+    def current(self):
+        return getattr(self._local, 'stats', None)
+
+    def end(self):
+        stats = self.current()
+        self._local.stats = None
+        return stats
+
+    def record_io(self, kind, nbytes=0, seconds=0.0, calls=1):
+        with self._lock:
+            entry = self.io_totals[kind]
+            entry[0] += calls
+            entry[1] += nbytes
+            entry[2] += seconds
+            if calls:
+                self.io_latency[kind].observe(seconds)
+        stats = self.current()
+        if stats is not None:
+            stats.add(kind, nbytes, seconds, calls)
+
+    def finish_request(self, stats, endpoint, method, path, status):
+        """Record a served request; logs it to SLOW_REQUEST_LOG past SLOW_REQUEST_MS. Returns its seconds."""
+        seconds = stats.elapsed()
+        with self._lock:
+            self.request_latency.setdefault(endpoint, Histogram()).observe(seconds)
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for kind, (calls, nbytes, spent) in stats.io.items():
+                if calls:
+                    self.request_io[kind].observe(spent)
+            slow = seconds * 1000 >= SLOW_REQUEST_MS
+            if slow:
+                self.slow_requests += 1
+        if slow:
+            entry = {'at': str(datetime.now()), 'method': method, 'path': path, 'endpoint': endpoint, 'status': status,
+                     'ms': round(seconds * 1000, 3), 'io': stats.summary()}
+            os.makedirs(os.path.dirname(SLOW_REQUEST_LOG) or '.', exist_ok=True)
+            with open(SLOW_REQUEST_LOG, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+        return seconds
+
+    def render(self, extra=None):
+        """Everything in the Prometheus text exposition format; extra is {name: (help, type, value)} from elsewhere."""
+        with self._lock:
+            lines = []
+            _histograms(lines, 'sharetask_request_duration_seconds', 'Request handling time by endpoint',
+                        [({'endpoint': e}, h) for e, h in sorted(self.request_latency.items())])
+            lines += ['# HELP sharetask_requests_total Requests served', '# TYPE sharetask_requests_total counter']
+            lines += [f"sharetask_requests_total{_labels({'endpoint': e, 'method': m, 'status': s})} {n}"
+                      for (e, m, s), n in sorted(self.requests.items())]
+            lines += ['# HELP sharetask_slow_requests_total Requests over the slow-request threshold',
+                      '# TYPE sharetask_slow_requests_total counter', f"sharetask_slow_requests_total {self.slow_requests}"]
+            _histograms(lines, 'sharetask_io_duration_seconds', 'Time per storage I/O or render call',
+                        [({'kind': k}, self.io_latency[k]) for k in IO_KINDS])
+            _histograms(lines, 'sharetask_request_io_seconds', 'Time a request spent in each kind of I/O',
+                        [({'kind': k}, self.request_io[k]) for k in IO_KINDS])
+            for name, index, help_text in (('calls', 0, 'Storage I/O and render calls'), ('bytes', 1, 'Bytes read or written')):
+                lines += [f"# HELP sharetask_io_{name}_total {help_text}", f"# TYPE sharetask_io_{name}_total counter"]
+                lines += [f"sharetask_io_{name}_total{_labels({'kind': k})} {self.io_totals[k][index]}" for k in IO_KINDS]
+        for name, (help_text, kind, value) in (extra or {}).items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+def _histograms(lines, name, help_text, series):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, hist in series:
+        for bound, count in hist.cumulative():
+            lines.append(f"{name}_bucket{_labels(dict(labels, le=repr(float(bound))))} {count}")
+        lines.append(f"{name}_bucket{_labels(dict(labels, le='+Inf'))} {hist.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {hist.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {hist.count}")
+
+metrics = Metrics()
@@ -0,0 +1,110 @@
+import calendar
+import os
+from datetime import date, datetime, timedelta
+
+# frequency -> (unit, step); any other frequency ('one-time') has a single occurrence on the due date
+RECURRENCE_RULES = {'daily': ('days', 1), 'weekly': ('days', 7), 'monthly': ('months', 1)}
+OCCURRENCE_WINDOW_DAYS = int(os.environ.get('SHARETASK_OCCURRENCE_WINDOW', 14))
+OCCURRENCE_WINDOW_MAX = 366
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value or '', '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None
+
+def is_recurring(task):
+    return task.get('frequency') in RECURRENCE_RULES and parse_day(task.get('due_date')) is not None
+
+def _add_months(day, months):
+    # the anchor's day of month, clamped to shorter months (Jan 31 -> Feb 28 -> Mar 31)
+    month = day.month - 1 + months
+    year, month = day.year + month // 12, month % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+def iter_occurrences(task, start, end=None):
+    """Occurrence dates of a task in [start, end) (end None = unbounded), generated lazily.
+
+    The due date is the first occurrence and the frequency the rule for the rest;
+    the generator jumps straight to start, so the cost is the size of the window.
+    """
+    first = parse_day(task.get('due_date'))
+    if first is None:
+        return
+    rule = RECURRENCE_RULES.get(task.get('frequency'))
+    if rule is None:
+        if start <= first and (end is None or first < end):
+            yield first
+        return
+    unit, step = rule
+    if unit == 'days':
+        day = first + timedelta(days=max(0, -(-(start - first).days // step)) * step)
+        while end is None or day < end:
+            yield day
+            day += timedelta(days=step)
+        return
+    n = max(0, (start.year - first.year) * 12 + start.month - first.month) // step * step
+    while True:
+        day = _add_months(first, n)
+        if end is not None and day >= end:
+            return
+        if day >= start:
+            yield day
+        n += step
+
+def previous_occurrence(task, day):
+    """Last occurrence before day, or None."""
+    first = parse_day(task.get('due_date'))
+    if first is None or first >= day:
+        return None
+    unit, step = RECURRENCE_RULES.get(task.get('frequency'), ('days', None))
+    if step is None:
+        return first
+    if unit == 'days':
+        return first + timedelta(days=(day - first - timedelta(days=1)).days // step * step)
+    prev = first
+    for occ in iter_occurrences(task, _add_months(day, -step - 1), day):
+        prev = occ
+    return prev
+
+def is_occurrence(task, day):
+    return next(iter_occurrences(task, day, day + timedelta(days=1)), None) == day
+
+def occurrence_statuses(task, day):
+    """Each member's status for one occurrence: the sparse override if set, else To Do
+    (members yet to accept the share stay Pending)."""
+    overrides = task.get('occurrence_statuses', {}).get(day.isoformat(), {})
+    return {email: overrides.get(email, 'Pending' if status == 'Pending' else 'To Do')
+            for email, status in task.get('statuses', {}).items()}
+
+def occurrence_view(task, day):
+    """{'date', 'statuses', 'master_status'} of one occurrence; a one-time task's only occurrence is the task itself."""
+    if not is_recurring(task):
+        return {'date': day.isoformat(), 'statuses': dict(task.get('statuses', {})), 'master_status': task.get('master_status', 'To Do')}
+    statuses = occurrence_statuses(task, day)
+    values = statuses.values()
+    if all(s == 'Done' for s in values):
+        master = 'Done'
+    elif any(s == 'In Progress' for s in values):
+        master = 'In Progress'
+    else:
+        master = 'To Do'
+    if task.get('category') == 'assignment' and task.get('shared_with'):
+        master = statuses.get(task['shared_with'][0], master)
+    return {'date': day.isoformat(), 'statuses': statuses, 'master_status': master}
+
+def set_occurrence_status(task, day, email, status):
+    # only deviations from the default are stored, and emptied dates are dropped
+    overrides = task.setdefault('occurrence_statuses', {})
+    entry = overrides.setdefault(day.isoformat(), {})
+    if status == 'To Do':
+        entry.pop(email, None)
+    else:
+        entry[email] = status
+    if not entry:
+        del overrides[day.isoformat()]
+    if not overrides:
+        del task['occurrence_statuses']
+
+def occurrences_in_window(task, start, days=OCCURRENCE_WINDOW_DAYS):
+    return [occurrence_view(task, day) for day in iter_occurrences(task, start, start + timedelta(days=days))]
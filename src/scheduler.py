@@ -0,0 +1,529 @@
+import atexit
+import heapq
+import itertools
+import os
+import sys
+import threading
+import traceback
+from datetime import datetime, timedelta, time as dtime
+from src.utils import load_task, iter_tasks, save_task, on_commit, run_transaction, clone
+from src.user import add_notification
+from src.events import hub, task_members
+from src.recurrence import parse_day, is_recurring, iter_occurrences, previous_occurrence, occurrence_view
+
+# tasks written in this process are scheduled as they commit; the full rescan of the store is
+# the safety net that picks up tasks created or changed by other processes (CLI, other workers)
+SCHEDULER_RESCAN = float(os.environ.get('SHARETASK_SCHEDULER_RESCAN', 300))
+# (user, key, level) due-date notifications already sent are kept on the task under DUE_NOTIFIED_FIELD,
+# written in the same commit as the notifications; the key is the task id, or "<id>@<date>" for an
+# occurrence of a recurring task, and those are forgotten once older than any previous occurrence can be
+DUE_NOTIFIED_FIELD = 'due_notified'
+# delay before tasks whose batch failed to commit are tried again
+SCHEDULER_RETRY = 30
+DUE_SOON_DAYS = 3
+DUE_NOTIFIED_KEEP_DAYS = 32
+# seconds between batched writes of changed live-task participants
+PRESENCE_FLUSH = float(os.environ.get('SHARETASK_PRESENCE_FLUSH', 2))
+
+def live_deadline(task):
+    """(when, transition) of the next automatic transition of a live task, or None."""
+    if task.get('task_type') != 'live' or not task.get('start_time'):
+        return None
+    start = datetime.fromisoformat(task['start_time'])
+    if task.get('live_status') == 'not_started' and task.get('live_mode') == 'preconfigured':
+        return start, 'start'
+    if task.get('live_status') == 'running' and (task.get('duration') or 0) > 0:
+        return start + timedelta(minutes=task['duration']), 'end'
+    return None
+
+def _skip_task(job, task_id):
+    # one task's bad data must not stop the job for every other task
+    print(f"{job}: skipping task {task_id}: {traceback.format_exc().strip().splitlines()[-1]}", file=sys.stderr)
+
+def apply_live_transitions(task, now=None):
+    """Apply every automatic transition due by now; returns True if the task changed.
+
+    Timestamps come from the deadlines rather than the clock, so applying the
+    same transitions again (another reader, a retried commit) gives the same task.
+    """
+    now = now or datetime.now()
+    changed = False
+    deadline = live_deadline(task)
+    while deadline and deadline[0] <= now:
+        when, transition = deadline
+        if transition == 'start':
+            task['live_status'] = 'running'
+            task.setdefault('participants', {})[task['owner']] = {'joined': task['start_time'], 'left': None, 'duration': 0}
+        elif when < now:
+            task['live_status'] = 'ended'
+            for p in task.get('participants', {}).values():
+                if p['left'] is None:
+                    p['left'] = str(when)
+                    p['duration'] = max((when - datetime.fromisoformat(p['joined'])).total_seconds(), 0)
+        else:
+            break
+        changed = True
+        deadline = live_deadline(task)
+    return changed
+
+class PeriodicJob:
+    """Background thread that sleeps until the earliest deadline in its heap or the next full rescan.
+
+    Subclasses implement rescan() (rebuild the heap from storage), schedule(task_id, task)
+    (push a task written in this process) and run_due(now).
+    """
+
+    def __init__(self, rescan_interval=SCHEDULER_RESCAN):
+        self.rescan_interval = rescan_interval
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def _replace_heap(self, heap):
+        heapq.heapify(heap)
+        with self._cond:
+            self._heap = heap
+            self._cond.notify()
+
+    def _push(self, when, key):
+        with self._cond:
+            heapq.heappush(self._heap, (when, key))
+            self._cond.notify()
+
+    def _pop_due(self, now):
+        due = set()
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                due.add(heapq.heappop(self._heap)[1])
+        return sorted(due)
+
+    def _retry_later(self, due, now):
+        # the batch did not commit (conflicts outlasting the retries, I/O error): try again soon
+        for tid in due:
+            self._push(now + timedelta(seconds=SCHEDULER_RETRY), tid)
+
+    def run(self):
+        next_scan = datetime.now()
+        while True:
+            now = datetime.now()
+            # a failed pass is logged and the loop goes on; the next rescan or retry picks it up
+            if now >= next_scan:
+                next_scan = now + timedelta(seconds=self.rescan_interval)
+                try:
+                    self.rescan()
+                except Exception:
+                    traceback.print_exc()
+            try:
+                self.run_due(now)
+            except Exception:
+                traceback.print_exc()
+            with self._cond:
+                if self._stopping:
+                    return
+                wake = min(next_scan, self._heap[0][0]) if self._heap else next_scan
+                self._cond.wait(max((wake - datetime.now()).total_seconds(), 0))
+
+    def start(self):
+        # a thread inherited through fork (preloading WSGI servers) is not running here
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stopping = False
+
+class LifecycleScheduler(PeriodicJob):
+    """Min-heap of upcoming live-task start/end deadlines, drained by a background thread.
+
+    Each wake-up applies every due transition in one transaction, so a batch of
+    tasks costs one write; transitions are guarded by live_status and committed
+    with version checks, so each is stored once even with several schedulers.
+    The live_status events are published after the commit, at most once.
+    """
+
+    def __init__(self, rescan_interval=SCHEDULER_RESCAN):
+        super().__init__(rescan_interval)
+        self.transitions = 0
+
+    def rescan(self):
+        heap = []
+        for tid, task in iter_tasks():
+            try:
+                deadline = live_deadline(task)
+            except Exception:
+                _skip_task('LifecycleScheduler', tid)
+                continue
+            if deadline:
+                heap.append((deadline[0], tid))
+        self._replace_heap(heap)
+
+    def schedule(self, task_id, task):
+        """Called after a task is written in this process."""
+        if self._thread is None:
+            return
+        try:
+            deadline = live_deadline(task)
+        except Exception:
+            _skip_task('LifecycleScheduler', task_id)
+            return
+        if deadline is not None:
+            self._push(deadline[0], task_id)
+
+    def run_due(self, now=None):
+        """Apply the transitions due by now; returns how many tasks changed."""
+        now = now or datetime.now()
+        due = self._pop_due(now)
+        if not due:
+            return 0
+        changed = {}
+
+        def apply():
+            changed.clear()
+            for tid in due:
+                task = load_task(tid)
+                if task is None:
+                    continue
+                # participants still in memory are ended together with the task
+                presence.merge_into(tid, task)
+                try:
+                    transitioned = apply_live_transitions(task, now)
+                except Exception:
+                    _skip_task('LifecycleScheduler', tid)
+                    continue
+                if transitioned:
+                    save_task(tid, task)
+                    changed[tid] = task
+        try:
+            run_transaction(apply)
+        except Exception:
+            self._retry_later(due, now)
+            raise
+        for tid, task in changed.items():
+            if task['live_status'] == 'ended':
+                presence.close(tid)
+            hub.publish(task_members(task), 'live_status', {'task_id': tid, 'live_status': task['live_status'], 'start_time': task['start_time']})
+        for tid in due:
+            # stale entries (stopped early, deleted) simply drop out here
+            task = changed.get(tid) or load_task(tid)
+            if task is not None:
+                self.schedule(tid, task)
+        self.transitions += len(changed)
+        return len(changed)
+
+def task_due_date(task):
+    return parse_day(task.get('due_date'))
+
+def due_levels(task_id, task, today):
+    """[(key, 'warning' | 'critical', message)] for a task due within DUE_SOON_DAYS or overdue.
+
+    A recurring task is checked per occurrence: the last one before today if it is
+    not Done, and the next one if it is due soon and not Done already.
+    """
+    if is_recurring(task):
+        levels = []
+        prev = previous_occurrence(task, today)
+        if prev is not None and occurrence_view(task, prev)['master_status'] != 'Done':
+            levels.append((f"{task_id}@{prev}", 'critical', f"Critical: Task overdue - {task['title']} (ID:{task_id}, {prev})"))
+        nxt = next(iter_occurrences(task, today, today + timedelta(days=DUE_SOON_DAYS + 1)), None)
+        if nxt is not None and occurrence_view(task, nxt)['master_status'] != 'Done':
+            levels.append((f"{task_id}@{nxt}", 'warning', f"Warning: Task due soon ({(nxt - today).days} days) - {task['title']} (ID:{task_id}, {nxt})"))
+        return levels
+    due = task_due_date(task)
+    if due is None:
+        return []
+    days_left = (due - today).days
+    if days_left < 0:
+        return [(task_id, 'critical', f"Critical: Task overdue - {task['title']} (ID:{task_id})")]
+    if days_left <= DUE_SOON_DAYS:
+        return [(task_id, 'warning', f"Warning: Task due soon ({days_left} days) - {task['title']} (ID:{task_id})")]
+    return []
+
+def next_due_threshold(task, now):
+    """Midnight at which the task next changes level: due soon, then overdue (per occurrence if recurring)."""
+    if is_recurring(task):
+        upcoming = itertools.islice(iter_occurrences(task, now.date()), 2)
+        thresholds = [datetime.combine(day + timedelta(days=offset), dtime.min)
+                      for day in upcoming for offset in (-DUE_SOON_DAYS, 1)]
+        return min(t for t in thresholds if t > now)
+    due = task_due_date(task)
+    if due is None:
+        return None
+    warning = datetime.combine(due - timedelta(days=DUE_SOON_DAYS), dtime.min)
+    overdue = datetime.combine(due + timedelta(days=1), dtime.min)
+    if now < warning:
+        return warning
+    return overdue if now < overdue else None
+
+def _expired_notice(key, today):
+    day = parse_day(key.partition('@')[2])
+    return day is not None and (today - day).days > DUE_NOTIFIED_KEEP_DAYS
+
+def due_recipients(task):
+    # the owner and everyone who accepted the share
+    return [task['owner']] + [email for email, status in task.get('statuses', {}).items()
+                              if email != task['owner'] and status != 'Pending']
+
+class DueDateNotifier(PeriodicJob):
+    """Due-soon / overdue notifications, sent when a task crosses a threshold.
+
+    The heap holds each task's next threshold; a wake-up notifies every recipient
+    of the crossed tasks who has not had that (user, key, level) yet and marks it
+    on the task, all in one transaction. Version checks let only one process commit
+    a marker, and the notification is delivered after that commit, so each notice
+    is sent at most once (a crash between commit and delivery loses it).
+    """
+
+    def __init__(self, rescan_interval=SCHEDULER_RESCAN):
+        super().__init__(rescan_interval)
+        self.sent = 0
+
+    def _sent(self, task):
+        return {tuple(entry) for entry in task.get(DUE_NOTIFIED_FIELD, [])}
+
+    def _pending(self, tid, task, today):
+        sent = self._sent(task)
+        return any((email, key, level) not in sent for key, level, msg in due_levels(tid, task, today) for email in due_recipients(task))
+
+    def _next_wake(self, tid, task, now):
+        try:
+            if self._pending(tid, task, now.date()):
+                # crossed a threshold with someone still to notify (e.g. a share accepted since)
+                return now
+            return next_due_threshold(task, now)
+        except Exception:
+            _skip_task('DueDateNotifier', tid)
+            return None
+
+    def rescan(self):
+        now = datetime.now()
+        heap = []
+        for tid, task in iter_tasks():
+            when = self._next_wake(tid, task, now)
+            if when is not None:
+                heap.append((when, tid))
+        self._replace_heap(heap)
+
+    def schedule(self, task_id, task):
+        """Called after a task is written in this process (created, shared, status or due date changed)."""
+        if self._thread is None:
+            return
+        when = self._next_wake(task_id, task, datetime.now())
+        if when is not None:
+            self._push(when, task_id)
+
+    def run_due(self, now=None):
+        """Send the notifications for thresholds crossed by now; returns how many were sent."""
+        now = now or datetime.now()
+        due = self._pop_due(now)
+        if not due:
+            return 0
+        batch = []
+
+        def notify():
+            batch.clear()
+            for tid in due:
+                task = load_task(tid)
+                if task is None:
+                    continue
+                try:
+                    levels = due_levels(tid, task, now.date())
+                except Exception:
+                    _skip_task('DueDateNotifier', tid)
+                    continue
+                sent = self._sent(task)
+                new = []
+                for key, level, msg in levels:
+                    for email in due_recipients(task):
+                        if (email, key, level) not in sent:
+                            add_notification(email, msg, level, tid)
+                            new.append([email, key, level])
+                marked = task.get(DUE_NOTIFIED_FIELD, [])
+                kept = [entry for entry in marked if not _expired_notice(entry[1], now.date())]
+                if new or len(kept) != len(marked):
+                    task[DUE_NOTIFIED_FIELD] = kept + new
+                    save_task(tid, task)
+                batch.extend(new)
+        try:
+            run_transaction(notify)
+        except Exception:
+            self._retry_later(due, now)
+            raise
+        self.sent += len(batch)
+        for tid in due:
+            task = load_task(tid)
+            when = None
+            if task is not None:
+                try:
+                    when = next_due_threshold(task, now)
+                except Exception:
+                    _skip_task('DueDateNotifier', tid)
+            if when is not None:
+                self._push(when, tid)
+        return len(batch)
+
+class PresenceTracker:
+    """Participants of running live tasks, kept in memory and written back in batches.
+
+    A session is a copy of the running task whose participants are authoritative:
+    join/leave only change the session, and every PRESENCE_FLUSH seconds the
+    changed sessions are merged into their tasks in one transaction. Stopping a
+    task (owner or scheduler) merges its session into that write, and stop()
+    flushes once more on a clean shutdown. Only active while the flush thread
+    runs (the web server); without it callers write participants directly.
+    Sessions only supply participants: the stored task is read every time, and a
+    session whose task was stopped, restarted or deleted elsewhere is dropped.
+    """
+
+    def __init__(self, interval=PRESENCE_FLUSH):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._dirty = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._registered = False
+        self.flushes = 0
+
+    @property
+    def active(self):
+        return self._thread is not None
+
+    def open(self, task_id, task):
+        if self.active:
+            with self._lock:
+                self._sessions.setdefault(task_id, clone(task))
+
+    def current(self, task_id):
+        """The stored task with the tracked participants overlaid, or None if it does not exist."""
+        task = load_task(task_id)
+        if task is None:
+            self.close(task_id)
+            return None
+        self.merge_into(task_id, task)
+        return task
+
+    def join(self, task_id, task, email, when):
+        with self._lock:
+            participants = self._sessions.setdefault(task_id, clone(task)).setdefault('participants', {})
+            if email not in participants:
+                participants[email] = {'joined': str(when), 'left': None, 'duration': 0}
+                self._dirty.add(task_id)
+            return dict(participants[email])
+
+    def leave(self, task_id, task, email, when):
+        with self._lock:
+            p = self._sessions.setdefault(task_id, clone(task)).get('participants', {}).get(email)
+            if p is None:
+                return None
+            if p['left'] is None:
+                p['left'] = str(when)
+                p['duration'] = (when - datetime.fromisoformat(p['joined'])).total_seconds()
+                self._dirty.add(task_id)
+            return dict(p)
+
+    def merge_into(self, task_id, task):
+        """Overlay the session's participants on a task loaded from storage."""
+        with self._lock:
+            session = self._sessions.get(task_id)
+            if session is None:
+                return
+            # another process (or a write that bypassed this one) ended or restarted the task
+            if task.get('live_status') == 'ended' or task.get('start_time') != session.get('start_time'):
+                self._sessions.pop(task_id, None)
+                self._dirty.discard(task_id)
+                return
+            task['participants'] = clone(session.get('participants', {}))
+
+    def close(self, task_id):
+        with self._lock:
+            self._sessions.pop(task_id, None)
+            self._dirty.discard(task_id)
+
+    def flush(self):
+        """Write every changed session in one transaction; returns how many tasks were written."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return 0
+        written, gone = [], []
+
+        def write():
+            written.clear()
+            gone.clear()
+            for tid in sorted(dirty):
+                task = load_task(tid)
+                if task is not None:
+                    apply_live_transitions(task)
+                if task is None or task.get('live_status') != 'running':
+                    # stopped or deleted elsewhere
+                    gone.append(tid)
+                    continue
+                self.merge_into(tid, task)
+                save_task(tid, task)
+                written.append(tid)
+        try:
+            run_transaction(write)
+        except Exception:
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        for tid in gone:
+            self.close(tid)
+        self.flushes += 1
+        return len(written)
+
+    def run(self):
+        while True:
+            with self._cond:
+                if not self._stopping:
+                    self._cond.wait(self.interval)
+                stopping = self._stopping
+            try:
+                self.flush()
+            except Exception:
+                # kept dirty, retried on the next round
+                traceback.print_exc()
+            if stopping:
+                return
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+            if not self._registered:
+                atexit.register(self.stop)
+                self._registered = True
+        return self._thread
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stopping = False
+
+lifecycle = LifecycleScheduler()
+due_notifier = DueDateNotifier()
+presence = PresenceTracker()
+
+def schedule_written(tasks):
+    for tid, task in tasks.items():
+        if task is not None:
+            lifecycle.schedule(tid, task)
+            due_notifier.schedule(tid, task)
+
+on_commit(schedule_written)
+
+def start_jobs():
+    return [lifecycle.start(), due_notifier.start(), presence.start()]
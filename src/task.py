@@ -1,8 +1,17 @@
-from src.utils import load_data, save_data, TASKS_FILE, USERS_FILE, get_current_user
+from src.utils import load_task, tasks_for_user, iter_tasks, task_stamps, load_task_batch, query_tasks, task_stats, task_log, task_log_page, current_transaction, TASK_SORT_FIELDS, TASK_FILTER_FIELDS, TASK_STAT_FIELDS, TASK_LOG_FIELDS, TASK_LOG_PAGE, save_task, remove_task, next_task_id, description_taken, title_taken, load_user, get_current_user, transactional
 from datetime import datetime, timedelta
+import base64
 import csv
+import io
+import json
+import os
+import threading
 import time
+from collections import OrderedDict
 from src.user import add_notification, get_notifications
+from src.scheduler import apply_live_transitions, presence
+from src.events import publish, task_members
+from src.recurrence import parse_day, is_recurring, is_occurrence, set_occurrence_status, occurrence_view, occurrences_in_window, OCCURRENCE_WINDOW_DAYS, OCCURRENCE_WINDOW_MAX
 
 def add_to_history(task, action, user, details=''):
     if 'history' not in task:
@@ -14,18 +23,50 @@ def add_to_history(task, action, user, details=''):
         'details': details
     })
 
+def _status_counts(task):
+    counts = task.get('status_counts')
+    if counts is None:  # written before the counts were kept
+        counts = task['status_counts'] = {}
+        for s in task.get('statuses', {}).values():
+            counts[s] = counts.get(s, 0) + 1
+    return counts
+
+def set_user_status(task, email, status):
+    """Set one user's status (None removes it), keeping the task's per-status counts in step."""
+    counts = _status_counts(task)
+    old = task['statuses'].pop(email, None) if status is None else task['statuses'].get(email)
+    if old is not None:
+        counts[old] -= 1
+        if not counts[old]:
+            del counts[old]
+    if status is not None:
+        task['statuses'][email] = status
+        counts[status] = counts.get(status, 0) + 1
+
+def derive_master_status(task):
+    counts = _status_counts(task)
+    if counts.get('Done', 0) == len(task['statuses']):
+        task['master_status'] = 'Done'
+    elif counts.get('In Progress'):
+        task['master_status'] = 'In Progress'
+    else:
+        task['master_status'] = 'To Do'
+
+@transactional
 def create_task(title, description, frequency, due_date, task_type='normal', category='sharing', user_email=None, start_time=None, duration=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    for t in tasks.values():
-        if t.get('description') == description:
-            return False, "Task description must be unique"
-    for t in tasks.values():
-        if t.get('owner') == current_email and t.get('title') == title:
-            return False, "Task title must be unique for the user"
-    task_id = str(max([int(k) for k in tasks.keys()] or [0]) + 1)
+    if description_taken(description):
+        return False, "Task description must be unique"
+    if title_taken(current_email, title):
+        return False, "Task title must be unique for the user"
+    if task_type == 'live' and start_time:
+        try:
+            datetime.fromisoformat(start_time)
+        except (TypeError, ValueError):
+            return False, "Invalid start time (use YYYY-MM-DDTHH:MM)"
+    task_id = next_task_id()
     task_data = {
         'owner': current_email,
         'title': title,
@@ -35,6 +76,7 @@ def create_task(title, description, frequency, due_date, task_type='normal', cat
         'created_at': str(datetime.now()),
         'shared_with': [],
         'statuses': {current_email: 'To Do'},
+        'status_counts': {'To Do': 1},
         'master_status': 'To Do',
         'comments': [],
         'task_type': task_type,
@@ -47,23 +89,21 @@ def create_task(title, description, frequency, due_date, task_type='normal', cat
         task_data['participants'] = {}  # email: {'joined': ts, 'left': ts or None, 'duration': secs}
         task_data['live_mode'] = 'preconfigured' if start_time else 'dynamic'
     add_to_history(task_data, 'created', current_email, f"Category: {category}, type: {task_type}")
-    tasks[task_id] = task_data
-    save_data(TASKS_FILE, tasks)
+    save_task(task_id, task_data)
     return True, f"Task created: {title} (type: {task_type})"
 
+@transactional
 def share_task(task_id, share_email, context=None, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    users = load_data('data/users.json')
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    if tasks[task_id]['owner'] != current_email:
+    if task['owner'] != current_email:
         return False, "Not task owner"
-    if share_email not in users:
+    if load_user(share_email) is None:
         return False, "User to share with not registered"
-    task = tasks[task_id]
     if share_email not in task['shared_with']:
         if task.get('category') == 'assignment':
             if task.get('shared_with'):
@@ -74,33 +114,29 @@ def share_task(task_id, share_email, context=None, user_email=None):
                     return False, "Cannot reassign assignment task in In Progress"
                 # unassign old
                 task['shared_with'].remove(curr_assignee)
-                if curr_assignee in task['statuses']:
-                    del task['statuses'][curr_assignee]
+                set_user_status(task, curr_assignee, None)
             if len(task.get('shared_with', [])) > 0:
                 return False, "Assignment category supports only one assignee"
         task['shared_with'].append(share_email)
-        if share_email == current_email:
-            task['statuses'][share_email] = 'To Do'
-        else:
-            task['statuses'][share_email] = 'Pending'
+        set_user_status(task, share_email, 'To Do' if share_email == current_email else 'Pending')
         if context:
             task['assign_context'] = context
         add_to_history(task, 'shared', current_email, f"with {share_email}{', context: ' + context if context else ''}")
-        save_data(TASKS_FILE, tasks)
+        save_task(task_id, task)
         msg = f"New task shared: {task['title']} (ID: {task_id}) from {current_email}"
         if context:
             msg += f" - Context: {context}"
         add_notification(share_email, msg, 'info', task_id)
     return True, f"Task shared with {share_email} (pending acceptance)"
 
+@transactional
 def update_task_status(task_id, status, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
     if current_email not in task['statuses']:
         return False, "No permission to update this task"
     if task.get('category') == 'assignment' and current_email == task['owner']:
@@ -111,124 +147,139 @@ def update_task_status(task_id, status, user_email=None):
         return False, "Accept the shared task first"
     if status not in ['To Do', 'In Progress', 'Done']:
         return False, "Invalid status"
-    task['statuses'][current_email] = status
-    statuses = task['statuses'].values()
-    if all(s == 'Done' for s in statuses):
-        task['master_status'] = 'Done'
-    elif any(s == 'In Progress' for s in statuses):
-        task['master_status'] = 'In Progress'
-    else:
-        task['master_status'] = 'To Do'
+    set_user_status(task, current_email, status)
+    derive_master_status(task)
     if task.get('category') == 'assignment' and task.get('shared_with'):
         assignee = task['shared_with'][0]
         task['master_status'] = task['statuses'].get(assignee, task['master_status'])
     add_to_history(task, 'status_update', current_email, f"to {status}")
-    save_data(TASKS_FILE, tasks)
+    save_task(task_id, task)
+    publish(task_members(task), 'status', task_id=task_id, user=current_email, status=status, master_status=task['master_status'])
     return True, "Status updated"
 
+@transactional
+def update_occurrence_status(task_id, day, status, user_email=None):
+    """Set the user's status for one occurrence (YYYY-MM-DD) of a recurring task, stored as a sparse override."""
+    current_email = user_email or get_current_user()
+    if not current_email:
+        return False, "Please login first"
+    task = load_task(task_id)
+    if task is None:
+        return False, "Task not found"
+    if current_email not in task['statuses']:
+        return False, "No permission to update this task"
+    if task['statuses'][current_email] == 'Pending':
+        return False, "Accept the shared task first"
+    if status not in ['To Do', 'In Progress', 'Done']:
+        return False, "Invalid status"
+    if not is_recurring(task):
+        return False, "Not a recurring task"
+    occurrence = parse_day(day)
+    if occurrence is None or not is_occurrence(task, occurrence):
+        return False, f"No occurrence on {day}"
+    set_occurrence_status(task, occurrence, current_email, status)
+    master_status = occurrence_view(task, occurrence)['master_status']
+    add_to_history(task, 'occurrence_status', current_email, f"{occurrence} to {status}")
+    save_task(task_id, task)
+    publish(task_members(task), 'occurrence', task_id=task_id, date=occurrence.isoformat(), user=current_email, status=status, master_status=master_status)
+    return True, "Occurrence status updated"
+
+@transactional
 def add_comment(task_id, comment, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
     if current_email not in task['statuses'] and current_email != task['owner']:
         return False, "No permission to comment"
-    task['comments'].append({
+    task.setdefault('comments', []).append({
         'user': current_email,
         'comment': comment,
         'timestamp': str(datetime.now())
     })
     add_to_history(task, 'comment_added', current_email, comment[:50])
-    save_data(TASKS_FILE, tasks)
+    save_task(task_id, task)
     return True, "Comment added"
 
+@transactional
 def revoke_share(task_id, revoke_email, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
     if task['owner'] != current_email:
         return False, "Only owner can revoke share"
     if revoke_email not in task.get('shared_with', []):
         return False, "User not in shared list"
     task['shared_with'].remove(revoke_email)
-    if revoke_email in task['statuses']:
-        del task['statuses'][revoke_email]
+    set_user_status(task, revoke_email, None)
     add_to_history(task, 'revoked_share', current_email, f"from {revoke_email}")
-    save_data(TASKS_FILE, tasks)
+    save_task(task_id, task)
     return True, f"Share revoked from {revoke_email}"
 
+@transactional
 def accept_shared_task(task_id, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
     if current_email not in task.get('statuses', {}):
         return False, "No permission"
     if task['statuses'][current_email] != 'Pending':
         return False, "Task not in pending state"
-    task['statuses'][current_email] = 'To Do'
-    statuses = task['statuses'].values()
-    if all(s == 'Done' for s in statuses):
-        task['master_status'] = 'Done'
-    elif any(s == 'In Progress' for s in statuses):
-        task['master_status'] = 'In Progress'
-    else:
-        task['master_status'] = 'To Do'
+    set_user_status(task, current_email, 'To Do')
+    derive_master_status(task)
     add_to_history(task, 'accepted', current_email, 'Shared task accepted')
-    save_data(TASKS_FILE, tasks)
+    save_task(task_id, task)
     add_notification(task['owner'], f"User {current_email} accepted shared task {task['title']} (ID: {task_id})", 'info', task_id)
     return True, "Task accepted and set to To Do"
 
+@transactional
 def reject_shared_task(task_id, reason=None, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
     if current_email not in task.get('statuses', {}) or task['statuses'][current_email] != 'Pending':
         return False, "Task not pending for you"
     if reason:
-        task['comments'].append({
+        task.setdefault('comments', []).append({
             'user': current_email,
             'comment': f"Rejection reason: {reason}",
             'timestamp': str(datetime.now())
         })
     if current_email in task.get('shared_with', []):
         task['shared_with'].remove(current_email)
-    if current_email in task['statuses']:
-        del task['statuses'][current_email]
+    set_user_status(task, current_email, None)
     add_to_history(task, 'rejected', current_email, f"Reason: {reason or 'none'}")
-    save_data(TASKS_FILE, tasks)
+    save_task(task_id, task)
     notif_msg = f"User {current_email} rejected shared task {task['title']} (ID: {task_id})"
     if reason:
         notif_msg += f" - Reason: {reason}"
     add_notification(task['owner'], notif_msg, 'critical', task_id)
     return True, "Task rejected"
 
+@transactional
 def start_live_task(task_id, duration=None, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
     if task['owner'] != current_email:
         return False, "Only owner can start live task"
     if task.get('task_type') != 'live':
         return False, "Not a live task"
+    apply_live_transitions(task)
     if task['live_status'] != 'not_started':
         return False, "Task already started or ended"
     task['live_status'] = 'running'
@@ -241,19 +292,23 @@ def start_live_task(task_id, duration=None, user_email=None):
         'duration': 0
     }
     add_to_history(task, 'live_started', current_email, f"duration: {duration}")
-    save_data(TASKS_FILE, tasks)
+    save_task(task_id, task)
+    current_transaction().after_commit(lambda: presence.open(task_id, task))
+    publish(task_members(task), 'live_status', task_id=task_id, live_status='running', start_time=task['start_time'])
     return True, f"Live task started (duration: {duration} mins if set)"
 
+@transactional
 def stop_live_task(task_id, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
     if task['owner'] != current_email:
         return False, "Only owner can stop live task"
+    presence.merge_into(task_id, task)
+    apply_live_transitions(task)
     if task.get('task_type') != 'live' or task['live_status'] != 'running':
         return False, "Task not running"
     task['live_status'] = 'ended'
@@ -266,178 +321,402 @@ def stop_live_task(task_id, user_email=None):
             p['left'] = str(left_ts)
             p['duration'] = (left_ts - joined).total_seconds()
     add_to_history(task, 'live_stopped', current_email)
-    save_data(TASKS_FILE, tasks)
+    save_task(task_id, task)
+    current_transaction().after_commit(lambda: presence.close(task_id))
+    publish(task_members(task), 'live_status', task_id=task_id, live_status='ended', start_time=task['start_time'])
     return True, "Live task stopped"
 
+@transactional
 def checkin_live_task(task_id, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    # the stored task, with participants still in memory
+    task = presence.current(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
+    apply_live_transitions(task)
     if task.get('task_type') != 'live' or task['live_status'] != 'running':
         return False, "Live task not active"
     if current_email == task['owner']:
         return False, "Owner cannot checkin"
-    if current_email not in task.get('participants', {}):
-        task.setdefault('participants', {})[current_email] = {
-            'joined': str(datetime.now()),
-            'left': None,
-            'duration': 0
-        }
-    save_data(TASKS_FILE, tasks)
+    if presence.active:
+        presence.join(task_id, task, current_email, datetime.now())
+    else:
+        if current_email not in task.get('participants', {}):
+            task.setdefault('participants', {})[current_email] = {
+                'joined': str(datetime.now()),
+                'left': None,
+                'duration': 0
+            }
+        save_task(task_id, task)
+    publish(task_members(task), 'participant', task_id=task_id, user=current_email, action='joined', duration=0)
     return True, f"Checked in to live task as participant"
 
+@transactional
 def leave_live_task(task_id, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = presence.current(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
+    apply_live_transitions(task)
     if task.get('task_type') != 'live' or task['live_status'] != 'running':
         return False, "Live task not active"
     if current_email not in task.get('participants', {}):
         return False, "Not participating"
     now = datetime.now()
-    p = task['participants'][current_email]
-    if p['left'] is None:
-        joined = datetime.fromisoformat(p['joined'])
-        p['left'] = str(now)
-        p['duration'] = (now - joined).total_seconds()
-    save_data(TASKS_FILE, tasks)
+    if presence.active:
+        p = presence.leave(task_id, task, current_email, now)
+        if p is None:
+            return False, "Not participating"
+    else:
+        p = task['participants'][current_email]
+        if p['left'] is None:
+            joined = datetime.fromisoformat(p['joined'])
+            p['left'] = str(now)
+            p['duration'] = (now - joined).total_seconds()
+        save_task(task_id, task)
+    publish(task_members(task), 'participant', task_id=task_id, user=current_email, action='left', duration=int(p['duration']))
     return True, f"Left live task (duration: {int(p['duration'])} secs)"
 
+def _live_view(task_id, task):
+    # participants still in memory and transitions the scheduler has not persisted yet, on this copy only
+    if task.get('task_type') == 'live':
+        presence.merge_into(task_id, task)
+        apply_live_transitions(task)
+
 def get_live_status(task_id, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first", {}
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = presence.current(task_id)
+    if task is None:
         return False, "Task not found", {}
-    task = tasks[task_id]
     if task.get('task_type') != 'live':
         return False, "Not a live task", {}
-    # Auto-start for preconfigured if time passed
-    if task.get('live_mode') == 'preconfigured' and task.get('start_time') and task['live_status'] == 'not_started':
-        start = datetime.fromisoformat(task['start_time'])
-        if datetime.now() >= start:
-            task['live_status'] = 'running'
-            # auto join owner
-            task.setdefault('participants', {})[task['owner']] = {
-                'joined': str(datetime.now()),
-                'left': None,
-                'duration': 0
-            }
-            save_data(TASKS_FILE, tasks)
-    # Auto-end if duration exceeded
-    if task['live_status'] == 'running' and task['duration'] is not None and task['start_time'] and task['duration'] > 0:
-        start = datetime.fromisoformat(task['start_time'])
-        elapsed = (datetime.now() - start).total_seconds() / 60
-        if elapsed > task['duration']:
-            task['live_status'] = 'ended'
-            # End participants
-            now = datetime.now()
-            for email, p in task.get('participants', {}).items():
-                if p['left'] is None:
-                    joined = datetime.fromisoformat(p['joined'])
-                    p['left'] = str(now)
-                    p['duration'] = (now - joined).total_seconds()
-            save_data(TASKS_FILE, tasks)
+    apply_live_transitions(task)
+    now = datetime.now()
+    participants = task.get('participants', {})
+    for p in participants.values():
+        if p['left'] is None and task['live_status'] == 'running':
+            p['duration'] = max((now - datetime.fromisoformat(p['joined'])).total_seconds(), 0)
     status = {
         'live_status': task['live_status'],
         'start_time': task.get('start_time'),
         'duration': task.get('duration'),
-        'participants': task.get('participants', {}),
+        'participants': participants,
         'absent': [u for u in task.get('shared_with', []) + [task['owner']] if u not in task.get('participants', {}) and u != task['owner']]
     }
     return True, "Live status retrieved", status
 
-def list_tasks(show_shared=False, user_email=None):
+def _can_view(task, email):
+    return email == task['owner'] or email in task.get('shared_with', [])
+
+def get_task(task_id, user_email=None):
+    """One task by id if the user owns it or it is shared with them; read-only."""
+    current_email = user_email or get_current_user()
+    if not current_email:
+        return False, "Please login first", None
+    task = load_task(task_id)
+    if task is None or not _can_view(task, current_email):
+        return False, "Task not found", None
+    _live_view(task_id, task)
+    return True, "Task found", task
+
+def _window_start(start):
+    return parse_day(start) if start else datetime.now().date()
+
+def list_tasks(show_shared=False, user_email=None, window_days=None):
+    """The user's tasks; with window_days each carries its 'occurrences' from today over that many days."""
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first", []
-    check_due_date_notifications(current_email)
-    tasks = load_data(TASKS_FILE)
+    if window_days is not None and not 1 <= window_days <= OCCURRENCE_WINDOW_MAX:
+        return False, f"window must be between 1 and {OCCURRENCE_WINDOW_MAX} days", []
+    today = datetime.now().date()
     user_tasks = []
-    for tid, task in tasks.items():
-        if task['owner'] == current_email or current_email in task.get('shared_with', []):
-            # trigger auto for live (pre/start/end)
-            if task.get('task_type') == 'live':
-                if task.get('live_mode') == 'preconfigured' and task.get('start_time') and task.get('live_status') == 'not_started':
-                    start = datetime.fromisoformat(task['start_time'])
-                    if datetime.now() >= start:
-                        task['live_status'] = 'running'
-                        task.setdefault('participants', {})[task['owner']] = {'joined': str(datetime.now()), 'left': None, 'duration': 0}
-                if task['live_status'] == 'running' and task['duration'] is not None and task['start_time'] and task['duration'] > 0:
-                    start = datetime.fromisoformat(task['start_time'])
-                    elapsed = (datetime.now() - start).total_seconds() / 60
-                    if elapsed > task['duration']:
-                        task['live_status'] = 'ended'
-                        now = datetime.now()
-                        for email, p in task.get('participants', {}).items():
-                            if p['left'] is None:
-                                joined = datetime.fromisoformat(p['joined'])
-                                p['left'] = str(now)
-                                p['duration'] = (now - joined).total_seconds()
-                save_data(TASKS_FILE, tasks)
-            user_tasks.append((tid, task))
+    for tid, task in tasks_for_user(current_email):
+        _live_view(tid, task)
+        if window_days is not None:
+            task['occurrences'] = occurrences_in_window(task, today, window_days)
+        user_tasks.append((tid, task))
     return True, "Tasks listed", user_tasks
 
+def list_occurrences(user_email=None, start=None, days=OCCURRENCE_WINDOW_DAYS):
+    """Occurrences of the user's tasks from start (YYYY-MM-DD, default today) over days, by date then task id.
+
+    Recurring tasks are expanded lazily over the window only; one-time tasks appear on their due date.
+    """
+    current_email = user_email or get_current_user()
+    if not current_email:
+        return False, "Please login first", []
+    window_start = _window_start(start)
+    if window_start is None:
+        return False, "start must be a date (YYYY-MM-DD)", []
+    if not 1 <= days <= OCCURRENCE_WINDOW_MAX:
+        return False, f"days must be between 1 and {OCCURRENCE_WINDOW_MAX}", []
+    occurrences = []
+    for tid, task in iter_tasks(current_email):
+        for occurrence in occurrences_in_window(task, window_start, days):
+            occurrences.append(dict(occurrence, task_id=tid, title=task['title'], recurring=is_recurring(task)))
+    occurrences.sort(key=lambda o: (o['date'], int(o['task_id'])))
+    return True, f"{len(occurrences)} occurrences from {window_start} over {days} days", occurrences
+
+TASK_RELATIONS = ('owned', 'shared', 'pending')
+TASK_PAGE_MAX = 500
+
+def _encode_cursor(sort, desc, key):
+    return base64.urlsafe_b64encode(json.dumps([sort, desc, key[0], key[1]]).encode()).decode()
+
+def _decode_cursor(cursor, sort, desc):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        return None
+    # anything but what _encode_cursor writes is rejected like an undecodable cursor
+    if not isinstance(decoded, list) or len(decoded) != 4:
+        return None
+    c_sort, c_desc, value, num = decoded
+    if c_sort != sort or c_desc != desc or not isinstance(value, str) or type(num) is not int:
+        return None
+    return (value, num)
+
+def list_tasks_page(user_email=None, relation=None, filters=None, sort='id', desc=False, cursor=None, limit=50):
+    """One page of the user's tasks; returns (success, msg, tasks, next_cursor or None)."""
+    current_email = user_email or get_current_user()
+    if not current_email:
+        return False, "Please login first", [], None
+    if relation is not None and relation not in TASK_RELATIONS:
+        return False, f"relation must be one of: {', '.join(TASK_RELATIONS)}", [], None
+    if sort not in TASK_SORT_FIELDS:
+        return False, f"sort must be one of: {', '.join(TASK_SORT_FIELDS)}", [], None
+    if not 1 <= limit <= TASK_PAGE_MAX:
+        return False, f"limit must be between 1 and {TASK_PAGE_MAX}", [], None
+    filters = {k: v for k, v in (filters or {}).items() if k in TASK_FILTER_FIELDS + ('due_from', 'due_to') and v}
+    after = None
+    if cursor:
+        after = _decode_cursor(cursor, sort, desc)
+        if after is None:
+            return False, "Invalid cursor", [], None
+    page = query_tasks(current_email, relation, filters, sort, desc, after, limit + 1)
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        tid, task = page[-1]
+        next_cursor = _encode_cursor(sort, desc, ('' if sort == 'id' else task.get(sort) or '', int(tid)))
+    for tid, task in page:
+        _live_view(tid, task)
+    return True, "Tasks listed", page, next_cursor
+
+def get_task_log(task_id, field, user_email=None, before=None, limit=TASK_LOG_PAGE):
+    """Newest-first page of a visible task's comments or history; returns (success, msg, entries, next_before)."""
+    current_email = user_email or get_current_user()
+    if not current_email:
+        return False, "Please login first", [], None
+    if field not in TASK_LOG_FIELDS:
+        return False, f"Unknown log: {field}", [], None
+    task = load_task(task_id)
+    if task is None or not _can_view(task, current_email):
+        return False, "Task not found", [], None
+    entries, next_before = task_log_page(task_id, task, field, before, limit)
+    return True, f"{field.capitalize()} listed", entries, next_before
+
+STATS_SCOPES = ('mine', 'all')
+
+def get_stats(user_email=None, scope='mine', filters=None):
+    """Task counts by master status, category and type, over the user's tasks (owned or shared,
+    pending included) or all tasks, optionally narrowed by those same fields. Read from the
+    aggregates kept up to date as tasks are written, so the cost does not grow with the task count.
+    """
+    current_email = user_email or get_current_user()
+    if not current_email:
+        return False, "Please login first", {}
+    if scope not in STATS_SCOPES:
+        return False, f"scope must be one of: {', '.join(STATS_SCOPES)}", {}
+    filters = {k: v for k, v in (filters or {}).items() if k in TASK_STAT_FIELDS and v}
+    stats = {'total': 0}
+    stats.update({field: {} for field in TASK_STAT_FIELDS})
+    for key, count in task_stats(None if scope == 'all' else current_email).items():
+        values = dict(zip(TASK_STAT_FIELDS, json.loads(key)))
+        if any(values[k] != v for k, v in filters.items()):
+            continue
+        stats['total'] += count
+        for field, value in values.items():
+            stats[field][value] = stats[field].get(value, 0) + count
+    return True, "Stats computed", stats
+
+REPORT_FORMATS = ('text', 'csv', 'ndjson')
+REPORT_CACHE_BYTES = int(os.environ.get('SHARETASK_REPORT_CACHE_BYTES', 32 * 1024 * 1024))
+REPORT_BATCH = 500
+
+class ReportCache:
+    """Rendered report fragments per (format, task), LRU-evicted once they pass max_bytes.
+
+    A fragment is reused while the task's version (bumped by every committed
+    write) and live status (which the scheduler can advance on read) are unchanged.
+    """
+
+    def __init__(self, max_bytes=REPORT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, fmt, tid, stamp):
+        key = (fmt, tid)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, fmt, tid, stamp, text):
+        key = (fmt, tid)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self._entries[key] = (stamp, text)
+            self.bytes += len(text)
+            while self.bytes > self.max_bytes and self._entries:
+                self.bytes -= len(self._entries.popitem(last=False)[1][1])
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                    'entries': len(self._entries), 'bytes': self.bytes, 'evictions': self.evictions}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = self.hits = self.misses = self.evictions = 0
+
+report_cache = ReportCache()
+
+def _report_text(tid, task):
+    lines = [f"Task ID: {tid} - {task['title']} (Owner: {task['owner']}, Master: {task.get('master_status', 'To Do')})", "Statuses:"]
+    lines += [f"  {user}: {stat}" for user, stat in task['statuses'].items()]
+    if task.get('occurrences') is not None:
+        lines.append(f"Upcoming ({task['frequency']}): " + ', '.join(f"{o['date']} {o['master_status']}" for o in task['occurrences']))
+    lines.append("Comments:")
+    lines += [f"  {c['user']} @ {c['timestamp']}: {c['comment']}" for c in task.get('comments', [])]
+    if task.get('task_type') == 'live':
+        lines.append(f"Live Status: {task.get('live_status')}")
+    lines.append("---\n")
+    return "\n".join(lines)
+
+def _report_csv(rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+def _report_csv_rows(tid, task):
+    comments_str = '; '.join(f"{c['user']}: {c['comment']}" for c in task.get('comments', []))
+    occurrences = task.get('occurrences') or []
+    return [[tid, task['title'], task['owner'], task.get('master_status', 'To Do'), user, stat, comments_str, task.get('live_status', ''),
+             '; '.join(f"{o['date']}: {o['statuses'].get(user, '')}" for o in occurrences)]
+            for user, stat in task['statuses'].items()]
+
+def _report_record(tid, task):
+    return json.dumps({
+        'id': tid,
+        'title': task['title'],
+        'owner': task['owner'],
+        'master_status': task.get('master_status', 'To Do'),
+        'statuses': task['statuses'],
+        'comments': task.get('comments', []),
+        'live_status': task.get('live_status'),
+        'occurrences': task.get('occurrences')
+    }, default=str) + "\n"
+
+def iter_report(user_email=None, fmt='text'):
+    """Report chunks one task at a time (all tasks, or those visible to user_email); recurring
+    tasks list their occurrences over the next OCCURRENCE_WINDOW_DAYS."""
+    if fmt not in REPORT_FORMATS:
+        raise ValueError(f"Unknown report format: {fmt}")
+    if fmt == 'text':
+        yield "Task Status Report (as of " + str(datetime.now()) + ")\n\n"
+    elif fmt == 'csv':
+        yield _report_csv([['Task ID', 'Title', 'Owner', 'Master Status', 'User', 'User Status', 'Comments', 'Live Status', 'Upcoming']])
+    formatter = {'text': _report_text, 'csv': lambda tid, task: _report_csv(_report_csv_rows(tid, task)), 'ndjson': _report_record}[fmt]
+
+    today = datetime.now().date()
+    day = today.isoformat()
+
+    def render(tid, task):
+        # comments are only read for the tasks actually rendered
+        task['comments'] = task_log(tid, task, 'comments')
+        if is_recurring(task):
+            task['occurrences'] = occurrences_in_window(task, today)
+        return formatter(tid, task)
+    tx = current_transaction()
+    if tx is not None and tx.tasks:
+        # staged changes are not reflected in the versions yet
+        for tid, task in iter_tasks(user_email):
+            apply_live_transitions(task)
+            yield render(tid, task)
+        return
+    stamps = task_stamps(user_email)
+    for start in range(0, len(stamps), REPORT_BATCH):
+        batch = stamps[start:start + REPORT_BATCH]
+        # live tasks are always loaded: their status can move on without a new version;
+        # fragments are keyed on the day too, as the occurrence window moves with it
+        cached = {tid: report_cache.get(fmt, tid, (version, None, day)) for tid, version, live in batch if not live}
+        tasks = load_task_batch([tid for tid, version, live in batch if cached.get(tid) is None])
+        for tid, version, live in batch:
+            if cached.get(tid) is not None:
+                yield cached[tid]
+            elif tid in tasks:
+                task = tasks[tid]
+                stamp = (task.get('version', 0), None, day)
+                if live:
+                    apply_live_transitions(task)
+                    stamp = (stamp[0], task.get('live_status'), day)
+                    text = report_cache.get(fmt, tid, stamp)
+                    if text is not None:
+                        yield text
+                        continue
+                text = render(tid, task)
+                report_cache.put(fmt, tid, stamp, text)
+                yield text
+
 def generate_report(user_email=None):
-    tasks = load_data(TASKS_FILE)
-    report = "Task Status Report (as of " + str(datetime.now()) + ")\n\n"
-    filtered_tasks = {}
-    for tid, task in tasks.items():
-        if user_email is None or task['owner'] == user_email or user_email in task.get('shared_with', []):
-            filtered_tasks[tid] = task
-            report += f"Task ID: {tid} - {task['title']} (Owner: {task['owner']}, Master: {task.get('master_status', 'To Do')})\n"
-            report += "Statuses:\n"
-            for user, stat in task['statuses'].items():
-                report += f"  {user}: {stat}\n"
-            report += "Comments:\n"
-            for c in task.get('comments', []):
-                report += f"  {c['user']} @ {c['timestamp']}: {c['comment']}\n"
-            if task.get('task_type') == 'live':
-                report += f"Live Status: {task.get('live_status')}\n"
-            report += "---\n"
-    with open('data/task_report.txt', 'w') as f:
-        f.write(report)
-    with open('data/task_report.csv', 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['Task ID', 'Title', 'Owner', 'Master Status', 'User', 'User Status', 'Comments', 'Live Status'])
-        for tid, task in filtered_tasks.items():
-            live_stat = task.get('live_status', '')
-            for user, stat in task['statuses'].items():
-                comments_str = '; '.join([f"{c['user']}: {c['comment']}" for c in task.get('comments', [])])
-                writer.writerow([tid, task['title'], task['owner'], task.get('master_status', 'To Do'), user, stat, comments_str, live_stat])
-    print("Report generated and 'emailed' (saved to data/task_report.txt). Excel CSV report ready for download (data/task_report.csv)")
-    return True, report
+    return True, ''.join(iter_report(user_email))
 
+def report_cache_stats():
+    return report_cache.stats()
+
+@transactional
 def delete_task(task_id, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    if tasks[task_id]['owner'] != current_email:
+    if task['owner'] != current_email:
         return False, "Only owner can delete task"
-    del tasks[task_id]
-    save_data(TASKS_FILE, tasks)
+    remove_task(task_id)
     return True, "Task deleted"
 
+@transactional
 def reclaim_task(task_id, user_email=None):
     current_email = user_email or get_current_user()
     if not current_email:
         return False, "Please login first"
-    tasks = load_data(TASKS_FILE)
-    if task_id not in tasks:
+    task = load_task(task_id)
+    if task is None:
         return False, "Task not found"
-    task = tasks[task_id]
     if task['owner'] != current_email or task.get('category') != 'assignment':
         return False, "Only owner can reclaim assignment task"
     if task.get('shared_with'):
@@ -446,40 +725,56 @@ def reclaim_task(task_id, user_email=None):
         if assignee_stat == 'In Progress':
             return False, "Cannot reclaim assignment task in In Progress"
         task['shared_with'].remove(assignee)
-        if assignee in task['statuses']:
-            del task['statuses'][assignee]
-    task['statuses'][current_email] = 'To Do'
+        set_user_status(task, assignee, None)
+    set_user_status(task, current_email, 'To Do')
     add_to_history(task, 'reclaimed', current_email, 'Task reclaimed from assignee')
-    save_data(TASKS_FILE, tasks)
+    save_task(task_id, task)
     return True, "Task reclaimed by owner"
 
-def check_due_date_notifications(user_email=None):
+# op name -> (function, required fields, optional fields), each called as fn(task_id, *fields, user_email=...);
+# every field is a string
+BATCH_OPERATIONS = {
+    'status': (update_task_status, ('status',), ()),
+    'occurrence': (update_occurrence_status, ('date', 'status'), ()),
+    'share': (share_task, ('email',), ('context',)),
+    'revoke': (revoke_share, ('email',), ()),
+    'comment': (add_comment, ('comment',), ()),
+    'accept': (accept_shared_task, (), ()),
+    'reject': (reject_shared_task, (), ('reason',)),
+}
+BATCH_MAX = 1000
+
+@transactional
+def apply_batch(operations, user_email=None):
+    """Apply many operations in one transaction: each sees the ones before it, all are committed in
+    one write and notifications go out once per recipient. Returns (success, msg, per-operation results).
+    """
     current_email = user_email or get_current_user()
     if not current_email:
-        return
-    tasks = load_data(TASKS_FILE)
-    today = datetime.now().date()
-    for tid, task in tasks.items():
-        if current_email != task.get('owner'):
-            if current_email not in task.get('statuses', {}) or task.get('statuses', {}).get(current_email) == 'Pending':
-                continue
-        try:
-            due_str = task.get('due_date')
-            if not due_str:
-                continue
-            due = datetime.strptime(due_str, '%Y-%m-%d').date()
-            days_left = (due - today).days
-            if days_left < 0:
-                msg = f"Critical: Task overdue - {task['title']} (ID:{tid})"
-                ntype = 'critical'
-            elif days_left <= 3:
-                msg = f"Warning: Task due soon ({days_left} days) - {task['title']} (ID:{tid})"
-                ntype = 'warning'
+        return False, "Please login first", []
+    if not isinstance(operations, list) or not operations:
+        return False, "operations must be a non-empty list", []
+    if len(operations) > BATCH_MAX:
+        return False, f"At most {BATCH_MAX} operations per batch", []
+    results = []
+    for op in operations:
+        name = op.get('op') if isinstance(op, dict) and isinstance(op.get('op'), str) else None
+        task_id = str(op.get('task_id', '')) if isinstance(op, dict) else ''
+        if name not in BATCH_OPERATIONS:
+            success, msg = False, f"op must be one of: {', '.join(BATCH_OPERATIONS)}"
+        elif not task_id:
+            success, msg = False, "Missing task_id"
+        else:
+            fn, required, optional = BATCH_OPERATIONS[name]
+            missing = [field for field in required if not op.get(field)]
+            # checked before the op runs, so a bad value fails only its own entry and changes nothing
+            invalid = [field for field in required + optional if op.get(field) is not None and not isinstance(op[field], str)]
+            if missing:
+                success, msg = False, f"Missing {', '.join(missing)}"
+            elif invalid:
+                success, msg = False, f"{', '.join(invalid)} must be a string"
             else:
-                continue
-            users = load_data(USERS_FILE)
-            notifs = users.get(current_email, {}).get('notifications', [])
-            if not any(n.get('message') == msg for n in notifs[-5:]):
-                add_notification(current_email, msg, ntype, tid)
-        except:
-            continue
+                success, msg = fn(task_id, *[op.get(field) for field in required + optional], user_email=current_email)
+        results.append({'op': name, 'task_id': task_id, 'success': success, 'message': msg})
+    applied = sum(r['success'] for r in results)
+    return True, f"{applied} of {len(results)} operations applied", results
@@ -0,0 +1,130 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# shared by every worker process, independent of SHARETASK_STORAGE
+TOKENS_DB = os.environ.get('SHARETASK_TOKENS_DB', 'data/tokens.db')
+TOKEN_TTL = float(os.environ.get('SHARETASK_TOKEN_TTL', 24 * 3600))
+TOKEN_SWEEP_INTERVAL = 60
+TOKEN_CACHE_SIZE = 10000
+# how long a worker trusts its cached entry; bounds how late it notices a token replaced elsewhere
+TOKEN_CACHE_TTL = 5
+
+TOKENS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tokens_email ON tokens (email);
+CREATE INDEX IF NOT EXISTS idx_tokens_expires_at ON tokens (expires_at);
+'''
+
+class TokenStore:
+    """API tokens keyed by token in a SQLite file, with an LRU of recent lookups in front.
+
+    A user holds one token at a time: logging in again replaces the old one.
+    Expired tokens are rejected on lookup and deleted by sweep(), which issue()
+    runs at most every TOKEN_SWEEP_INTERVAL seconds.
+    """
+
+    def __init__(self, db_file=TOKENS_DB, ttl=TOKEN_TTL, cache_size=TOKEN_CACHE_SIZE):
+        self.db_file = db_file
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._cache = OrderedDict()  # token -> (email, expires_at, cached_at)
+        self._cached_tokens = {}  # email -> token in _cache
+        self._cache_lock = threading.Lock()
+        self._last_sweep = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_file) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(TOKENS_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _cache_get(self, token, now):
+        with self._cache_lock:
+            entry = self._cache.get(token)
+            if entry is None:
+                return None
+            if entry[2] < now - TOKEN_CACHE_TTL:
+                self._evict(token)
+                return None
+            self._cache.move_to_end(token)
+            return entry
+
+    def _evict(self, token):
+        # called with _cache_lock held
+        entry = self._cache.pop(token, None)
+        if entry is not None and self._cached_tokens.get(entry[0]) == token:
+            del self._cached_tokens[entry[0]]
+
+    def _cache_put(self, token, email, expires_at, now):
+        with self._cache_lock:
+            self._cache[token] = (email, expires_at, now)
+            self._cache.move_to_end(token)
+            self._cached_tokens[email] = token
+            while len(self._cache) > self.cache_size:
+                self._evict(next(iter(self._cache)))
+
+    def _cache_drop(self, email=None, token=None):
+        with self._cache_lock:
+            if token is not None:
+                self._evict(token)
+            if email is not None and email in self._cached_tokens:
+                self._evict(self._cached_tokens[email])
+
+    def issue(self, email):
+        now = time.time()
+        token = str(uuid.uuid4())
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM tokens WHERE email = ?', (email,))
+            conn.execute('INSERT INTO tokens (token, email, expires_at) VALUES (?, ?, ?)', (token, email, now + self.ttl))
+        self._cache_drop(email=email)
+        if now - self._last_sweep > TOKEN_SWEEP_INTERVAL:
+            self.sweep(now)
+        return token
+
+    def lookup(self, token):
+        """Email the token belongs to, or None if it is unknown or expired."""
+        now = time.time()
+        entry = self._cache_get(token, now)
+        if entry is None:
+            row = self._conn().execute('SELECT email, expires_at FROM tokens WHERE token = ?', (token,)).fetchone()
+            if row is None:
+                return None
+            self._cache_put(token, row[0], row[1], now)
+            entry = row
+        if entry[1] <= now:
+            self.revoke(token)
+            return None
+        return entry[0]
+
+    def revoke(self, token):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM tokens WHERE token = ?', (token,))
+        self._cache_drop(token=token)
+
+    def sweep(self, now=None):
+        """Delete expired tokens; returns how many."""
+        now = now or time.time()
+        self._last_sweep = now
+        conn = self._conn()
+        with conn:
+            count = conn.execute('DELETE FROM tokens WHERE expires_at <= ?', (now,)).rowcount
+        with self._cache_lock:
+            for stale in [t for t, entry in self._cache.items() if entry[1] <= now]:
+                self._evict(stale)
+        return count
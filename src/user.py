@@ -1,26 +1,109 @@
-from src.utils import load_data, save_data, hash_password, USERS_FILE, set_current_user, get_current_user, validate_email, validate_password
+from src.utils import load_user, save_user, hash_password, set_current_user, get_current_user, validate_email, validate_password, transactional, current_transaction, load_mailbox, update_mailbox
 from datetime import datetime
+from src.events import hub
 
+NOTIFICATION_CAP = 20
+
+class NotificationStore:
+    """Per-user mailboxes kept apart from the user records.
+
+    A mailbox is {'items': [...], 'seq': last id, 'read_upto': seq, 'unread': n}:
+    a ring buffer of the newest NOTIFICATION_CAP notifications in timestamp order
+    plus an unread counter kept up to date on every change. An item is read if
+    it is flagged or its seq is <= read_upto, so mark-all-read only moves read_upto.
+    """
+
+    def _mailbox(self, email):
+        mailbox = load_mailbox(email)
+        if mailbox is None:
+            # users registered before the store existed keep their notifications in the user record
+            mailbox = update_mailbox(email, self._seed(email))
+        return mailbox
+
+    def _seed(self, email):
+        def seed(mailbox):
+            if mailbox is not None:
+                return mailbox
+            mailbox = {'items': [], 'seq': 0, 'read_upto': 0, 'unread': 0}
+            legacy = ((load_user(email) or {}).get('notifications') or [])[-NOTIFICATION_CAP:]
+            for n in sorted(legacy, key=lambda x: x.get('timestamp', '')):
+                mailbox['seq'] += 1
+                mailbox['items'].append(dict(n, seq=mailbox['seq']))
+                mailbox['unread'] += not n.get('read', True)
+            return mailbox
+        return seed
+
+    def _is_read(self, mailbox, n):
+        return n.get('read', False) or n['seq'] <= mailbox['read_upto']
+
+    def add(self, email, *notifs):
+        def append(mailbox):
+            mailbox = self._seed(email)(mailbox)
+            for notif in notifs:
+                mailbox['seq'] += 1
+                mailbox['items'].append(dict(notif, seq=mailbox['seq']))
+            mailbox['unread'] += len(notifs)
+            for n in mailbox['items'][:-NOTIFICATION_CAP]:
+                if not self._is_read(mailbox, n):
+                    mailbox['unread'] -= 1
+            mailbox['items'] = mailbox['items'][-NOTIFICATION_CAP:]
+            return mailbox
+        return update_mailbox(email, append)['unread']
+
+    def badge(self, email):
+        """(notifications newest first with 'read' resolved, unread count) from one mailbox read."""
+        mailbox = self._mailbox(email)
+        return [dict(n, read=self._is_read(mailbox, n)) for n in reversed(mailbox['items'])], mailbox['unread']
+
+    def list(self, email):
+        return self.badge(email)[0]
+
+    def unread_count(self, email):
+        return self._mailbox(email)['unread']
+
+    def mark_read(self, email, notif_id):
+        found = []
+        def mark(mailbox):
+            mailbox = self._seed(email)(mailbox)
+            for n in mailbox['items']:
+                if n.get('id') == notif_id:
+                    found.append(n)
+                    if not self._is_read(mailbox, n):
+                        n['read'] = True
+                        mailbox['unread'] -= 1
+                    break
+            return mailbox
+        update_mailbox(email, mark)
+        return bool(found)
+
+    def mark_all_read(self, email):
+        def mark(mailbox):
+            mailbox = self._seed(email)(mailbox)
+            mailbox['read_upto'] = mailbox['seq']
+            mailbox['unread'] = 0
+            return mailbox
+        return update_mailbox(email, mark)['seq'] > 0
+
+notifications = NotificationStore()
+
+@transactional
 def register_user(email, password, name):
     if not validate_email(email):
         return False, "Invalid email format"
     if not validate_password(password):
         return False, "Password must be at least 10 chars, include uppercase, number, and special char"
-    users = load_data(USERS_FILE)
-    if email in users:
+    if load_user(email) is not None:
         return False, "User already exists"
-    users[email] = {
+    save_user(email, {
         'name': name,
         'password_hash': hash_password(password),
-        'registered_at': str(datetime.now()),
-        'notifications': []
-    }
-    save_data(USERS_FILE, users)
+        'registered_at': str(datetime.now())
+    })
     return True, "User registered successfully"
 
 def login_user(email, password, set_session=True):
-    users = load_data(USERS_FILE)
-    if email in users and users[email]['password_hash'] == hash_password(password):
+    user = load_user(email)
+    if user and user['password_hash'] == hash_password(password):
         if set_session:
             current = get_current_user()
             if current and current != email:
@@ -34,15 +117,12 @@ def login_user(email, password, set_session=True):
     return False, "Invalid credentials"
 
 def get_user_by_email(email):
-    users = load_data(USERS_FILE)
-    return users.get(email)
+    return load_user(email)
 
+@transactional
 def add_notification(user_email, message, notif_type='info', task_id=None):
-    users = load_data(USERS_FILE)
-    if user_email not in users:
+    if load_user(user_email) is None:
         return False, "User not found"
-    if 'notifications' not in users[user_email]:
-        users[user_email]['notifications'] = []
     notif = {
         'id': str(datetime.now()),
         'message': message,
@@ -51,25 +131,33 @@ def add_notification(user_email, message, notif_type='info', task_id=None):
         'read': False,
         'task_id': task_id
     }
-    users[user_email]['notifications'].append(notif)
-    users[user_email]['notifications'] = users[user_email]['notifications'][-20:]
-    save_data(USERS_FILE, users)
+    # delivered only if the surrounding unit of work commits, and once even if it is retried;
+    # everything a transaction sends one user lands in a single mailbox write
+    tx = current_transaction()
+    if not tx.outbox:
+        tx.after_commit(lambda: deliver_notifications(tx.outbox))
+    tx.outbox.setdefault(user_email, []).append(notif)
     return True, "Notification added"
 
+def deliver_notifications(outbox):
+    for email, notifs in outbox.items():
+        unread = notifications.add(email, *notifs)
+        for notif in notifs:
+            hub.publish([email], 'notification', {'message': notif['message'], 'type': notif['type'],
+                                                  'task_id': notif['task_id'], 'unread': unread})
+
 def get_notifications(user_email):
-    users = load_data(USERS_FILE)
-    user = users.get(user_email, {})
-    notifs = user.get('notifications', [])
-    notifs.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-    return notifs
+    return notifications.list(user_email)
+
+def notification_badge(user_email):
+    return notifications.badge(user_email)
 
 def mark_notification_read(user_email, notif_id):
-    users = load_data(USERS_FILE)
-    if user_email not in users or 'notifications' not in users[user_email]:
-        return False, "No notifications"
-    for n in users[user_email]['notifications']:
-        if n.get('id') == notif_id:
-            n['read'] = True
-            save_data(USERS_FILE, users)
-            return True, "Marked read"
+    if notifications.mark_read(user_email, notif_id):
+        return True, "Marked read"
     return False, "Notification not found"
+
+def mark_all_notifications_read(user_email):
+    if notifications.mark_all_read(user_email):
+        return True, "All marked read"
+    return False, "No notifications"
@@ -1,25 +1,1560 @@
+import atexit
 import json
 import hashlib
 import os
 import re
 import fcntl
+import sqlite3
+import threading
+import contextlib
+import heapq
+import marshal
+import pickle
+import struct
+import random
+import time
+import traceback
+from urllib.parse import quote
+from functools import wraps
 from datetime import datetime
+from src.metrics import metrics
 
 USERS_FILE = 'data/users.json'
 TASKS_FILE = 'data/tasks.json'
+DB_FILE = os.environ.get('SHARETASK_DB', 'data/sharetask.db')
+# 'json' keeps everything in data/*.json, 'journal' appends task mutations to TASKS_LOG
+# on top of the tasks.json snapshot, 'sqlite' keeps tasks and users in DB_FILE
+STORAGE_BACKEND = os.environ.get('SHARETASK_STORAGE', 'json')
+# on-disk encoding of the users/tasks files: 'pretty' (indented JSON), 'compact' JSON,
+# or length-prefixed binary 'marshal' / 'pickle' (protocol 5); reads detect the format
+DATA_FORMAT = os.environ.get('SHARETASK_FORMAT', 'pretty')
+DATA_FORMATS = ('pretty', 'compact', 'marshal', 'pickle')
+BINARY_HEADER = struct.Struct('>4sBQ')  # magic, format code, payload length
+BINARY_MAGIC = b'STK\x00'
+BINARY_CODES = {'marshal': 1, 'pickle': 2}
+TASK_INDEX_FILE = 'data/task_index.json'
+# the index's stats alone, so stats after another process's write do not reload the whole index
+TASK_STATS_FILE = 'data/task_stats.json'
+# seconds a writer waits before persisting its updated index, so a burst of commits costs one save
+TASK_INDEX_SAVE_DELAY = float(os.environ.get('SHARETASK_INDEX_SAVE_DELAY', 1))
+TASK_SEQ_FILE = 'data/task_seq'
+TASKS_LOG = 'data/tasks.log'
+TASKS_LOCK = 'data/tasks.lock'
+USERS_LOCK = 'data/users.lock'
+# one small file per user mailbox (json/journal), see src/user.py NotificationStore
+NOTIFICATIONS_DIR = 'data/notifications'
+NOTIFICATIONS_LOCK = 'data/notifications.lock'
+# the journal is folded into a new tasks.json snapshot once it passes either limit
+JOURNAL_MAX_BYTES = int(os.environ.get('SHARETASK_JOURNAL_MAX_BYTES', 1024 * 1024))
+JOURNAL_MAX_RECORDS = int(os.environ.get('SHARETASK_JOURNAL_MAX_RECORDS', 1000))
+# optimistic concurrency: a transaction whose records changed underneath it is re-run
+TX_MAX_RETRIES = int(os.environ.get('SHARETASK_TX_MAX_RETRIES', 8))
+TX_BACKOFF = 0.005  # seconds, doubled per attempt with full jitter
+# comment/history entries live in per-task append-only logs, only their counts on the task;
+# a list under these keys holds entries appended since the task was loaded (or, in old
+# records, everything) and is moved to the log when the task is saved
+TASK_LOG_FIELDS = ('comments', 'history')
+TASK_LOG_COUNTS = {'comments': 'comment_count', 'history': 'history_count'}
+TASK_LOG_TABLES = {'comments': 'task_comments', 'history': 'task_history'}
+# one file per task and field for the json/journal backends, one JSON entry per line
+TASK_LOGS_DIR = 'data/task_logs'
+TASK_LOG_PAGE = 20
+TASK_LOG_BLOCK = 64 * 1024
+
+# list queries: sortable fields and fields filtered by equality
+TASK_SORT_FIELDS = ('id', 'title', 'due_date', 'created_at', 'master_status')
+TASK_FILTER_FIELDS = ('master_status', 'category', 'task_type')
+
+# status aggregates are counted per combination of these, over all tasks ('*') and per member
+TASK_STAT_FIELDS = ('master_status', 'category', 'task_type')
+TASK_STAT_DEFAULTS = {'master_status': 'To Do', 'category': 'sharing', 'task_type': 'normal'}
+TASK_STATS_ALL = '*'
+
+# task fields stored in their own tables by the sqlite backend
+TASK_CHILD_FIELDS = ('shared_with', 'statuses', 'comments', 'history')
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    title TEXT NOT NULL,
+    description TEXT,
+    master_status TEXT,
+    due_date TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_owner_title ON tasks (owner, title);
+CREATE INDEX IF NOT EXISTS idx_tasks_description ON tasks (description);
+CREATE INDEX IF NOT EXISTS idx_tasks_owner_due_date ON tasks (owner, due_date);
+CREATE TABLE IF NOT EXISTS task_statuses (
+    task_id TEXT NOT NULL,
+    email TEXT NOT NULL,
+    status TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (task_id, email)
+);
+CREATE INDEX IF NOT EXISTS idx_task_statuses_email ON task_statuses (email);
+CREATE TABLE IF NOT EXISTS task_shares (
+    task_id TEXT NOT NULL,
+    email TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (task_id, email)
+);
+CREATE INDEX IF NOT EXISTS idx_task_shares_email ON task_shares (email);
+CREATE TABLE IF NOT EXISTS task_comments (
+    task_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (task_id, seq)
+);
+CREATE TABLE IF NOT EXISTS task_history (
+    task_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (task_id, seq)
+);
+CREATE TABLE IF NOT EXISTS task_stats (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    name TEXT,
+    password_hash TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mailboxes (
+    email TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+'''
+
+def encode_data(data, fmt=None):
+    fmt = fmt or DATA_FORMAT
+    # a plain dict of the current values: json.dumps would go through CowDict.items() and
+    # deep-copy every task just to read it, and marshal only takes exact builtin types
+    plain = dict.copy(data) if isinstance(data, dict) else data
+    if fmt == 'pretty':
+        return json.dumps(plain, indent=2, default=str).encode()
+    if fmt == 'compact':
+        return json.dumps(plain, separators=(',', ':'), default=str).encode()
+    if fmt not in BINARY_CODES:
+        raise ValueError(f"Unknown data format: {fmt}")
+    body = marshal.dumps(plain) if fmt == 'marshal' else pickle.dumps(plain, protocol=5)
+    return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_CODES[fmt], len(body)) + body
+
+def decode_data(payload):
+    if not payload.startswith(BINARY_MAGIC):
+        return json.loads(payload)
+    _, code, length = BINARY_HEADER.unpack_from(payload)
+    body = memoryview(payload)[BINARY_HEADER.size:]
+    if len(body) != length:
+        raise ValueError(f"Truncated data file: expected {length} bytes, found {len(body)}")
+    return marshal.loads(body) if code == BINARY_CODES['marshal'] else pickle.loads(body)
+
+def clone(value):
+    """Deep copy of JSON-shaped data (dicts, lists, scalars), much cheaper than copy.deepcopy."""
+    if isinstance(value, dict):
+        return {k: clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [clone(v) for v in value]
+    return value
+
+class CowDict(dict):
+    """Private top-level copy of a cached mapping; each value is deep-copied the first time it is accessed."""
+
+    def __init__(self, shared):
+        super().__init__(shared)
+        self._owned = set()
+
+    def _own(self, key):
+        value = dict.__getitem__(self, key)
+        if key not in self._owned:
+            if isinstance(value, (dict, list)):
+                value = clone(value)
+                dict.__setitem__(self, key, value)
+            self._owned.add(key)
+        return value
+
+    def __getitem__(self, key):
+        return self._own(key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._owned.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._owned.discard(key)
+
+    def get(self, key, default=None):
+        return self._own(key) if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self._own(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self._own(key)
+        del self[key]
+        return value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def values(self):
+        return [self._own(k) for k in self]
+
+    def items(self):
+        return [(k, self._own(k)) for k in self]
+
+    def snapshot(self):
+        """Copy safe to share with the cache: untouched values are still the cached originals."""
+        shared = dict.copy(self)
+        for key in self._owned:
+            shared[key] = clone(shared[key])
+        return shared
+
+class DataCache:
+    """Parsed data files shared process-wide, revalidated with os.stat (inode, mtime_ns, size)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_path):
+        start = time.perf_counter()
+        key = os.path.abspath(file_path)
+        sig = _file_signature(file_path)
+        if sig is None:
+            with self._lock:
+                self._entries.pop(key, None)
+            metrics.record_io('load', 0, time.perf_counter() - start)
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == sig:
+                self.hits += 1
+                metrics.record_io('load', 0, time.perf_counter() - start)
+                return entry[1]
+            self.misses += 1
+        with open(file_path, 'rb') as f:
+            # labelled with the file actually read, which may be newer than the one stat'ed above
+            sig = _fd_signature(f.fileno())
+            payload = f.read()
+        parse_start = time.perf_counter()
+        data = decode_data(payload)
+        end = time.perf_counter()
+        metrics.record_io('parse', len(payload), end - parse_start)
+        metrics.record_io('load', len(payload), end - start)
+        with self._lock:
+            self._entries[key] = (sig, data)
+        return data
+
+    def put(self, file_path, data):
+        shared = data.snapshot() if isinstance(data, CowDict) else clone(data)
+        with self._lock:
+            self._entries[os.path.abspath(file_path)] = (_file_signature(file_path), shared)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+data_cache = DataCache()
+
+def _file_signature(file_path):
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _fd_signature(fd):
+    st = os.fstat(fd)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def load_shared(file_path):
+    """Cached parse of file_path; the result is shared and must not be mutated (use load_data for a private copy)."""
+    data = data_cache.get(file_path)
+    return {} if data is None else data
 
 def load_data(file_path):
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as f:
-            return json.load(f)
-    return {}
+    data = data_cache.get(file_path)
+    if data is None:
+        return {}
+    return CowDict(data) if isinstance(data, dict) else clone(data)
 
 def save_data(file_path, data):
-    with open(file_path, 'w') as f:
-        # lock for concurrent task updates to handle race conditions gracefully
-        if TASKS_FILE in file_path:
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-        json.dump(data, f, indent=2, default=str)
+    # swapped in whole so lock-free readers never see a half-written file;
+    # writers serialise on the store's lock file in commit()
+    start = time.perf_counter()
+    payload = encode_data(data)
+    metrics.record_io('encode', len(payload), time.perf_counter() - start)
+    write_file_atomic(file_path, payload)
+    data_cache.put(file_path, data)
+
+def _task_memberships(task):
+    yield task['owner'], 'owned'
+    for email in task.get('shared_with', []):
+        yield email, 'pending' if task.get('statuses', {}).get(email) == 'Pending' else 'shared'
+
+def _task_stat_entries(task):
+    """(scope, key) pairs a task is counted under: all tasks and each member, keyed by
+    its master status, category and type (a JSON list, see task_stats())."""
+    key = json.dumps([task.get(f) or TASK_STAT_DEFAULTS[f] for f in TASK_STAT_FIELDS])
+    return {(scope, key) for scope in [TASK_STATS_ALL, task['owner']] + list(task.get('shared_with', []))}
+
+def _stat_deltas(old, new):
+    before = _task_stat_entries(old) if old else set()
+    after = _task_stat_entries(new) if new else set()
+    return [(entry, -1) for entry in before - after] + [(entry, 1) for entry in after - before]
+
+class TaskIndex:
+    """Secondary indexes over the task store.
+
+    users: {email: {'owned': [...], 'shared': [...], 'pending': [...]}}
+    descriptions: {description: [task ids]}
+    titles: {owner: {title: [task ids]}}
+    stats: {scope: {key: task count}}, see _task_stat_entries()
+    """
+
+    KINDS = ('owned', 'shared', 'pending')
+
+    def __init__(self, users=None, descriptions=None, titles=None, stats=None):
+        self.users = users or {}
+        self.descriptions = descriptions or {}
+        self.titles = titles or {}
+        self.stats = stats or {}
+
+    @classmethod
+    def build(cls, tasks):
+        index = cls()
+        for tid, task in tasks.items():
+            index.update(tid, None, task)
+        return index
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('users'), data.get('descriptions'), data.get('titles'), data.get('stats'))
+
+    def to_dict(self):
+        return {'users': self.users, 'descriptions': self.descriptions, 'titles': self.titles, 'stats': self.stats}
+
+    def update(self, task_id, old, new):
+        before = set(_task_memberships(old)) if old else set()
+        after = set(_task_memberships(new)) if new else set()
+        for email, kind in before - after:
+            ids = self.users.get(email, {}).get(kind, [])
+            if task_id in ids:
+                ids.remove(task_id)
+        for email, kind in after - before:
+            self.users.setdefault(email, {k: [] for k in self.KINDS})[kind].append(task_id)
+        if old and (not new or new.get('description') != old.get('description')):
+            _discard_id(self.descriptions, old.get('description'), task_id)
+        if new and (not old or new.get('description') != old.get('description')):
+            self.descriptions.setdefault(new.get('description'), []).append(task_id)
+        if old and (not new or (new['owner'], new['title']) != (old['owner'], old['title'])):
+            _discard_id(self.titles.get(old['owner'], {}), old['title'], task_id)
+        if new and (not old or (new['owner'], new['title']) != (old['owner'], old['title'])):
+            self.titles.setdefault(new['owner'], {}).setdefault(new['title'], []).append(task_id)
+        for (scope, key), delta in _stat_deltas(old, new):
+            counts = self.stats.setdefault(scope, {})
+            counts[key] = counts.get(key, 0) + delta
+            if counts[key] <= 0:
+                del counts[key]
+                if not counts:
+                    del self.stats[scope]
+
+    def stat_counts(self, scope):
+        return dict(self.stats.get(scope, {}))
+
+    def ids_for(self, email):
+        entry = self.users.get(email, {})
+        return {k: list(entry.get(k, [])) for k in self.KINDS}
+
+    def visible_ids(self, email):
+        entry = self.users.get(email, {})
+        ids = set(entry.get('owned', [])) | set(entry.get('shared', [])) | set(entry.get('pending', []))
+        return sorted(ids, key=int)
+
+    def ids_with_description(self, description):
+        return list(self.descriptions.get(description, []))
+
+    def ids_with_title(self, owner, title):
+        return list(self.titles.get(owner, {}).get(title, []))
+
+def _task_sort_key(tid, task, sort):
+    return ('' if sort == 'id' else task.get(sort) or '', int(tid))
+
+def _task_matches(task, filters):
+    for field in TASK_FILTER_FIELDS:
+        if filters.get(field) is not None and task.get(field) != filters[field]:
+            return False
+    due = task.get('due_date') or ''
+    if filters.get('due_from') and due < filters['due_from']:
+        return False
+    if filters.get('due_to') and (not due or due > filters['due_to']):
+        return False
+    return True
+
+def _page_tasks(pairs, filters, sort, desc, after, limit):
+    """Up to limit matching (id, task) pairs after the keyset position `after`, without sorting the rest."""
+    keyed = ((_task_sort_key(tid, task, sort), tid, task) for tid, task in pairs if _task_matches(task, filters))
+    if after is not None:
+        keyed = (k for k in keyed if (k[0] < after if desc else k[0] > after))
+    pick = heapq.nlargest if desc else heapq.nsmallest
+    return [(tid, task) for key, tid, task in pick(limit, keyed, key=lambda k: k[0])]
+
+def _discard_id(mapping, key, task_id):
+    ids = mapping.get(key)
+    if ids and task_id in ids:
+        ids.remove(task_id)
+        if not ids:
+            del mapping[key]
+
+def split_task_logs(task):
+    """Move comment/history entries off the task: {field: entries numbered by seq}; bumps the counts."""
+    logs = {}
+    for field in TASK_LOG_FIELDS:
+        entries = task.pop(field, None) or []
+        count = task.get(TASK_LOG_COUNTS[field], 0)
+        task[TASK_LOG_COUNTS[field]] = count + len(entries)
+        if entries:
+            logs[field] = [dict(entry, seq=seq) for seq, entry in enumerate(entries, count)]
+    return logs
+
+def _decode_entry(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        # torn last line of a crashed append
+        return None
+
+def _read_backwards(path):
+    """Entries of a log file from the last line to the first, reading TASK_LOG_BLOCK bytes at a time."""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        pos = f.seek(0, os.SEEK_END)
+        rest = b''
+        while pos > 0:
+            size = min(TASK_LOG_BLOCK, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + rest).split(b'\n')
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                entry = _decode_entry(line) if line else None
+                if entry is not None:
+                    yield entry
+        entry = _decode_entry(rest) if rest else None
+        if entry is not None:
+            yield entry
+
+class ConflictError(Exception):
+    """A record changed between being read and being committed."""
+
+def _lock_file(path, mode=fcntl.LOCK_EX):
+    f = open(path, 'a')
+    fcntl.flock(f.fileno(), mode)
+    return f
+
+def _check_versions(current, expected, kind):
+    for key, version in expected.items():
+        record = current.get(key)
+        if (record.get('version', 0) if record else 0) != version:
+            raise ConflictError(f"{kind} {key} was modified concurrently")
+
+class JsonStorage:
+    """Whole-file storage in data/tasks.json and data/users.json.
+
+    The per-user TaskIndex is persisted in TASK_INDEX_FILE together with the
+    tasks.json signature it was built from, and rebuilt if they disagree. It is
+    only written with TASKS_LOCK held and stamped with the signature of the
+    tasks.json it was built from, so a stale index never looks current. Its
+    stats are also written to TASK_STATS_FILE, stamped the same way. Commits
+    only update the index in memory; it is saved TASK_INDEX_SAVE_DELAY later
+    (and at exit) if no other process wrote tasks.json meanwhile.
+    """
+
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self._task_index = None
+        self._task_index_source = None
+        self._index_save = None
+        self._atexit_registered = False
+
+    def _tasks(self):
+        # shared read-only view, records handed to callers are copied
+        return load_shared(TASKS_FILE)
+
+    def _load_index(self, source, tasks, locked=False):
+        """Index of tasks, read when source is the tasks.json signature read before tasks was loaded.
+
+        The persisted index is used if it was built from that same file. Otherwise one is built
+        and saved, with TASKS_LOCK already held (locked) or, on the read path, only if the lock
+        is free and tasks.json is still the file tasks came from.
+        """
+        persisted = load_shared(TASK_INDEX_FILE)
+        if source is not None and persisted.get('source') == list(source):
+            return TaskIndex.from_dict(clone(persisted))
+        index = TaskIndex.build(tasks)
+        if locked:
+            self._save_index(index, source)
+            return index
+        try:
+            lock = _lock_file(TASKS_LOCK, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # a writer holds it (possibly this process) and saves its own index
+            return index
+        try:
+            if _file_signature(TASKS_FILE) == source:
+                self._save_index(index, source)
+        finally:
+            lock.close()
+        return index
+
+    def _save_index(self, index, source):
+        # source: signature of the tasks.json the index reflects, taken with TASKS_LOCK held
+        if source is None:
+            return
+        write_file_atomic(TASK_INDEX_FILE, json.dumps(dict(index.to_dict(), source=list(source)), separators=(',', ':')).encode())
+        write_file_atomic(TASK_STATS_FILE, json.dumps({'stats': index.stats, 'source': list(source)}, separators=(',', ':')).encode())
+
+    def _index(self):
+        with self._mutex:
+            source = _file_signature(TASKS_FILE)
+            if self._task_index is None or self._task_index_source != source:
+                tasks = self._tasks()
+                if _file_signature(TASKS_FILE) != source:
+                    # replaced while loading: tasks is newer than source, so build but never save
+                    source = None
+                self._task_index = self._load_index(source, tasks)
+                self._task_index_source = source
+            return self._task_index
+
+    def load_task(self, task_id):
+        return clone(self._tasks().get(task_id))
+
+    def load_tasks(self):
+        return CowDict(self._tasks())
+
+    def tasks_for_user(self, email):
+        with self._mutex:
+            tasks = self._tasks()
+            return [(tid, clone(tasks[tid])) for tid in self._index().visible_ids(email) if tid in tasks]
+
+    def user_task_ids(self, email):
+        with self._mutex:
+            return self._index().ids_for(email)
+
+    def iter_tasks(self, email=None):
+        with self._mutex:
+            tasks = self._tasks()
+            ids = list(tasks) if email is None else self._index().visible_ids(email)
+        for tid in ids:
+            task = tasks.get(tid)
+            if task is not None:
+                yield tid, clone(task)
+
+    def query_tasks(self, email, relation, filters, sort, desc, after, limit):
+        with self._mutex:
+            tasks = self._tasks()
+            index = self._index()
+            ids = index.visible_ids(email) if relation is None else index.ids_for(email)[relation]
+            page = _page_tasks(((tid, tasks[tid]) for tid in ids if tid in tasks), filters, sort, desc, after, limit)
+        return [(tid, clone(task)) for tid, task in page]
+
+    def task_stamps(self, email=None):
+        with self._mutex:
+            tasks = self._tasks()
+            ids = list(tasks) if email is None else self._index().visible_ids(email)
+            return [(tid, tasks[tid].get('version', 0), tasks[tid].get('task_type') == 'live') for tid in ids if tid in tasks]
+
+    def load_task_batch(self, task_ids):
+        tasks = self._tasks()
+        return {tid: clone(tasks[tid]) for tid in task_ids if tid in tasks}
+
+    def _write_tasks(self, changes):
+        with self._mutex:
+            index = self._index()
+            shared = self._tasks()
+            tasks = CowDict(shared)
+            try:
+                for tid, task in changes.items():
+                    old = shared.get(tid)
+                    if task is None:
+                        if old is None:
+                            continue
+                        del tasks[tid]
+                    else:
+                        tasks[tid] = task
+                    index.update(tid, old, task)
+                save_data(TASKS_FILE, tasks)
+            except Exception:
+                self._task_index = None
+                raise
+            # commit() holds TASKS_LOCK, so nothing replaced tasks.json since save_data
+            self._task_index_source = _file_signature(TASKS_FILE)
+            if self._index_save is None:
+                self._index_save = threading.Timer(TASK_INDEX_SAVE_DELAY, self.save_pending_index)
+                self._index_save.daemon = True
+                self._index_save.start()
+                if not self._atexit_registered:
+                    atexit.register(self.save_pending_index)
+                    self._atexit_registered = True
+
+    def save_pending_index(self):
+        """Persist the index updated by this process's commits, unless another writer has replaced tasks.json since."""
+        with self._mutex:
+            if self._index_save is None:
+                return
+            self._index_save.cancel()
+            self._index_save = None
+            lock = _lock_file(TASKS_LOCK)
+            try:
+                if self._task_index is not None and self._task_index_source == _file_signature(TASKS_FILE):
+                    self._save_index(self._task_index, self._task_index_source)
+            finally:
+                lock.close()
+
+    def _current_tasks(self):
+        # called with TASKS_LOCK held
+        return load_shared(TASKS_FILE)
+
+    def _log_path(self, task_id, field):
+        return os.path.join(TASK_LOGS_DIR, f"{task_id}.{field}.log")
+
+    def _append_logs(self, logs):
+        # called from commit() with TASKS_LOCK held; entries past the task's count
+        # (appended by a commit that crashed before writing the task) are ignored by readers
+        os.makedirs(TASK_LOGS_DIR, exist_ok=True)
+        for tid, field, entries in logs:
+            payload = b''.join(json.dumps(entry, separators=(',', ':'), default=str).encode() + b'\n' for entry in entries)
+            start = time.perf_counter()
+            with open(self._log_path(tid, field), 'ab+') as f:
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        payload = b'\n' + payload
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            metrics.record_io('save', len(payload), time.perf_counter() - start)
+
+    def _remove_logs(self, task_id):
+        for field in TASK_LOG_FIELDS:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._log_path(task_id, field))
+
+    def load_log_page(self, task_id, field, before, limit):
+        page, seen = [], set()
+        for entry in _read_backwards(self._log_path(task_id, field)):
+            # the last line written for a seq wins
+            if entry['seq'] in seen:
+                continue
+            seen.add(entry['seq'])
+            if entry['seq'] < before:
+                page.append(entry)
+                if len(page) == limit:
+                    break
+        return page
+
+    def load_log(self, task_id, field, count):
+        entries = {}
+        try:
+            with open(self._log_path(task_id, field), 'rb') as f:
+                for line in f:
+                    entry = _decode_entry(line)
+                    if entry is not None and entry['seq'] < count:
+                        entries[entry['seq']] = entry
+        except FileNotFoundError:
+            pass
+        return [entries[seq] for seq in sorted(entries)]
+
+    def commit(self, tasks, users, expected_tasks=None, expected_users=None, logs=None):
+        """Write staged tasks (None = delete), their new comment/history entries and users,
+        at most one write per store.
+
+        Both stores are locked and every expected version checked before
+        anything is written, so a conflict leaves both untouched.
+        """
+        with self._mutex:
+            locks = []
+            try:
+                if tasks:
+                    locks.append(_lock_file(TASKS_LOCK))
+                if users:
+                    locks.append(_lock_file(USERS_LOCK))
+                if tasks:
+                    _check_versions(self._current_tasks(), expected_tasks or {}, 'Task')
+                if users:
+                    _check_versions(load_shared(USERS_FILE), expected_users or {}, 'User')
+                if logs:
+                    self._append_logs(logs)
+                if tasks:
+                    self._write_tasks(tasks)
+                    for tid, task in tasks.items():
+                        if task is None:
+                            self._remove_logs(tid)
+                if users:
+                    data = load_data(USERS_FILE)
+                    data.update(users)
+                    save_data(USERS_FILE, data)
+            finally:
+                for lock in reversed(locks):
+                    lock.close()
+
+    def next_task_id(self):
+        # allocated under an exclusive lock so concurrent creators never share an id
+        fd = os.open(TASK_SEQ_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            current = os.pread(fd, 32, 0).strip()
+            last = int(current) if current else max([int(k) for k in self._tasks().keys()] or [0])
+            # fixed width, so the value is overwritten in place without a truncate
+            os.pwrite(fd, b'%020d' % (last + 1), 0)
+        finally:
+            os.close(fd)
+        return str(last + 1)
+
+    def ids_with_description(self, description):
+        with self._mutex:
+            return self._index().ids_with_description(description)
+
+    def task_stats(self, scope):
+        with self._mutex:
+            source = _file_signature(TASKS_FILE)
+            if source is not None and (self._task_index is None or self._task_index_source != source):
+                # tasks.json changed since this process last indexed it: the writer's stats are enough
+                persisted = load_shared(TASK_STATS_FILE)
+                if persisted.get('source') == list(source):
+                    return dict(persisted['stats'].get(scope, {}))
+            return self._index().stat_counts(scope)
+
+    def ids_with_title(self, owner, title):
+        with self._mutex:
+            return self._index().ids_with_title(owner, title)
+
+    def load_user(self, email):
+        return clone(load_shared(USERS_FILE).get(email))
+
+    def load_users(self):
+        return load_data(USERS_FILE)
+
+    def _mailbox_path(self, email):
+        return os.path.join(NOTIFICATIONS_DIR, quote(email, safe='@.') + '.json')
+
+    def load_mailbox(self, email):
+        data = data_cache.get(self._mailbox_path(email))
+        return clone(data) if data is not None else None
+
+    def update_mailbox(self, email, update):
+        """Read-modify-write of one mailbox: update(mailbox or None) returns the new mailbox."""
+        os.makedirs(NOTIFICATIONS_DIR, exist_ok=True)
+        path = self._mailbox_path(email)
+        lock = _lock_file(NOTIFICATIONS_LOCK)
+        try:
+            mailbox = update(self.load_mailbox(email))
+            write_file_atomic(path, json.dumps(mailbox, separators=(',', ':'), default=str).encode())
+            data_cache.put(path, mailbox)
+        finally:
+            lock.close()
+        return mailbox
+
+def _diff_task(old, new):
+    """Journal record turning old into new; appends to comments/history carry their start index so replay is idempotent."""
+    if old is None:
+        return {'put': new}
+    record = {}
+    changed = {k: v for k, v in new.items() if k not in TASK_LOG_FIELDS and old.get(k) != v}
+    if changed:
+        record['set'] = changed
+    removed = [k for k in old if k not in new]
+    if removed:
+        record['unset'] = removed
+    for field in TASK_LOG_FIELDS:
+        before, after = old.get(field, []), new.get(field)
+        if after is None or after == before:
+            continue
+        start = len(before) if after[:len(before)] == before else 0
+        record.setdefault('append', {})[field] = [start, after[start:]]
+    return record
+
+def _apply_record(tasks, record):
+    tid = record['id']
+    if 'delete' in record:
+        tasks.pop(tid, None)
+        return
+    if 'put' in record:
+        tasks[tid] = record['put']
+        return
+    if tid not in tasks:
+        return
+    # copy-on-write: the previous task object may be shared with the data cache or a reader
+    task = dict(tasks[tid])
+    task.update(record.get('set', {}))
+    for k in record.get('unset', []):
+        task.pop(k, None)
+    for field, (start, items) in record.get('append', {}).items():
+        task[field] = task.get(field, [])[:start] + items
+    tasks[tid] = task
+
+class JournalStorage(JsonStorage):
+    """tasks.json snapshot plus an append-only TASKS_LOG of per-task records.
+
+    Every task mutation costs one small appended line. Readers keep the replayed
+    state in memory and only read the log tail written since their last look.
+    Once the log passes JOURNAL_MAX_BYTES/JOURNAL_MAX_RECORDS a background thread
+    folds it into a new snapshot, written to a temp file and swapped in with
+    os.replace, so a crash at any point leaves either the old or the new snapshot.
+    Records are idempotent, so replaying a log already folded into the snapshot
+    (crash between the swap and the log truncate) gives the same state.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._state = {}
+        self._snapshot_sig = None
+        self._log_pos = 0
+        self._log_records = 0
+        self._compacting = False
+
+    def _refresh(self):
+        sig = _file_signature(TASKS_FILE)
+        # no tasks.json yet (fresh data dir) has the signature None too, so also build the first time
+        if self._task_index is None or sig != self._snapshot_sig:
+            self._state = dict(load_shared(TASKS_FILE))
+            # always called with TASKS_LOCK held (shared or exclusive), so the snapshot is stable
+            self._task_index = self._load_index(sig, self._state, locked=True)
+            self._snapshot_sig = sig
+            self._log_pos = 0
+            self._log_records = 0
+        if not os.path.exists(TASKS_LOG):
+            return
+        with open(TASKS_LOG, 'rb') as f:
+            f.seek(self._log_pos)
+            tail = f.read()
+        # a torn last line (crash mid-append) is left for the next writer to terminate
+        end = tail.rfind(b'\n') + 1
+        for line in tail[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            self._apply(record)
+            self._log_records += 1
+        self._log_pos += end
+
+    def _apply(self, record):
+        tid = record['id']
+        old = self._state.get(tid)
+        _apply_record(self._state, record)
+        self._task_index.update(tid, old, self._state.get(tid))
+
+    def _tasks(self):
+        with self._mutex:
+            lock = _lock_file(TASKS_LOCK, fcntl.LOCK_SH)
+            try:
+                self._refresh()
+            finally:
+                lock.close()
+            return self._state
+
+    def load_task(self, task_id):
+        with self._mutex:
+            return super().load_task(task_id)
+
+    def load_tasks(self):
+        with self._mutex:
+            return super().load_tasks()
+
+    def _index(self):
+        with self._mutex:
+            self._tasks()
+            return self._task_index
+
+    def _current_tasks(self):
+        self._refresh()
+        return self._state
+
+    def task_stats(self, scope):
+        # TASK_STATS_FILE reflects the snapshot only; the index replayed from the log tail is current
+        with self._mutex:
+            return self._index().stat_counts(scope)
+
+    def _write_tasks(self, changes):
+        # called from commit() with TASKS_LOCK held and _current_tasks() just refreshed
+        lines = []
+        for tid, task in changes.items():
+            old = self._state.get(tid)
+            if task is None:
+                record = {'delete': True} if old is not None else None
+            else:
+                record = _diff_task(old, task)
+            if record:
+                record['id'] = tid
+                lines.append(json.dumps(record, separators=(',', ':'), default=str).encode() + b'\n')
+        if not lines:
+            return
+        payload = b''.join(lines)
+        start = time.perf_counter()
+        with open(TASKS_LOG, 'ab') as f:
+            if f.tell() > self._log_pos:
+                # terminate a torn record left by a crashed writer
+                payload = b'\n' + payload
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+            self._log_pos = f.tell()
+        metrics.record_io('save', len(payload), time.perf_counter() - start)
+        for line in lines:
+            self._apply(json.loads(line))
+        self._log_records += len(lines)
+        if (self._log_pos > JOURNAL_MAX_BYTES or self._log_records > JOURNAL_MAX_RECORDS) and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        with self._mutex:
+            lock = _lock_file(TASKS_LOCK)
+            try:
+                self._refresh()
+                write_file_atomic(TASKS_FILE, encode_data(self._state))
+                with open(TASKS_LOG, 'wb') as f:
+                    os.fsync(f.fileno())
+                self._snapshot_sig = _file_signature(TASKS_FILE)
+                self._save_index(self._task_index, self._snapshot_sig)
+                self._log_pos = 0
+                self._log_records = 0
+            finally:
+                lock.close()
+                self._compacting = False
+
+def write_file_atomic(file_path, payload):
+    start = time.perf_counter()
+    tmp_path = f"{file_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+    metrics.record_io('save', len(payload), time.perf_counter() - start)
+
+class SqliteStorage:
+    """Row-level storage in a SQLite database (one connection per thread)."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_file) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SQLITE_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _build_tasks(self, conn, ids_sql, params=()):
+        tasks, nbytes, start = {}, 0, time.perf_counter()
+        for tid, data in conn.execute(f'SELECT id, data FROM tasks WHERE id IN ({ids_sql}) ORDER BY CAST(id AS INTEGER), id', params):
+            nbytes += len(data)
+            task = json.loads(data)
+            task['shared_with'] = []
+            task['statuses'] = {}
+            tasks[tid] = task
+        if not tasks:
+            metrics.record_io('load', 0, time.perf_counter() - start)
+            return tasks
+        for tid, email in conn.execute(f'SELECT task_id, email FROM task_shares WHERE task_id IN ({ids_sql}) ORDER BY task_id, position', params):
+            tasks[tid]['shared_with'].append(email)
+        for tid, email, status in conn.execute(f'SELECT task_id, email, status FROM task_statuses WHERE task_id IN ({ids_sql}) ORDER BY task_id, position', params):
+            tasks[tid]['statuses'][email] = status
+        if any(TASK_LOG_COUNTS['comments'] not in task for task in tasks.values()):
+            # written before the counts were kept on the task
+            for field, table in TASK_LOG_TABLES.items():
+                counts = dict(conn.execute(f'SELECT task_id, COUNT(*) FROM {table} WHERE task_id IN ({ids_sql}) GROUP BY task_id', params))
+                for tid, task in tasks.items():
+                    task.setdefault(TASK_LOG_COUNTS[field], counts.get(tid, 0))
+        metrics.record_io('load', nbytes, time.perf_counter() - start)
+        return tasks
+
+    def load_task(self, task_id):
+        return self._build_tasks(self._conn(), '?', (task_id,)).get(task_id)
+
+    def load_tasks(self):
+        return self._build_tasks(self._conn(), 'SELECT id FROM tasks')
+
+    def tasks_for_user(self, email):
+        ids_sql = 'SELECT id FROM tasks WHERE owner = ? UNION SELECT task_id FROM task_shares WHERE email = ?'
+        return list(self._build_tasks(self._conn(), ids_sql, (email, email)).items())
+
+    def _visible_ids_sql(self, email):
+        if email is None:
+            return 'SELECT id FROM tasks', ()
+        return 'SELECT id FROM tasks WHERE owner = ? UNION SELECT task_id FROM task_shares WHERE email = ?', (email, email)
+
+    def iter_tasks(self, email=None, batch_size=500):
+        ids_sql, params = self._visible_ids_sql(email)
+        ids = [r[0] for r in self._conn().execute(f'SELECT id FROM ({ids_sql}) ORDER BY CAST(id AS INTEGER), id', params)]
+        for start in range(0, len(ids), batch_size):
+            yield from self.load_task_batch(ids[start:start + batch_size]).items()
+
+    def query_tasks(self, email, relation, filters, sort, desc, after, limit):
+        shares = ('SELECT sh.task_id FROM task_shares sh LEFT JOIN task_statuses st '
+                  'ON st.task_id = sh.task_id AND st.email = sh.email WHERE sh.email = ? AND ')
+        if relation is None:
+            ids_sql, params = self._visible_ids_sql(email)
+        else:
+            ids_sql = {'owned': 'SELECT id FROM tasks WHERE owner = ?',
+                       'shared': shares + "(st.status IS NULL OR st.status != 'Pending')",
+                       'pending': shares + "st.status = 'Pending'"}[relation]
+            params = (email,)
+        where, params = [f'id IN ({ids_sql})'], list(params)
+        for field in TASK_FILTER_FIELDS:
+            if filters.get(field) is not None:
+                where.append('master_status = ?' if field == 'master_status' else f"json_extract(data, '$.{field}') = ?")
+                params.append(filters[field])
+        if filters.get('due_from'):
+            where.append("COALESCE(due_date, '') >= ?")
+            params.append(filters['due_from'])
+        if filters.get('due_to'):
+            where.append("due_date IS NOT NULL AND due_date != '' AND due_date <= ?")
+            params.append(filters['due_to'])
+        column = {'id': "''", 'created_at': "json_extract(data, '$.created_at')"}.get(sort, sort)
+        key = f"COALESCE({column}, '')"
+        direction, cmp = ('DESC', '<') if desc else ('ASC', '>')
+        if after is not None:
+            where.append(f'({key} {cmp} ? OR ({key} = ? AND CAST(id AS INTEGER) {cmp} ?))')
+            params += [after[0], after[0], after[1]]
+        ids = [r[0] for r in self._conn().execute(
+            f"SELECT id FROM tasks WHERE {' AND '.join(where)} ORDER BY {key} {direction}, CAST(id AS INTEGER) {direction} LIMIT ?",
+            params + [limit])]
+        tasks = self.load_task_batch(ids)
+        return [(tid, tasks[tid]) for tid in ids if tid in tasks]
+
+    def task_stamps(self, email=None):
+        ids_sql, params = self._visible_ids_sql(email)
+        return [(tid, version, task_type == 'live') for tid, version, task_type in self._conn().execute(
+            f"SELECT id, COALESCE(json_extract(data, '$.version'), 0), json_extract(data, '$.task_type') FROM tasks "
+            f"WHERE id IN ({ids_sql}) ORDER BY CAST(id AS INTEGER), id", params)]
+
+    def load_task_batch(self, task_ids):
+        # callers keep batches well under SQLite's bound-parameter limit
+        return self._build_tasks(self._conn(), ','.join('?' * len(task_ids)), list(task_ids)) if task_ids else {}
+
+    def user_task_ids(self, email):
+        conn = self._conn()
+        ids = {'owned': [r[0] for r in conn.execute('SELECT id FROM tasks WHERE owner = ? ORDER BY CAST(id AS INTEGER)', (email,))],
+               'shared': [], 'pending': []}
+        for tid, status in conn.execute('SELECT sh.task_id, st.status FROM task_shares sh LEFT JOIN task_statuses st '
+                                        'ON st.task_id = sh.task_id AND st.email = sh.email WHERE sh.email = ? '
+                                        'ORDER BY CAST(sh.task_id AS INTEGER)', (email,)):
+            ids['pending' if status == 'Pending' else 'shared'].append(tid)
+        return ids
+
+    def _append_log(self, conn, task_id, field, entries):
+        conn.executemany(f'INSERT OR REPLACE INTO {TASK_LOG_TABLES[field]} (task_id, seq, data) VALUES (?, ?, ?)',
+                         [(task_id, entry['seq'], json.dumps({k: v for k, v in entry.items() if k != 'seq'}, default=str))
+                          for entry in entries])
+
+    def _log_entries(self, rows):
+        return [dict(json.loads(data), seq=seq) for seq, data in rows]
+
+    def load_log_page(self, task_id, field, before, limit):
+        return self._log_entries(self._conn().execute(
+            f'SELECT seq, data FROM {TASK_LOG_TABLES[field]} WHERE task_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?',
+            (task_id, before, limit)))
+
+    def load_log(self, task_id, field, count):
+        return self._log_entries(self._conn().execute(
+            f'SELECT seq, data FROM {TASK_LOG_TABLES[field]} WHERE task_id = ? AND seq < ? ORDER BY seq', (task_id, count)))
+
+    def _stored_stat_fields(self, conn, task_id):
+        row = conn.execute("SELECT owner, master_status, json_extract(data, '$.category'), json_extract(data, '$.task_type') "
+                           "FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        shares = [r[0] for r in conn.execute('SELECT email FROM task_shares WHERE task_id = ?', (task_id,))]
+        return {'owner': row[0], 'master_status': row[1], 'category': row[2], 'task_type': row[3], 'shared_with': shares}
+
+    def _update_stats(self, conn, task_id, task):
+        deltas = _stat_deltas(self._stored_stat_fields(conn, task_id), task)
+        conn.executemany('INSERT INTO task_stats (scope, key, count) VALUES (?, ?, ?) '
+                         'ON CONFLICT(scope, key) DO UPDATE SET count = count + excluded.count',
+                         [(scope, key, delta) for (scope, key), delta in deltas])
+        conn.executemany('DELETE FROM task_stats WHERE scope = ? AND key = ? AND count <= 0',
+                         [entry for entry, delta in deltas if delta < 0])
+
+    def task_stats(self, scope):
+        return dict(self._conn().execute('SELECT key, count FROM task_stats WHERE scope = ?', (scope,)))
+
+    def _write_task(self, conn, task_id, task):
+        fields = {k: v for k, v in task.items() if k not in TASK_CHILD_FIELDS}
+        conn.execute('INSERT INTO tasks (id, owner, title, description, master_status, due_date, data) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                     'ON CONFLICT(id) DO UPDATE SET owner = excluded.owner, title = excluded.title, description = excluded.description, '
+                     'master_status = excluded.master_status, due_date = excluded.due_date, data = excluded.data',
+                     (task_id, task['owner'], task['title'], task.get('description'), task.get('master_status'),
+                      task.get('due_date'), json.dumps(fields, default=str)))
+        conn.execute('DELETE FROM task_statuses WHERE task_id = ?', (task_id,))
+        conn.executemany('INSERT INTO task_statuses (task_id, email, status, position) VALUES (?, ?, ?, ?)',
+                         [(task_id, email, status, pos) for pos, (email, status) in enumerate(task.get('statuses', {}).items())])
+        conn.execute('DELETE FROM task_shares WHERE task_id = ?', (task_id,))
+        conn.executemany('INSERT INTO task_shares (task_id, email, position) VALUES (?, ?, ?)',
+                         [(task_id, email, pos) for pos, email in enumerate(task.get('shared_with', []))])
+
+    def _delete_task(self, conn, task_id):
+        for table in ('task_statuses', 'task_shares', 'task_comments', 'task_history'):
+            conn.execute(f'DELETE FROM {table} WHERE task_id = ?', (task_id,))
+        conn.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
+
+    def _check_versions(self, conn, table, key_column, expected, kind):
+        for key, version in expected.items():
+            row = conn.execute(f"SELECT COALESCE(json_extract(data, '$.version'), 0) FROM {table} WHERE {key_column} = ?", (key,)).fetchone()
+            if (row[0] if row else 0) != version:
+                raise ConflictError(f"{kind} {key} was modified concurrently")
+
+    def commit(self, tasks, users, expected_tasks=None, expected_users=None, logs=None):
+        """Write staged tasks (None = delete), their new comment/history entries and users in one database transaction.
+
+        BEGIN IMMEDIATE takes the write lock up front, so the version checks
+        and the writes cannot interleave with another writer.
+        """
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._check_versions(conn, 'tasks', 'id', expected_tasks or {}, 'Task')
+            self._check_versions(conn, 'users', 'email', expected_users or {}, 'User')
+            for tid, task in tasks.items():
+                self._update_stats(conn, tid, task)
+                if task is None:
+                    self._delete_task(conn, tid)
+                else:
+                    self._write_task(conn, tid, task)
+            for tid, field, entries in logs or []:
+                self._append_log(conn, tid, field, entries)
+            for email, user in users.items():
+                self._write_user(conn, email, user)
+
+    def next_task_id(self):
+        conn = self._conn()
+        with conn:
+            # the UPDATE takes the database write lock, so concurrent creators never share an id
+            row = conn.execute("UPDATE sequences SET value = value + 1 WHERE name = 'tasks' RETURNING value").fetchone()
+            if row is None:
+                conn.execute("INSERT INTO sequences (name, value) SELECT 'tasks', COALESCE(MAX(CAST(id AS INTEGER)), 0) + 1 FROM tasks")
+                row = conn.execute("SELECT value FROM sequences WHERE name = 'tasks'").fetchone()
+        return str(row[0])
+
+    def ids_with_description(self, description):
+        return [r[0] for r in self._conn().execute('SELECT id FROM tasks WHERE description = ?', (description,))]
+
+    def ids_with_title(self, owner, title):
+        return [r[0] for r in self._conn().execute('SELECT id FROM tasks WHERE owner = ? AND title = ?', (owner, title))]
+
+    def load_user(self, email):
+        row = self._conn().execute('SELECT data FROM users WHERE email = ?', (email,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_users(self):
+        return {email: json.loads(data) for email, data in self._conn().execute('SELECT email, data FROM users ORDER BY rowid')}
+
+    def _write_user(self, conn, email, user):
+        conn.execute('INSERT INTO users (email, name, password_hash, data) VALUES (?, ?, ?, ?) '
+                     'ON CONFLICT(email) DO UPDATE SET name = excluded.name, password_hash = excluded.password_hash, data = excluded.data',
+                     (email, user.get('name'), user.get('password_hash'), json.dumps(user, default=str)))
+
+    def load_mailbox(self, email):
+        row = self._conn().execute('SELECT data FROM mailboxes WHERE email = ?', (email,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_mailbox(self, email, update):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            mailbox = update(self.load_mailbox(email))
+            conn.execute('INSERT INTO mailboxes (email, data) VALUES (?, ?) ON CONFLICT(email) DO UPDATE SET data = excluded.data',
+                         (email, json.dumps(mailbox, default=str)))
+        return mailbox
+
+
+_storage = None
+
+def cache_stats():
+    return data_cache.stats()
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == 'sqlite':
+            _storage = SqliteStorage(DB_FILE)
+        elif STORAGE_BACKEND == 'journal':
+            _storage = JournalStorage()
+        elif STORAGE_BACKEND == 'json':
+            _storage = JsonStorage()
+        else:
+            raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+    return _storage
+
+class Transaction:
+    """Task and user writes staged in memory until the outermost transaction() block commits.
+
+    Staged tasks get their own TaskIndex so reads inside the transaction
+    (membership, uniqueness) see them without scanning the stage.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.users = {}
+        self.index = TaskIndex()
+        # versions of records as first read, checked again at commit
+        self.task_versions = {}
+        # (task id, field, entries) split off saved tasks, appended at commit
+        self.logs = []
+        # {email: [notifications]} delivered after commit, see src/user.py add_notification
+        self.outbox = {}
+        self.callbacks = []
+
+    def after_commit(self, callback):
+        """Run callback once the outermost block has committed; dropped if it fails or is retried."""
+        self.callbacks.append(callback)
+
+    def stage_task(self, task_id, task):
+        if task is not None:
+            self.logs += [(task_id, field, entries) for field, entries in split_task_logs(task).items()]
+        self.index.update(task_id, self.tasks.get(task_id), task)
+        self.tasks[task_id] = task
+
+    def commit(self):
+        if not self.tasks and not self.users:
+            return
+        expected_tasks = {}
+        for tid, task in self.tasks.items():
+            if task is not None:
+                expected_tasks[tid] = task.get('version', 0)
+                task['version'] = expected_tasks[tid] + 1
+            elif tid in self.task_versions:
+                expected_tasks[tid] = self.task_versions[tid]
+        expected_users = {}
+        for email, user in self.users.items():
+            expected_users[email] = user.get('version', 0)
+            user['version'] = expected_users[email] + 1
+        logs = [entry for entry in self.logs if self.tasks.get(entry[0]) is not None]
+        start = time.perf_counter()
+        get_storage().commit(self.tasks, self.users, expected_tasks, expected_users, logs)
+        metrics.record_io('commit', 0, time.perf_counter() - start)
+        tx_counters.count('commits')
+        for listener in commit_listeners:
+            try:
+                listener(self.tasks)
+            except Exception:
+                # the write is committed whatever a listener does
+                traceback.print_exc()
+
+# called with the committed {task id: task, or None if deleted} after every commit in this
+# process; the tasks are the stored records and must not be changed
+commit_listeners = []
+
+def on_commit(listener):
+    commit_listeners.append(listener)
+
+class TxCounters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'commits': 0, 'conflicts': 0, 'retries': 0, 'failures': 0}
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+tx_counters = TxCounters()
+
+def tx_stats():
+    return tx_counters.stats()
+
+_tx_local = threading.local()
+
+def current_transaction():
+    return getattr(_tx_local, 'tx', None)
+
+@contextlib.contextmanager
+def transaction():
+    """Unit of work: stage every task/user write in the block and commit them together at the end.
+
+    Nested blocks join the outer one; an exception discards everything staged.
+    """
+    tx = current_transaction()
+    if tx is not None:
+        yield tx
+        return
+    tx = _tx_local.tx = Transaction()
+    try:
+        yield tx
+    finally:
+        _tx_local.tx = None
+    tx.commit()
+    for callback in tx.callbacks:
+        callback()
+
+def run_transaction(fn, *args, on_retry=None, **kwargs):
+    """Run fn in a transaction, re-running it with jittered exponential backoff on ConflictError.
+
+    Inside an outer transaction fn simply joins it; the outermost caller retries.
+    """
+    if current_transaction() is not None:
+        return fn(*args, **kwargs)
+    for attempt in range(TX_MAX_RETRIES + 1):
+        try:
+            with transaction():
+                return fn(*args, **kwargs)
+        except ConflictError:
+            tx_counters.count('conflicts')
+            if attempt == TX_MAX_RETRIES:
+                tx_counters.count('failures')
+                raise
+        tx_counters.count('retries')
+        time.sleep(random.uniform(0, TX_BACKOFF * 2 ** attempt))
+        if on_retry:
+            on_retry()
+
+def transactional(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        return run_transaction(fn, *args, **kwargs)
+    return wrapper
+
+def load_task(task_id):
+    tx = current_transaction()
+    if tx is not None and task_id in tx.tasks:
+        return clone(tx.tasks[task_id])
+    task = get_storage().load_task(task_id)
+    if tx is not None:
+        tx.task_versions.setdefault(task_id, task.get('version', 0) if task else 0)
+    return task
+
+def load_tasks():
+    tasks = get_storage().load_tasks()
+    tx = current_transaction()
+    if tx is not None and tx.tasks:
+        for tid, task in tx.tasks.items():
+            if task is None:
+                if tid in tasks:
+                    del tasks[tid]
+            else:
+                tasks[tid] = clone(task)
+        tasks = CowDict(dict(sorted(dict.items(tasks), key=lambda p: int(p[0]))))
+    return tasks
+
+def tasks_for_user(email):
+    pairs = get_storage().tasks_for_user(email)
+    tx = current_transaction()
+    if tx is None or not tx.tasks:
+        return pairs
+    result = {tid: t for tid, t in pairs if tid not in tx.tasks}
+    for tid in tx.index.visible_ids(email):
+        result[tid] = clone(tx.tasks[tid])
+    return sorted(result.items(), key=lambda p: int(p[0]))
+
+def iter_tasks(email=None):
+    """(id, task) pairs one at a time, all tasks or those visible to email, without materialising the store."""
+    tx = current_transaction()
+    if tx is not None and tx.tasks:
+        return iter(load_tasks().items() if email is None else tasks_for_user(email))
+    return get_storage().iter_tasks(email)
+
+def query_tasks(email, relation=None, filters=None, sort='id', desc=False, after=None, limit=50):
+    """One page of the tasks visible to email (or only its owned/shared/pending ones), filtered and
+    keyset-paginated: `after` is the (sort value, numeric id) of the last task of the previous page.
+    """
+    filters = filters or {}
+    tx = current_transaction()
+    if tx is not None and tx.tasks:
+        pairs = tasks_for_user(email)
+        if relation is not None:
+            wanted = set(user_task_ids(email)[relation])
+            pairs = [(tid, task) for tid, task in pairs if tid in wanted]
+        return _page_tasks(pairs, filters, sort, desc, after, limit)
+    return get_storage().query_tasks(email, relation, filters, sort, desc, after, limit)
+
+def task_stamps(email=None):
+    """[(id, version, is_live)] of all tasks or those visible to email, without loading them.
+
+    Staged writes of the current transaction are not reflected.
+    """
+    return get_storage().task_stamps(email)
+
+def load_task_batch(task_ids):
+    return get_storage().load_task_batch(task_ids)
+
+def task_stats(email=None):
+    """{key: task count} over all tasks or those visible to email, maintained as tasks are
+    written; each key is a JSON [master_status, category, task_type].
+
+    Staged writes of the current transaction are not reflected.
+    """
+    return get_storage().task_stats(TASK_STATS_ALL if email is None else email)
+
+def _unsaved_log_entries(task_id, task, field):
+    # staged in the current transaction or still inline on the record, not in the log yet
+    count = task.get(TASK_LOG_COUNTS[field], 0)
+    entries = [dict(entry, seq=seq) for seq, entry in enumerate(task.get(field) or [], count)]
+    tx = current_transaction()
+    if tx is not None:
+        entries += [entry for tid, f, staged in tx.logs if tid == task_id and f == field for entry in staged]
+    return count, entries
+
+def task_log_page(task_id, task, field, before=None, limit=TASK_LOG_PAGE):
+    """Newest-first page of a task's comments or history with seq < before; returns (entries, next_before or None)."""
+    count, unsaved = _unsaved_log_entries(task_id, task, field)
+    if before is None:
+        before = count + len(task.get(field) or [])
+    page = sorted((entry for entry in unsaved if entry['seq'] < before), key=lambda entry: entry['seq'], reverse=True)[:limit]
+    if len(page) < limit:
+        saved_before = min([before, count] + [entry['seq'] for entry in unsaved])
+        page += get_storage().load_log_page(task_id, field, saved_before, limit - len(page))
+    next_before = page[-1]['seq'] if len(page) == limit and page[-1]['seq'] > 0 else None
+    return page, next_before
+
+def task_log(task_id, task, field):
+    """All of a task's comments or history, oldest first."""
+    count, unsaved = _unsaved_log_entries(task_id, task, field)
+    saved_count = min([count] + [entry['seq'] for entry in unsaved])
+    return get_storage().load_log(task_id, field, saved_count) + sorted(unsaved, key=lambda entry: entry['seq'])
+
+def user_task_ids(email):
+    ids = get_storage().user_task_ids(email)
+    tx = current_transaction()
+    if tx is None or not tx.tasks:
+        return ids
+    staged = tx.index.ids_for(email)
+    return {k: sorted([tid for tid in ids[k] if tid not in tx.tasks] + staged[k], key=int) for k in ids}
+
+def save_task(task_id, task):
+    with transaction() as tx:
+        tx.stage_task(task_id, clone(task))
+
+def remove_task(task_id):
+    with transaction() as tx:
+        tx.stage_task(task_id, None)
+
+def next_task_id():
+    return get_storage().next_task_id()
+
+def _taken(base_ids, staged_ids):
+    tx = current_transaction()
+    return bool(staged_ids) or any(tx is None or tid not in tx.tasks for tid in base_ids)
+
+def description_taken(description):
+    tx = current_transaction()
+    staged = tx.index.ids_with_description(description) if tx else []
+    return _taken(get_storage().ids_with_description(description), staged)
+
+def title_taken(owner, title):
+    tx = current_transaction()
+    staged = tx.index.ids_with_title(owner, title) if tx else []
+    return _taken(get_storage().ids_with_title(owner, title), staged)
+
+def load_user(email):
+    tx = current_transaction()
+    if tx is not None and email in tx.users:
+        return clone(tx.users[email])
+    return get_storage().load_user(email)
+
+def save_user(email, user):
+    with transaction() as tx:
+        tx.users[email] = clone(user)
+
+def load_mailbox(email):
+    return get_storage().load_mailbox(email)
+
+def update_mailbox(email, update):
+    return get_storage().update_mailbox(email, update)
+
+def compact_journal():
+    storage = get_storage()
+    if not isinstance(storage, JournalStorage):
+        return False, "Journal storage is not enabled (SHARETASK_STORAGE=journal)"
+    storage.compact()
+    return True, f"Journal compacted into {TASKS_FILE}"
+
+@transactional
+def split_inline_task_logs():
+    """Move comments/history still stored inside task records (written before the per-task logs) into the logs."""
+    moved = 0
+    for tid, task in load_tasks().items():
+        if any(isinstance(task.get(field), list) for field in TASK_LOG_FIELDS):
+            save_task(tid, task)
+            moved += 1
+    return True, f"Moved comments/history of {moved} tasks out of the task records"
+
+def migrate_json_to_sqlite(db_file=DB_FILE):
+    if os.path.exists(db_file):
+        return False, f"Database already exists: {db_file}"
+    users = load_data(USERS_FILE)
+    # the tasks.json snapshot with the journal's records not yet compacted replayed on top
+    # (the same as tasks.json alone when there is no tasks.log)
+    files = JournalStorage()
+    tasks = files.load_tasks()
+    # built under a temporary name and moved into place only when complete, so a failed
+    # run leaves nothing behind and can simply be repeated
+    partial = db_file + '.partial'
+    _remove_db(partial)
+    storage = SqliteStorage(partial)
+    conn = storage._conn()
+    try:
+        with conn:
+            for email, user in users.items():
+                storage._write_user(conn, email, user)
+                mailbox = files.load_mailbox(email)
+                if mailbox is not None:
+                    conn.execute('INSERT INTO mailboxes (email, data) VALUES (?, ?)', (email, json.dumps(mailbox, default=str)))
+            for tid, task in tasks.items():
+                logs = split_task_logs(task)
+                storage._update_stats(conn, tid, task)
+                storage._write_task(conn, tid, task)
+                for field in TASK_LOG_FIELDS:
+                    storage._append_log(conn, tid, field, logs.get(field) or files.load_log(tid, field, task[TASK_LOG_COUNTS[field]]))
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    except BaseException:
+        conn.close()
+        _remove_db(partial)
+        raise
+    conn.close()
+    os.replace(partial, db_file)
+    _remove_db(partial)
+    return True, f"Migrated {len(users)} users and {len(tasks)} tasks to {db_file}"
+
+def _remove_db(db_file):
+    for path in (db_file, db_file + '-wal', db_file + '-shm'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
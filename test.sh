@@ -60,3 +60,61 @@ run_test "Stop live task (pos)" "python3 main.py login --email testpos1@example.
 run_test "Create non-live (neg for live)" "python3 main.py create-task --title 'Normal Task' --description 'Normal $(date +%s)' --frequency daily --due-date '2025-01-01'"
 run_test "Start non-live (neg)" "python3 main.py start-live-task --task-id 6 --duration 5"
 run_test "Checkin invalid live (neg)" "python3 main.py checkin-live-task --task-id 999"
+
+# Batch, stats, occurrences, scheduler and storage scenarios (pos/neg)
+echo "=== Batch / Stats / Scheduler / Storage Scenarios ===" >> $LOG_FILE
+BATCH_FILE=$(mktemp)
+echo '[{"op": "status", "task_id": "2", "status": "Done"}, {"op": "comment", "task_id": "3", "comment": "Batched comment"}]' > $BATCH_FILE
+run_test "Batch operations (pos)" "python3 main.py batch --file $BATCH_FILE"
+echo '[{"op": "comment", "task_id": "2", "comment": 5}, {"op": "status", "task_id": "999", "status": "Done"}]' > $BATCH_FILE
+run_test "Batch with bad operations (neg, reported per op)" "python3 main.py batch --file $BATCH_FILE"
+run_test "Batch unreadable file (neg)" "python3 main.py batch --file /nonexistent/ops.json"
+rm -f $BATCH_FILE
+run_test "Stats own tasks (pos)" "python3 main.py stats"
+run_test "Stats all live tasks (pos)" "python3 main.py stats --all --type live"
+run_test "Occurrences next week (pos)" "python3 main.py occurrences --days 7"
+run_test "Occurrences invalid start (neg)" "python3 main.py occurrences --start not-a-date"
+run_test "Scheduler single pass (pos)" "python3 main.py scheduler --once"
+MIGRATE_DB=$(mktemp -u --suffix .db)
+run_test "Migrate storage to SQLite (pos)" "python3 main.py migrate-storage --db $MIGRATE_DB"
+run_test "Migrate storage twice (neg)" "python3 main.py migrate-storage --db $MIGRATE_DB"
+rm -f $MIGRATE_DB $MIGRATE_DB-wal $MIGRATE_DB-shm
+
+# A transaction whose task is committed by another writer between its read and its commit is re-run;
+# with the writer interfering on every attempt it gives up after SHARETASK_TX_MAX_RETRIES retries
+CONFLICT_CHECK='python3 - <<EOF
+import subprocess, sys
+from src.utils import ConflictError, run_transaction, load_task, save_task
+WRITER = "from src.utils import run_transaction, load_task, save_task; run_transaction(lambda: save_task(str(3), load_task(str(3))))"
+attempts = []
+def touch(interfere):
+    attempts.append(1)
+    task = load_task(str(3))
+    if interfere(len(attempts)):
+        subprocess.run([sys.executable, "-c", WRITER], check=True)
+    save_task(str(3), task)
+try:
+    run_transaction(touch, INTERFERE)
+except ConflictError as e:
+    print(f"ERROR: {e} after {len(attempts)} attempts")
+    sys.exit(1)
+print(f"Committed after {len(attempts)} attempts")
+sys.exit(0 if len(attempts) == 2 else 1)
+EOF'
+run_test "Transaction retried after concurrent write (pos)" "${CONFLICT_CHECK/INTERFERE/lambda attempt: attempt == 1}"
+run_test "Transaction conflicting on every retry (neg)" "SHARETASK_TX_MAX_RETRIES=2 ${CONFLICT_CHECK/INTERFERE/lambda attempt: True}"
+
+# Journal storage starting from an empty data dir (no tasks.json snapshot yet)
+echo "=== Journal Storage Scenarios ===" >> $LOG_FILE
+JOURNAL_DIR=$(mktemp -d)
+mkdir $JOURNAL_DIR/data
+JOURNAL_CLI="cd $JOURNAL_DIR && SHARETASK_STORAGE=journal python3 $PWD/main.py"
+run_test "Journal register on empty data (pos)" "$JOURNAL_CLI register --email journal1@example.com --password Pass123!test --name Journal1"
+run_test "Journal login (pos)" "$JOURNAL_CLI login --email journal1@example.com --password Pass123!test"
+run_test "Journal create first task (pos)" "$JOURNAL_CLI create-task --title 'Journal Task' --description 'Journal desc' --frequency daily --due-date '2030-01-01'"
+run_test "Journal create dup desc (neg)" "$JOURNAL_CLI create-task --title 'Journal Dup' --description 'Journal desc' --frequency daily --due-date '2030-01-01'"
+run_test "Journal list tasks (pos)" "$JOURNAL_CLI list-tasks"
+run_test "Journal update status, kept in the log (pos)" "$JOURNAL_CLI update-status --task-id 1 --status 'In Progress'"
+run_test "Journal migrate with uncompacted records (pos)" "$JOURNAL_CLI migrate-storage --db $JOURNAL_DIR/data/sharetask.db"
+run_test "SQLite sees journal records after migration (pos)" "cd $JOURNAL_DIR && SHARETASK_STORAGE=sqlite python3 $PWD/main.py list-tasks | grep 'journal1@example.com: In Progress'"
+rm -rf $JOURNAL_DIR